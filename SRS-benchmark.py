@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Замеры производительности SRS.py на синтетических расписаниях.
+
+Работает без сети и без настоящего cron: бот подменяется заглушкой,
+а в PATH кладётся фальшивый crontab, который хранит таблицу в файле.
+Все файлы создаются во временной папке, рабочая установка не трогается.
+
+Примеры:
+    python3 SRS-benchmark.py
+    python3 SRS-benchmark.py --sizes 10,1000 --repeat 5 --output before.json
+    python3 SRS-benchmark.py --compare before.json --output after.json
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import datetime
+
+SRS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SRS.py")
+DEFAULT_SIZES = "10,1000,100000"
+AUDIO_FILES = ["start.mp3", "end.mp3"]
+
+# Фальшивый crontab: -l печатает таблицу, "-" и файл - заменяют её
+FAKE_CRONTAB = """#!/bin/sh
+TABLE="$HOME/.crontab"
+case "$1" in
+    -l) [ -f "$TABLE" ] || { echo "no crontab for $USER" >&2; exit 1; }; cat "$TABLE" ;;
+    -r) rm -f "$TABLE" ;;
+    -)  cat > "$TABLE" ;;
+    *)  cat "$1" > "$TABLE" ;;
+esac
+"""
+
+
+class FakeMessage:
+    """Минимальное сообщение Telegram для вызова обработчиков"""
+
+    def __init__(self, chat_id=1, text=""):
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.audio = None
+        self.document = None
+        self.message_id = 1
+
+
+class FakeBot:
+    """Запоминает размер отправленных сообщений вместо отправки"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(len(text))
+        return FakeMessage(chat_id, text)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text)
+
+
+def prepare_environment(work_dir, storage):
+    """Фальшивый crontab в PATH и переменные окружения до импорта SRS"""
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    crontab = os.path.join(bin_dir, "crontab")
+    with open(crontab, "w") as f:
+        f.write(FAKE_CRONTAB)
+    os.chmod(crontab, 0o755)
+
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["HOME"] = work_dir
+    os.environ["TELEGRAM_BOT_TOKEN"] = "0:benchmark"
+    os.environ.setdefault("BOT_PASSWORD", "benchmark")
+    os.environ["STORAGE_BACKEND"] = storage
+    os.environ["STORAGE_DB"] = os.path.join(work_dir, "srs.db")
+    os.chdir(work_dir)
+
+
+def import_srs(work_dir):
+    spec = importlib.util.spec_from_file_location("SRS", SRS_PATH)
+    srs = importlib.util.module_from_spec(spec)
+    sys.modules["SRS"] = srs
+    spec.loader.exec_module(srs)
+    # Расписание и хранилище - во временной папке, а не рядом с SRS.py
+    srs.SCHEDULE_FILE = os.path.join(work_dir, "schedule.txt")
+    fake_bot = FakeBot()
+    srs.bot.send_message = fake_bot.send_message
+    srs.bot.reply_to = fake_bot.reply_to
+    for name in AUDIO_FILES:
+        with open(os.path.join(srs.AUDIO_DIR, name), "wb") as f:
+            f.write(b"\xff\xfb" + b"\0" * 1024)
+    return srs, fake_bot
+
+
+def synthetic_events(srs, count):
+    """count событий основного профиля: уроки по 45 минут с шагом 7 минут.
+
+    На больших размерах уроки неизбежно пересекаются - для замеров это не
+    важно, проверка времени при этом проходит свой полный путь.
+    """
+    events = []
+    for i in range(count // 2):
+        start = (8 * 60 + i * 7) % (23 * 60)
+        lesson_num = str(i + 1)
+        events.append(srs.LessonEvent(lesson_num, "start", srs.minutes_to_time(start), AUDIO_FILES[0]))
+        events.append(srs.LessonEvent(lesson_num, "end", srs.minutes_to_time(start + 45), AUDIO_FILES[1]))
+    return events
+
+
+def measure(fn, setup=None, repeat=3):
+    """Время (мин/медиана по repeat запускам) и пик памяти одного запуска"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+
+    # Память меряем отдельным запуском: tracemalloc сильно замедляет код
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "min_s": round(min(timings), 6),
+        "median_s": round(statistics.median(timings), 6),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def run_size(srs, fake_bot, size, repeat):
+    """Замеры всех этапов для расписания из size событий"""
+    events = synthetic_events(srs, size)
+    next_lesson = str(size // 2 + 1)
+    message = FakeMessage()
+
+    def cold_schedule():
+        srs.invalidate_schedule_cache()
+
+    def cold_crontab():
+        srs._crontab_cache["index"] = None
+
+    def cold_index():
+        cold_schedule()
+        srs.load_events()
+
+    stages = {
+        "save_events": (lambda: srs.save_events(events), None),
+        "load_events_cold": (srs.load_events, cold_schedule),
+        "load_events_warm": (srs.load_events, None),
+        "validate_lesson_times_cold": (
+            lambda: srs.validate_lesson_times(
+                next_lesson, "23:50", "23:55", events, index=srs.get_schedule_index()
+            ),
+            cold_index,
+        ),
+        "validate_lesson_times_warm": (
+            lambda: srs.validate_lesson_times(
+                next_lesson, "23:50", "23:55", events, index=srs.get_schedule_index()
+            ),
+            None,
+        ),
+        "generate_cron_jobs": (lambda: srs.generate_cron_jobs(events), None),
+        "install_cron_jobs": (srs.install_cron_jobs, None),
+        "get_cron_status_cold": (srs.get_cron_status, cold_crontab),
+        "get_cron_status_warm": (srs.get_cron_status, None),
+        "show_schedule": (lambda: srs.show_schedule(message), None),
+    }
+
+    results = {}
+    for name, (fn, setup) in stages.items():
+        fake_bot.sent.clear()
+        results[name] = measure(fn, setup, repeat)
+        if fake_bot.sent:
+            results[name]["sent_chars"] = sum(fake_bot.sent) // (repeat + 1)
+        print(
+            f"  {name:<28} {results[name]['min_s'] * 1000:>10.2f} мс"
+            f" (медиана {results[name]['median_s'] * 1000:.2f}), пик {results[name]['peak_kb']:.0f} КБ"
+        )
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", os.path.dirname(SRS_PATH), "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(previous, current, threshold, min_ms):
+    """Печатает этапы, ставшие медленнее в threshold раз. Возвращает их число.
+    Этапы быстрее min_ms миллисекунд не сравниваются - там один шум."""
+    regressions = 0
+    for size, stages in current["results"].items():
+        for name, result in stages.items():
+            old = previous.get("results", {}).get(size, {}).get(name)
+            if not old or not old["min_s"] or max(old["min_s"], result["min_s"]) * 1000 < min_ms:
+                continue
+            ratio = result["min_s"] / old["min_s"]
+            if ratio >= threshold:
+                regressions += 1
+                print(f"⚠️ {size} событий, {name}: {old['min_s'] * 1000:.2f} -> {result['min_s'] * 1000:.2f} мс (x{ratio:.2f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности SRS.py")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Размеры расписаний через запятую")
+    parser.add_argument("--repeat", type=int, default=3, help="Запусков каждого этапа")
+    parser.add_argument("--storage", choices=["text", "sqlite"], default="text")
+    parser.add_argument("--output", default="benchmark_results.json", help="Куда сохранить JSON")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Во сколько раз медленнее - регрессия")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="Не сравнивать этапы быстрее N мс")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    output = os.path.abspath(args.output)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="srs-bench-") as work_dir:
+        prepare_environment(work_dir, args.storage)
+        srs, fake_bot = import_srs(work_dir)
+        logging.disable(logging.ERROR)  # Предупреждения о пересечениях не нужны
+
+        report = {
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "storage": args.storage,
+                "repeat": args.repeat,
+            },
+            "results": {},
+        }
+        for size in sizes:
+            print(f"{size} событий:")
+            report["results"][str(size)] = run_size(srs, fake_bot, size, args.repeat)
+        report["meta"]["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.chdir(os.path.dirname(SRS_PATH))
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты: {output}")
+
+    if previous is not None and compare(previous, report, args.threshold, args.min_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
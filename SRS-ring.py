@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Обёртка для строк cron: играет звонок и пишет его точность в журнал.
+
+    SRS-ring.py <журнал> <ЧЧ:ММ> <профиль> <урок> <start|end> <плеер> <файл>
+
+Если бот запущен с постоянным плеером, звонок уходит ему строкой в канал
+player.fifo рядом с журналом - плеер уже держит устройство открытым и сам
+пишет журнал. Иначе запускается mpg123 в режиме -R: момент первой строки
+@F - первый сыгранный кадр. В журнал дописывается строка того же формата,
+что у record_ring в SRS.py. Только стандартная библиотека, чтобы запуск из
+cron был быстрым.
+"""
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+
+def scheduled_time(hhmm, now):
+    """Время звонка по расписанию для сегодняшней (или вчерашней) даты"""
+    hour, minute = map(int, hhmm.split(':'))
+    scheduled = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    # Cron запустил звонок 23:59 уже после полуночи
+    if scheduled - now > timedelta(hours=12):
+        scheduled -= timedelta(days=1)
+    return scheduled.timestamp()
+
+
+def send_to_player(fifo_path, scheduled, profile, lesson, event_type, audio_path):
+    """Отдаёт звонок постоянному плееру бота. False - канала нет или его никто не читает"""
+    try:
+        # Без читателя open с O_NONBLOCK сразу падает с ENXIO, а не ждёт
+        fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    line = "\t".join(["PLAY", str(scheduled), profile, lesson, event_type, os.path.abspath(audio_path)]) + "\n"
+    try:
+        os.write(fd, line.encode())
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def play(player, audio_path):
+    """Играет файл, возвращает (код выхода, запуск плеера, первый сэмпл)"""
+    if 'mpg123' not in os.path.basename(player):
+        started = time.time()
+        return subprocess.call([player, audio_path]), started, None
+
+    proc = subprocess.Popen([player, '-R'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    started = time.time()
+    first_sample = None
+    try:
+        proc.stdin.write(f"LOAD {audio_path}\n".encode())
+        proc.stdin.flush()
+        for line in proc.stdout:
+            if line.startswith(b'@F') and first_sample is None:
+                first_sample = time.time()
+                proc.stdin.write(b"SILENCE\n")
+                proc.stdin.flush()
+            elif line.startswith(b'@E'):
+                sys.stderr.write(line.decode(errors='replace'))
+                break
+            elif line.startswith(b'@P 0'):
+                break
+        proc.stdin.write(b"QUIT\n")
+        proc.stdin.close()
+    except (BrokenPipeError, OSError):
+        pass
+    return proc.wait(), started, first_sample
+
+
+def record(log_path, scheduled, started, first_sample, profile, lesson, event_type):
+    def delay_ms(moment):
+        return "-" if moment is None else str(round((moment - scheduled) * 1000))
+    line = "\t".join([
+        str(int(scheduled)), delay_ms(started), delay_ms(first_sample),
+        profile, lesson, event_type, "cron"
+    ]) + "\n"
+    fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def main():
+    if len(sys.argv) != 8:
+        sys.stderr.write(__doc__)
+        return 2
+    log_path, hhmm, profile, lesson, event_type, player, audio_path = sys.argv[1:]
+    scheduled = scheduled_time(hhmm, datetime.now())
+    fifo_path = os.path.join(os.path.dirname(log_path), "player.fifo")
+    if send_to_player(fifo_path, scheduled, profile, lesson, event_type, audio_path):
+        return 0
+    code, started, first_sample = play(player, audio_path)
+    try:
+        record(log_path, scheduled, started, first_sample, profile, lesson, event_type)
+    except OSError as e:
+        sys.stderr.write(f"Ошибка записи журнала звонков: {e}\n")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
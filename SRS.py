@@ -1,13 +1,39 @@
 import os
 import telebot
-from telebot import types
+from telebot import types, apihelper
+import requests
+import tempfile
 import time
 from dotenv import load_dotenv
 import json
 import logging
 import re
-from datetime import datetime 
+from datetime import datetime, timedelta, date
 import sys
+import subprocess
+import threading
+import shutil
+import mmap
+import bisect
+import csv
+import io
+import sqlite3
+import hashlib
+import cProfile
+import pstats
+import random
+import stat
+import gzip
+import hmac
+import socket
+import select
+import struct
+import fcntl
+import termios
+import ctypes
+import ctypes.util
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 
 env_path = Path('.') / '.env'
@@ -18,39 +44,289 @@ bot = telebot.TeleBot(TOKEN)
 
 # Константы
 AUDIO_DIR = "audio_files"
-SCHEDULE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schedule.txt")
+SCHEDULE_FILE = os.path.abspath(
+    os.getenv("SCHEDULE_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "schedule.txt")
+)
 CRON_FILE = "audio_schedule.cron"
 SETTINGS_FILE = "settings.json"
 CRON_BACKUP_FILE = "cron_backup.txt"
 CRON_BACKUPS_DIR = "cron_backups"  # Добавьте эту строку
 AUDIO_BACKUPS_DIR = "audio_backups"  # И эту строку
+PCM_CACHE_DIR = "audio_cache"  # Заранее декодированные WAV рядом с AUDIO_DIR
+AUDIO_META_FILE = os.path.join(AUDIO_DIR, "audio_meta.json")
+AUDIO_STORE_SUBDIR = "store"  # Уникальные звуки: AUDIO_DIR/store/<sha256>.<ext>
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.m4a']
+# Хранилище: "text" (schedule.txt + settings.json) или "sqlite"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "text").lower()
+STORAGE_DB = os.getenv("STORAGE_DB") or os.path.join(os.path.dirname(SCHEDULE_FILE), "srs.db")
+# Режим бота: "sync" (обработчики по одному) или "threaded" (чаты параллельно в пуле потоков)
+BOT_MODE = os.getenv("BOT_MODE", "sync").lower()
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "8"))
+# Метрики Prometheus: METRICS_PORT=9108 в .env включает http://127.0.0.1:9108/metrics
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+# Профилирование обработчиков: медленный вызов, доля вызовов под cProfile
+PERF_SLOW_MS = float(os.getenv("PERF_SLOW_MS", "500"))
+PERF_PROFILE_RATE = float(os.getenv("PERF_PROFILE_RATE", "0.05"))
+PERF_WINDOW = 1000  # Сколько последних вызовов обработчика держим для /perf
+PERF_PROFILE_FILE = "perf_profile.txt"
+# Очередь исходящих сообщений (OUTBOX=0 в .env - отправлять сразу из обработчика)
+OUTBOX_ENABLED = os.getenv("OUTBOX", "1") != "0"
+# Слежение за правками файлов вне бота: "1" (inotify или опрос), "poll", "0" - выключено
+FILE_WATCH = os.getenv("FILE_WATCH", "1").lower()
+# Сеть звонковых узлов: FLEET_ROLE=controller раздаёт расписание и звуки,
+# FLEET_ROLE=agent забирает их с FLEET_CONTROLLER (без своего бота Telegram)
+FLEET_ROLE = os.getenv("FLEET_ROLE", "").lower()
+FLEET_HOST = os.getenv("FLEET_HOST", "0.0.0.0")
+FLEET_PORT = int(os.getenv("FLEET_PORT") or 9110)
+FLEET_TOKEN = os.getenv("FLEET_TOKEN", "")
+FLEET_CONTROLLER = os.getenv("FLEET_CONTROLLER", "").rstrip("/")
+FLEET_NODE = os.getenv("FLEET_NODE") or socket.gethostname()
+FLEET_COMMAND_PORT = int(os.getenv("FLEET_COMMAND_PORT") or FLEET_PORT + 1)  # Постоянные соединения для /ring_now
+# Постоянный плеер: один aplay держит звуковое устройство открытым (PLAYER_SUPERVISOR=0 - выключить)
+PLAYER_SUPERVISOR_ENABLED = os.getenv("PLAYER_SUPERVISOR", "1") != "0"
+MPG123_PATH = "/usr/bin/mpg123"
+APLAY_PATH = "/usr/bin/aplay"
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+# Канонический формат кэша PCM
+PCM_RATE = 44100
+PCM_CHANNELS = 2
+
+# Режимы звонков (ключ ring_mode в settings.json)
+RING_MODE_CRON = "cron"      # Каждый звонок - строка crontab (запасной режим)
+RING_MODE_ENGINE = "engine"  # Встроенный движок звонков внутри сервиса
+# Профили и календарь звонков
+DEFAULT_PROFILE = "default"  # Профиль обычного учебного дня
+HOLIDAY = "holiday"          # В этот день звонков нет
+DEFAULT_WEEKDAYS = {1: DEFAULT_PROFILE, 2: DEFAULT_PROFILE, 3: DEFAULT_PROFILE,
+                    4: DEFAULT_PROFILE, 5: DEFAULT_PROFILE, 6: HOLIDAY, 7: HOLIDAY}
+CALENDAR_HORIZON_DAYS = 300  # На сколько дней вперёд в cron попадают особые даты
+CALENDAR_SKIP_FILE = "calendar_skip.txt"  # Даты, когда недельные строки cron молчат
+RING_LATE_LIMIT = 60         # Пропущенный более чем на N секунд звонок не играем
+# Журнал точности звонков: строка на каждый звонок, пишется только в конец
+RING_LOG_FILE = os.path.join(AUDIO_DIR, "ring_log.tsv")
+RING_LOG_MAX_SIZE = 1024 * 1024  # Больше - старый журнал уходит в .1
+# Обёртка для строк cron: засекает запуск плеера и первый сэмпл
+RING_HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SRS-ring.py")
 
 os.makedirs(AUDIO_DIR, exist_ok=True)
 os.makedirs(CRON_BACKUPS_DIR, exist_ok=True)
 os.makedirs(AUDIO_BACKUPS_DIR, exist_ok=True)
+os.makedirs(PCM_CACHE_DIR, exist_ok=True)
 
 
 MAX_ATTEMPTS = 3
 SESSION_TIMEOUT = 30 * 60  # 30 минут в секундах
+ATTEMPTS_TIMEOUT = 15 * 60  # Столько держится блокировка после MAX_ATTEMPTS ошибок
+DIALOG_TIMEOUT = 30 * 60    # Брошенный диалог (добавление, удаление) забывается
+SESSION_MAX_ENTRIES = 1000  # Больше записей - вытесняются давно не тронутые
+SESSIONS_FILE = "sessions.json"  # Снимок входов и попыток, переживает перезапуск
+SESSIONS_FLUSH_INTERVAL = 5      # Изменённые сессии пишутся на диск не чаще раза в столько секунд
+
+#--------------------Состояние сессий---------------------------------->
+class SessionStore:
+    """Словарь состояний по chat_id с TTL и ограничением размера (LRU).
+
+    Записи лежат в OrderedDict в порядке последнего обновления, а TTL у
+    всех одинаковый, поэтому просроченные всегда в начале. Каждая операция
+    снимает их с головы; запись удаляется один раз - O(1) амортизированно.
+    sliding=True продлевает запись при чтении, persist=True сохраняет
+    хранилище в SESSIONS_FILE: изменения копятся и пишутся одним снимком
+    через SESSIONS_FLUSH_INTERVAL секунд, так что поток сообщений (и
+    неудачных паролей) не превращается в поток записей на диск.
+    """
+
+    def __init__(self, name, ttl, max_size=SESSION_MAX_ENTRIES, sliding=False,
+                 persist=False, on_evict=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sliding = sliding
+        self.persist = persist
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # {ключ: [истекает, значение]}
+        self._lock = threading.RLock()
+        SESSION_STORES[name] = self
+
+    def _sweep(self, now):
+        evicted = []
+        while self._data:
+            key, (expires_at, value) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+            evicted.append(value)
+        return evicted
+
+    def _evicted(self, values):
+        if self.on_evict:
+            for value in values:
+                try:
+                    self.on_evict(value)
+                except Exception as e:
+                    logging.error(f"Ошибка очистки сессии {self.name}: {str(e)}")
+
+    def _lookup(self, key):
+        """(найдено, значение) с чисткой просроченных"""
+        now = time.time()
+        with self._lock:
+            evicted = self._sweep(now)
+            entry = self._data.get(key)
+            if entry is not None and self.sliding:
+                entry[0] = now + self.ttl
+                self._data.move_to_end(key)
+        self._evicted(evicted)
+        return (True, entry[1]) if entry is not None else (False, None)
+
+    def __contains__(self, key):
+        return self._lookup(key)[0]
+
+    def __getitem__(self, key):
+        found, value = self._lookup(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        with self._lock:
+            evicted = self._sweep(now)
+            self._data[key] = [now + self.ttl, value]
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                evicted.append(self._data.popitem(last=False)[1][1])
+        self._evicted(evicted)
+        self._changed()
+
+    def pop(self, key, *default):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._changed()
+        return entry[1]
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __len__(self):
+        with self._lock:
+            evicted = self._sweep(time.time())
+            size = len(self._data)
+        self._evicted(evicted)
+        return size
+
+    def items(self):
+        with self._lock:
+            evicted = self._sweep(time.time())
+            items = [(key, entry[1]) for key, entry in self._data.items()]
+        self._evicted(evicted)
+        return items
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def _changed(self):
+        if self.persist:
+            schedule_sessions_flush()
+
+    def dump(self):
+        with self._lock:
+            return [[key, expires_at, value] for key, (expires_at, value) in self._data.items()]
+
+    def restore(self, entries):
+        now = time.time()
+        with self._lock:
+            for key, expires_at, value in sorted(entries, key=lambda entry: entry[1]):
+                if expires_at > now:
+                    self._data[key] = [expires_at, value]
+            # Снимок мог писаться с другим лимитом - оставляем самые свежие
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+SESSION_STORES = {}
+_sessions_file_lock = threading.Lock()
+
+def save_sessions():
+    """Атомарно пишет снимок хранилищ с persist=True"""
+    snapshot = {name: store.dump() for name, store in SESSION_STORES.items() if store.persist}
+    try:
+        with _sessions_file_lock:
+            temp_path = SESSIONS_FILE + '.tmp'
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, SESSIONS_FILE)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения сессий: {str(e)}")
+
+_sessions_flush_timer = None
+_sessions_timer_lock = threading.Lock()
+
+def schedule_sessions_flush():
+    """Помечает сессии изменёнными: снимок уйдёт на диск через SESSIONS_FLUSH_INTERVAL"""
+    global _sessions_flush_timer
+    with _sessions_timer_lock:
+        if _sessions_flush_timer is not None:
+            return
+        _sessions_flush_timer = threading.Timer(SESSIONS_FLUSH_INTERVAL, flush_sessions)
+        _sessions_flush_timer.daemon = True
+        _sessions_flush_timer.start()
+
+def flush_sessions():
+    """Пишет отложенные изменения сессий сразу (по таймеру и при остановке)"""
+    global _sessions_flush_timer
+    with _sessions_timer_lock:
+        timer, _sessions_flush_timer = _sessions_flush_timer, None
+    if timer is None:
+        return
+    timer.cancel()
+    save_sessions()
+
+def load_sessions():
+    """Восстанавливает входы и попытки после перезапуска"""
+    try:
+        with open(SESSIONS_FILE) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logging.error(f"Ошибка чтения {SESSIONS_FILE}: {str(e)}")
+        return
+    for name, entries in snapshot.items():
+        store = SESSION_STORES.get(name)
+        if store is not None:
+            # Ключи JSON - строки, chat_id - числа
+            store.restore([[int(key), expires_at, value] for key, expires_at, value in entries])
 
 # Глобальные переменные для хранения состояния аутентификации
-authenticated_users = {}  # {chat_id: (timestamp, level)}
+authenticated_users = SessionStore("auth", SESSION_TIMEOUT, persist=True)  # {chat_id: (timestamp, level)}
+login_attempts = SessionStore("attempts", ATTEMPTS_TIMEOUT, persist=True)  # {chat_id: неудачных попыток}
+load_sessions()
 
 
 print(f"TOKEN loaded: {'✅' if TOKEN else '❌'}")
 print(f"BOT_PASSWORD loaded: {'✅' if os.getenv('BOT_PASSWORD') else '❌'}")
 
-if not TOKEN:
+if not TOKEN and FLEET_ROLE != "agent":
     logging.critical("TOKEN not loaded! Check .env file")
     sys.exit(1)
 
 # --- Класс для событий ---
 class LessonEvent:
-    def __init__(self, lesson_num, event_type, time, audio_file):
+    def __init__(self, lesson_num, event_type, time, audio_file, profile=DEFAULT_PROFILE):
         self.lesson_num = lesson_num
         self.event_type = event_type
         self.time = time
         self.audio_file = audio_file
+        self.profile = profile
 
 # --- Логирование ---
 logging.basicConfig(
@@ -59,6 +335,546 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     filemode='a'
 )
+#--------------------Метрики------------------------------------------>
+# Свой маленький реестр вместо prometheus_client: бот не тянет лишних
+# зависимостей, а формат text/plain 0.0.4 простой
+METRICS = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SPEED_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+LATENESS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        names = self.labels + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_label_text(names, key + (f'{bound:g}',))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_label_text(names, key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+HANDLER_LATENCY = Histogram(
+    "srs_handler_duration_seconds", "Время обработки сообщения", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "srs_handler_errors_total", "Необработанные исключения в обработчиках", ("handler",)
+)
+TELEGRAM_LATENCY = Histogram(
+    "srs_telegram_api_duration_seconds", "Время запроса к Telegram Bot API", ("method",)
+)
+TELEGRAM_ERRORS = Counter(
+    "srs_telegram_api_errors_total", "Неудачные запросы к Telegram Bot API", ("method",)
+)
+DOWNLOAD_BYTES = Counter("srs_audio_download_bytes_total", "Скачано байт аудио")
+DOWNLOAD_SPEED = Histogram(
+    "srs_audio_download_bytes_per_second", "Скорость скачивания аудио", buckets=SPEED_BUCKETS
+)
+CRON_INSTALL_LATENCY = Histogram("srs_cron_install_duration_seconds", "Время install_cron_jobs")
+CRON_INSTALL_TOTAL = Counter("srs_cron_install_total", "Вызовы install_cron_jobs по исходу", ("outcome",))
+SCHEDULE_EVENTS = Gauge("srs_schedule_events", "Событий в расписании", ("profile",))
+RING_LATENESS = Histogram(
+    "srs_ring_lateness_seconds", "Опоздание первого сэмпла звонка", ("source",), buckets=LATENESS_BUCKETS
+)
+RING_NO_SAMPLE = Counter(
+    "srs_rings_without_first_sample_total", "Звонки без отметки первого сэмпла", ("source",)
+)
+
+def timed_telegram_request(method, url, **kwargs):
+    """apihelper.CUSTOM_REQUEST_SENDER: обычный запрос плюс замер времени"""
+    api_method = url.rsplit('/', 1)[-1]
+    started = time.monotonic()
+    try:
+        return apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception:
+        TELEGRAM_ERRORS.inc(method=api_method)
+        raise
+    finally:
+        TELEGRAM_LATENCY.observe(time.monotonic() - started, method=api_method)
+
+def track_cron_install(install):
+    """Замеряет install_cron_jobs: длительность и исход"""
+    def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            success, message = install(*args, **kwargs)
+        except Exception:
+            CRON_INSTALL_TOTAL.inc(outcome="error")
+            raise
+        if getattr(_cron_batch, 'depth', 0):
+            CRON_INSTALL_TOTAL.inc(outcome="deferred")
+        else:
+            CRON_INSTALL_TOTAL.inc(outcome="success" if success else "failure")
+            CRON_INSTALL_LATENCY.observe(time.monotonic() - started)
+        return success, message
+    wrapper.__name__ = install.__name__
+    wrapper.__doc__ = install.__doc__
+    return wrapper
+
+def instrument_handlers():
+    """Оборачивает замером времени все обработчики сообщений и шагов диалога"""
+    for handler in bot.message_handlers:
+        commands = handler['filters'].get('commands')
+        name = commands[0] if commands else handler['function'].__name__
+        handler['function'] = timed_handler(handler['function'], name)
+
+    for handler in bot.callback_query_handlers:
+        handler['function'] = timed_handler(handler['function'], handler['function'].__name__)
+
+    # Шаги диалога регистрируются на лету - оборачиваем при регистрации
+    register = bot.register_next_step_handler
+
+    def register_timed(message, callback, *args, **kwargs):
+        return register(message, timed_handler(callback, callback.__name__), *args, **kwargs)
+    bot.register_next_step_handler = register_timed
+
+# Последние PERF_WINDOW длительностей каждого обработчика: {имя: deque(секунды)}
+handler_timings = {}
+_handler_timings_lock = threading.Lock()
+# Обработчики, чей прошлый медленный вызов прошёл без профиля - следующий профилируем
+_profile_next = set()
+# Последний медленный вызов под cProfile
+slow_profile = {'name': None, 'seconds': 0.0, 'at': None, 'stats': None}
+_perf_state = threading.local()  # Вложенные вызовы не профилируем
+
+def record_handler_timing(name, seconds, profiler=None):
+    with _handler_timings_lock:
+        timings = handler_timings.get(name)
+        if timings is None:
+            timings = handler_timings[name] = deque(maxlen=PERF_WINDOW)
+        timings.append(seconds)
+        if seconds * 1000 < PERF_SLOW_MS:
+            return
+        if profiler is None:
+            _profile_next.add(name)
+            return
+        _profile_next.discard(name)
+    slow_profile.update(
+        name=name, seconds=seconds, at=datetime.now(), stats=pstats.Stats(profiler)
+    )
+    logging.warning(f"Медленный обработчик {name}: {seconds * 1000:.0f} мс")
+
+def timed_handler(function, name):
+    def wrapper(message, *args, **kwargs):
+        profiler = None
+        owner = False  # Этот вызов включил профилирование в своём потоке
+        started = time.monotonic()
+        try:
+            if not getattr(_perf_state, 'active', False) and (
+                    name in _profile_next or random.random() < PERF_PROFILE_RATE):
+                _perf_state.active = owner = True
+                try:
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                except ValueError:
+                    # Python 3.12+: второй cProfile в другом потоке пула не запускается
+                    profiler = None
+                started = time.monotonic()
+            return function(message, *args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            if profiler is not None:
+                profiler.disable()
+            if owner:
+                _perf_state.active = False
+            HANDLER_LATENCY.observe(elapsed, handler=name)
+            record_handler_timing(name, elapsed, profiler)
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+def dump_slow_profile(path=PERF_PROFILE_FILE):
+    """Пишет последний медленный профиль: текстовый отчёт и .prof для snakeviz/pstats"""
+    stats = slow_profile['stats']
+    if stats is None:
+        return None
+    raw_path = os.path.splitext(path)[0] + '.prof'
+    stats.dump_stats(raw_path)
+    report = io.StringIO()
+    report.write(
+        f"{slow_profile['name']}: {slow_profile['seconds'] * 1000:.0f} мс, "
+        f"{slow_profile['at']:%Y-%m-%d %H:%M:%S}\n\n"
+    )
+    pstats.Stats(raw_path, stream=report).sort_stats('cumulative').print_stats(40)
+    with open(path, 'w') as f:
+        f.write(report.getvalue())
+    return os.path.abspath(path)
+
+# Журнал звонков пишут и бот, и SRS-ring.py из cron - опоздания берём из него,
+# дочитывая новые строки при каждом опросе
+_ring_log_offset = {'inode': None, 'offset': 0}
+
+def _collect_ring_lateness():
+    try:
+        st = os.stat(RING_LOG_FILE)
+    except FileNotFoundError:
+        return
+    if _ring_log_offset['inode'] != st.st_ino or st.st_size < _ring_log_offset['offset']:
+        _ring_log_offset['inode'] = st.st_ino
+        _ring_log_offset['offset'] = 0
+    with open(RING_LOG_FILE, 'rb') as f:
+        f.seek(_ring_log_offset['offset'])
+        data = f.read()
+    # Незаконченную последнюю строку дочитаем в следующий раз
+    complete = data[:data.rfind(b'\n') + 1]
+    _ring_log_offset['offset'] += len(complete)
+    for line in complete.decode(errors='replace').splitlines():
+        parts = line.split('\t')
+        if len(parts) != 7:
+            continue
+        if parts[2] == "-":
+            RING_NO_SAMPLE.inc(source=parts[6])
+        else:
+            RING_LATENESS.observe(int(parts[2]) / 1000, source=parts[6])
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    try:
+        _collect_ring_lateness()
+    except Exception as e:
+        logging.error(f"Ошибка чтения журнала звонков для метрик: {str(e)}")
+    try:
+        counts = {}
+        for event in load_events():
+            counts[event.profile] = counts.get(event.profile, 0) + 1
+        for profile in counts.keys() | {DEFAULT_PROFILE}:
+            SCHEDULE_EVENTS.set(counts.get(profile, 0), profile=profile)
+    except Exception as e:
+        logging.error(f"Ошибка подсчёта расписания для метрик: {str(e)}")
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def start_metrics_server():
+    """HTTP /metrics на METRICS_HOST:METRICS_PORT в фоновом потоке"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+#--------------------Очередь исходящих сообщений---------------------->
+TELEGRAM_MESSAGE_LIMIT = 4096
+OUTBOX_GLOBAL_RATE = 25    # Сообщений в секунду на бота (лимит Telegram ~30)
+OUTBOX_CHAT_RATE = 1.0     # Сообщений в секунду в один чат
+OUTBOX_CHAT_BURST = 3      # Столько можно отправить в чат подряд без паузы
+OUTBOX_MAX_RETRIES = 5     # Попыток при сетевых ошибках
+
+OUTBOX_QUEUED = Gauge("srs_outbox_queued", "Сообщений в очереди на отправку")
+OUTBOX_SENT = Counter("srs_outbox_sent_total", "Отправлено запросов из очереди", ("kind",))
+OUTBOX_MERGED = Counter("srs_outbox_merged_total", "Сообщений, склеенных с предыдущими")
+OUTBOX_RETRIES = Counter("srs_outbox_retries_total", "Повторные отправки", ("reason",))
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Сколько ждать до свободного токена (0 - можно сейчас)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class QueuedMessage:
+    """Возвращается вместо отправленного сообщения: register_next_step_handler
+    нужен только chat.id"""
+
+    def __init__(self, chat_id, text=None):
+        self.chat = types.Chat(chat_id, 'private')
+        self.text = text
+        self.message_id = None
+
+class Outbox:
+    """Очередь исходящих сообщений с отдельным потоком отправки.
+
+    Обработчик только кладёт сообщение в очередь чата и сразу возвращается.
+    Поток отправки обходит чаты по кругу с учётом общего и початового
+    token bucket, подряд идущие тексты одному чату склеивает в одно сообщение,
+    на 429 ждёт retry_after, на сетевые ошибки повторяет с растущей паузой.
+    Вёдра чатов лежат в порядке последней отправки; вытесняются только
+    простаивающие (полные и без очереди).
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._send_message = bot.send_message
+        self._send_document = bot.send_document
+        self._chats = OrderedDict()  # {chat_id: deque([вид, данные, kwargs, попытка])}, порядок - очередь обхода
+        self._chat_buckets = OrderedDict()  # {chat_id: TokenBucket}, давно молчавшие в начале
+        self._blocked_until = {}  # {chat_id: monotonic}, пауза после 429 или ошибки
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._global_blocked_until = 0  # monotonic, пауза всей отправки после 429 по общему лимиту
+        self._cond = threading.Condition()
+        self._queued = 0
+        self._sending = 0
+        self._thread = None
+
+    def install(self):
+        """Подменяет bot.send_message/send_document и запускает поток отправки"""
+        self.bot.send_message = self.send_message
+        self.bot.send_document = self.send_document
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._put(chat_id, ['message', text, kwargs, 0])
+        return QueuedMessage(chat_id, text)
+
+    def send_document(self, chat_id, document, **kwargs):
+        # Файл обработчика закроется раньше отправки - читаем его сейчас
+        if hasattr(document, 'read'):
+            document = document.read()
+        self._put(chat_id, ['document', document, kwargs, 0])
+        return QueuedMessage(chat_id)
+
+    def _put(self, chat_id, item, front=False):
+        with self._cond:
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+            if front:
+                queue.appendleft(item)
+            else:
+                queue.append(item)
+            self._queued += 1
+            OUTBOX_QUEUED.set(self._queued)
+            self._cond.notify()
+
+    def drain(self, timeout=5.0):
+        """Ждёт, пока очередь опустеет (при остановке бота)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queued or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @staticmethod
+    def _merge(first, second):
+        """Склеенное сообщение или None, если склеивать нельзя"""
+        if first[0] != 'message' or second[0] != 'message':
+            return None
+        if set(first[2]) - {'reply_markup'} or set(second[2]) - {'reply_markup'}:
+            return None
+        first_markup = first[2].get('reply_markup')
+        second_markup = second[2].get('reply_markup')
+        # Инлайн-кнопки относятся к тексту своего сообщения
+        if isinstance(second_markup, types.InlineKeyboardMarkup):
+            return None
+        # Клавиатура второго сообщения заменяет "убрать клавиатуру" первого
+        if first_markup is not None and not (
+                isinstance(first_markup, types.ReplyKeyboardRemove)
+                and isinstance(second_markup, (types.ReplyKeyboardMarkup, types.ReplyKeyboardRemove))):
+            return None
+        text = f"{first[1]}\n\n{second[1]}"
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            return None
+        kwargs = {'reply_markup': second_markup} if second_markup is not None else {}
+        return ['message', text, kwargs, 0]
+
+    def _next_item(self, now):
+        """(chat_id, сообщение) для отправки или (None, сколько ждать)"""
+        wait = None
+        for chat_id in self._chats:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+            chat_wait = max(self._blocked_until.get(chat_id, 0) - now, bucket.wait_time(now))
+            if chat_wait <= 0:
+                break
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        else:
+            return None, wait
+
+        global_wait = max(self._global_blocked_until - now, self._global.wait_time(now))
+        if global_wait > 0:
+            return None, global_wait
+
+        # Чат уходит в конец круга, если у него ещё что-то осталось
+        queue = self._chats.pop(chat_id)
+        item = queue.popleft()
+        taken = 1
+        while queue:
+            merged = self._merge(item, queue[0])
+            if merged is None:
+                break
+            queue.popleft()
+            item = merged
+            taken += 1
+        if queue:
+            self._chats[chat_id] = queue
+        self._queued -= taken
+        OUTBOX_QUEUED.set(self._queued)
+        if taken > 1:
+            OUTBOX_MERGED.inc(taken - 1)
+        bucket.take()
+        self._chat_buckets.move_to_end(chat_id)
+        self._global.take()
+        self._blocked_until.pop(chat_id, None)
+        # Вёдра простаивающих чатов не копим: полное ведро без очереди
+        # ничем не отличается от нового, а недавно писавшим лимит не сбрасываем
+        while len(self._chat_buckets) > SESSION_MAX_ENTRIES:
+            idle_id, idle = next(iter(self._chat_buckets.items()))
+            idle.wait_time(now)  # Досчитывает накопленные токены
+            if idle_id in self._chats or idle.tokens < idle.capacity:
+                break
+            self._chat_buckets.popitem(last=False)
+            self._blocked_until.pop(idle_id, None)
+        return chat_id, item
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    chat_id, item = self._next_item(time.monotonic())
+                    if chat_id is not None:
+                        self._sending += 1
+                        break
+                    self._cond.wait(item)
+            try:
+                self._deliver(chat_id, item)
+            finally:
+                with self._cond:
+                    self._sending -= 1
+                    self._cond.notify_all()
+
+    def _deliver(self, chat_id, item):
+        kind, data, kwargs, attempt = item
+        try:
+            if kind == 'document':
+                self._send_document(chat_id, data, **kwargs)
+            else:
+                self._send_message(chat_id, data, **kwargs)
+            OUTBOX_SENT.inc(kind=kind)
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 429:
+                logging.error(f"Сообщение в чат {chat_id} не отправлено: {e.description}")
+                return
+            retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+            OUTBOX_RETRIES.inc(reason="429")
+            with self._cond:
+                # Ведро чата держит его ниже лимита Telegram на чат; если при этом
+                # общее ведро потрачено больше чем наполовину, упёрлись в лимит бота
+                self._global.wait_time(time.monotonic())
+                hold_global = self._global.tokens < self._global.capacity / 2
+            logging.warning(
+                f"Telegram 429 для чата {chat_id}, пауза {retry_after} с"
+                + (" для всех чатов" if hold_global else "")
+            )
+            self._retry(chat_id, item, retry_after, hold_global)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt + 1 >= OUTBOX_MAX_RETRIES:
+                logging.error(f"Сообщение в чат {chat_id} не отправлено после {attempt + 1} попыток: {str(e)}")
+                return
+            OUTBOX_RETRIES.inc(reason="network")
+            self._retry(chat_id, [kind, data, kwargs, attempt + 1], min(2 ** attempt, 60))
+        except Exception as e:
+            logging.error(f"Ошибка отправки в чат {chat_id}: {str(e)}")
+
+    def _retry(self, chat_id, item, delay, hold_global=False):
+        with self._cond:
+            self._blocked_until[chat_id] = time.monotonic() + delay
+            if hold_global:
+                self._global_blocked_until = max(self._global_blocked_until, time.monotonic() + delay)
+        self._put(chat_id, item, front=True)
+
+outbox = Outbox(bot)
+
 #--------------------Аутентификация----------------------------------->
 # Добавляем новые функции для работы с паролем
 
@@ -90,15 +906,8 @@ def change_password(new_password):
 
 def is_authenticated(chat_id):
     """Проверяет, аутентифицирован ли пользователь"""
-    if chat_id not in authenticated_users:
-        return False
-    
-    login_time, _ = authenticated_users[chat_id]
-    if time.time() - login_time > SESSION_TIMEOUT:
-        del authenticated_users[chat_id]
-        return False
-    
-    return True
+    # Просроченные входы хранилище убирает само
+    return chat_id in authenticated_users
 def auth_required(func):
     """Декоратор для проверки аутентификации"""
     def wrapper(message):
@@ -146,14 +955,76 @@ def calculate_end_time(start_time, duration):
     return f"{end_h:02d}:{end_m:02d}"
 #---------------------------------------------------->
 
-def validate_lesson_times(new_lesson_num, new_start, new_end, existing_events):
+def time_to_minutes(time_str):
+    """Переводит ЧЧ:ММ в минуты от полуночи"""
+    h, m = map(int, time_str.split(':'))
+    return h * 60 + m
+
+def minutes_to_time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+class LessonIntervalIndex:
+    """Индекс интервалов уроков [начало, конец) для быстрых проверок.
+
+    Строится один раз на версию расписания: интервалы отсортированы по началу,
+    рядом хранится префиксный максимум концов. Пересечения ищутся бинарным
+    поиском, время конца последнего урока известно сразу.
+    """
+
+    def __init__(self, events):
+        bounds = {}
+        ends = []
+        for event in events:
+            minutes = time_to_minutes(event.time)
+            bounds.setdefault(event.lesson_num, {})[event.event_type] = minutes
+            if event.event_type == 'end':
+                ends.append(minutes)
+
+        self.lesson_nums = {int(num) for num in bounds}
+        self.last_end = max(ends) if ends else None
+        self.intervals = sorted(
+            (b['start'], b['end'], num)
+            for num, b in bounds.items()
+            if 'start' in b and 'end' in b
+        )
+        self.starts = [start for start, _, _ in self.intervals]
+        self.max_ends = []
+        running = -1
+        for _, end, _ in self.intervals:
+            running = max(running, end)
+            self.max_ends.append(running)
+
+    def overlaps(self, start, end, exclude=None):
+        """Все уроки, пересекающие [start, end), кроме урока exclude"""
+        conflicts = []
+        i = bisect.bisect_left(self.starts, end) - 1
+        while i >= 0 and self.max_ends[i] > start:
+            other_start, other_end, num = self.intervals[i]
+            if other_end > start and num != exclude:
+                conflicts.append((num, other_start, other_end))
+            i -= 1
+        conflicts.reverse()
+        return conflicts
+
+_schedule_index = {'version': None, 'indexes': {}}
+
+def profile_events(events, profile=DEFAULT_PROFILE):
+    """События одного профиля дня"""
+    return [e for e in events if e.profile == profile]
+
+def get_schedule_index(profile=DEFAULT_PROFILE):
+    """Индекс интервалов профиля для текущей версии расписания"""
+    version = get_schedule_version()
+    if _schedule_index['version'] != version:
+        _schedule_index['indexes'] = {}
+        _schedule_index['version'] = version
+    if profile not in _schedule_index['indexes']:
+        _schedule_index['indexes'][profile] = LessonIntervalIndex(profile_events(load_events(), profile))
+    return _schedule_index['indexes'][profile]
+
+def validate_lesson_times(new_lesson_num, new_start, new_end, existing_events, index=None):
     """Проверяет корректность времени урока с учетом последовательности"""
     try:
-        # Преобразуем время в минуты для удобства сравнения
-        def time_to_minutes(time_str):
-            h, m = map(int, time_str.split(':'))
-            return h * 60 + m
-
         new_start_min = time_to_minutes(new_start)
         new_end_min = time_to_minutes(new_end)
 
@@ -161,80 +1032,115 @@ def validate_lesson_times(new_lesson_num, new_start, new_end, existing_events):
         if new_start_min >= new_end_min:
             return False, "⛔ Начало урока должно быть раньше конца"
 
+        if index is None:
+            index = LessonIntervalIndex(existing_events)
+
         # 2. Проверка последовательности уроков
-        existing_nums = {int(e.lesson_num) for e in existing_events}
+        existing_nums = index.lesson_nums
         current_num = int(new_lesson_num)
 
         # Если это новый урок (не существующий номер)
-        if current_num not in existing_nums:
-            if existing_events:
-                # Находим максимальный номер урока
-                max_lesson_num = max(existing_nums)
-                
-                # Если номер нового урока не следующий по порядку
-                if current_num != max_lesson_num + 1:
-                    return False, f"⛔ Следующий урок должен иметь номер {max_lesson_num + 1}"
-
-                # Находим время конца последнего урока
-                last_lesson_ends = [
-                    time_to_minutes(e.time) 
-                    for e in existing_events 
-                    if e.event_type == 'end'
-                ]
-                if last_lesson_ends:
-                    last_lesson_end = max(last_lesson_ends)
-                    if new_start_min < last_lesson_end:
-                        last_end_str = f"{last_lesson_end//60:02d}:{last_lesson_end%60:02d}"
-                        return False, (
-                            f"⛔ Урок {new_lesson_num} должен начинаться ПОСЛЕ "
-                            f"конца предыдущего урока ({last_end_str})"
-                        )
+        if current_num not in existing_nums and existing_nums:
+            # Находим максимальный номер урока
+            max_lesson_num = max(existing_nums)
 
-        # 3. Проверка пересечений с другими уроками
-        for event in existing_events:
-            if event.lesson_num == new_lesson_num:
-                continue
+            # Если номер нового урока не следующий по порядку
+            if current_num != max_lesson_num + 1:
+                return False, f"⛔ Следующий урок должен иметь номер {max_lesson_num + 1}"
 
-            if event.event_type == 'start':
-                other_start = time_to_minutes(event.time)
-                other_end = next(
-                    (time_to_minutes(e.time) 
-                     for e in existing_events 
-                     if e.lesson_num == event.lesson_num and e.event_type == 'end'),
-                    None
+            # Время конца последнего урока
+            if index.last_end is not None and new_start_min < index.last_end:
+                return False, (
+                    f"⛔ Урок {new_lesson_num} должен начинаться ПОСЛЕ "
+                    f"конца предыдущего урока ({minutes_to_time(index.last_end)})"
                 )
 
-                if other_end:
-                    # Проверяем пересечение временных интервалов
-                    if (new_start_min < other_end) and (new_end_min > other_start):
-                        other_start_str = event.time
-                        other_end_str = f"{other_end//60:02d}:{other_end%60:02d}"
-                        return False, (
-                            f"⛔ Пересечение с уроком {event.lesson_num} "
-                            f"({other_start_str}-{other_end_str})"
-                        )
+        # 3. Проверка пересечений с другими уроками
+        conflicts = index.overlaps(new_start_min, new_end_min, exclude=new_lesson_num)
+        if len(conflicts) == 1:
+            num, other_start, other_end = conflicts[0]
+            return False, (
+                f"⛔ Пересечение с уроком {num} "
+                f"({minutes_to_time(other_start)}-{minutes_to_time(other_end)})"
+            )
+        if conflicts:
+            return False, "⛔ Пересечение с уроками:\n" + "\n".join(
+                f"  {num} ({minutes_to_time(other_start)}-{minutes_to_time(other_end)})"
+                for num, other_start, other_end in conflicts
+            )
 
         return True, "✅ Время урока корректно"
 
     except ValueError as e:
         return False, f"⛔ Ошибка формата времени: {str(e)}"
 #---------------------------------------------------->
+# Кэш расписания: ключ - (mtime_ns, size, inode) файла, обновляется в save_events
+_schedule_cache = {'key': None, 'events': []}
+_schedule_cache_lock = threading.Lock()
+_schedule_version = 0  # Растёт при каждом изменении закэшированного расписания
+_schedule_saved_key = None  # Ключ SCHEDULE_FILE после последней записи ботом (или уже учтённой правки)
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _schedule_file_key():
+    return _stat_key(SCHEDULE_FILE)
+
+def _set_schedule_cache(key, events):
+    global _schedule_version
+    with _schedule_cache_lock:
+        _schedule_cache['key'] = key
+        _schedule_cache['events'] = events
+        _schedule_version += 1
+
+def invalidate_schedule_cache():
+    """Сбрасывает кэш расписания (следующий load_events перечитает файл)"""
+    _set_schedule_cache(None, [])
+
+def _cached_events():
+    """События из кэша (без копии), файл перечитывается только при его изменении"""
+    key = storage.cache_key() if storage is not None else _schedule_file_key()
+    with _schedule_cache_lock:
+        if key is not None and key == _schedule_cache['key']:
+            return _schedule_cache['events']
+
+    events = storage.load_events() if storage is not None else _parse_schedule_file()
+    if key is not None:
+        _set_schedule_cache(key, events)
+    return events
+
+def get_schedule_version():
+    """Номер версии расписания для кэшей, построенных поверх него"""
+    _cached_events()  # Только сверка ключа, список не копируется
+    return _schedule_version
+
 def load_events():
+    """Возвращает события расписания, перечитывая файл только при его изменении"""
+    return list(_cached_events())
+
+def _parse_schedule_file(path=None):
+    path = path or SCHEDULE_FILE
     events = []
-    if not os.path.exists(SCHEDULE_FILE):
-        logging.warning(f"Файл расписания не найден: {SCHEDULE_FILE}")
+    if not os.path.exists(path):
+        logging.warning(f"Файл расписания не найден: {path}")
         return events
         
     try:
-        with open(SCHEDULE_FILE, 'r') as f:
+        with open(path, 'r') as f:
             for line in f:
                 line = line.strip()
                 if not line:
                     continue
                 parts = line.split()
-                if len(parts) == 4:
-                    event_type, lesson_num, time, audio_file = parts
-                    events.append(LessonEvent(lesson_num, event_type, time, audio_file))
+                if len(parts) in (4, 5):
+                    event_type, lesson_num, time, audio_file = parts[:4]
+                    # Пятый столбец - профиль дня (для обычного дня не пишется)
+                    profile = parts[4] if len(parts) == 5 else DEFAULT_PROFILE
+                    events.append(LessonEvent(lesson_num, event_type, time, audio_file, profile))
                 else:
                     logging.warning(f"Некорректная строка в расписании: {line}")
     except Exception as e:
@@ -243,156 +1149,2582 @@ def load_events():
 
     """Сохраняет события в файл и автоматически устанавливает cron"""
 def save_events(events):
+    global _schedule_saved_key
     try:
         logging.info(f"Попытка сохранения {len(events)} событий")
-        logging.info(f"Путь к файлу: {os.path.abspath(SCHEDULE_FILE)}")
-        logging.info(f"Права на директорию: {oct(os.stat(os.path.dirname(SCHEDULE_FILE)).st_mode)}")
-        
-        # Полный абсолютный путь
-        schedule_path = os.path.abspath(SCHEDULE_FILE)
-        os.makedirs(os.path.dirname(schedule_path), exist_ok=True)
-        
-        # Временный файл для безопасной записи
-        temp_path = schedule_path + '.tmp'
         
         lesson_records = {}
         for event in events:
-            key = (event.lesson_num, event.event_type)
+            key = (event.profile, event.lesson_num, event.event_type)
             lesson_records[key] = event
 
-        with open(temp_path, 'w') as f:
-            for key in sorted(lesson_records.keys()):
-                event = lesson_records[key]
-                line = f"{event.event_type} {event.lesson_num} {event.time} {event.audio_file}\n"
-                f.write(line)
-        
-        # Атомарная замена файла
-        if os.path.exists(schedule_path):
-            os.remove(schedule_path)
-        os.rename(temp_path, schedule_path)
-        
+        # Обычный день первым, затем остальные профили
+        saved_events = [
+            lesson_records[key]
+            for key in sorted(lesson_records.keys(), key=lambda k: (k[0] != DEFAULT_PROFILE, k))
+        ]
+
+        if storage is not None:
+            storage.save_events(saved_events)
+            _set_schedule_cache(storage.cache_key(), saved_events)
+            notify_fleet()
+            return True
+
+        logging.info(f"Путь к файлу: {os.path.abspath(SCHEDULE_FILE)}")
+        logging.info(f"Права на директорию: {oct(os.stat(os.path.dirname(SCHEDULE_FILE)).st_mode)}")
+        _write_schedule_file(saved_events, SCHEDULE_FILE)
+
+        # Сквозная запись в кэш: перечитывать только что записанный файл не нужно
+        _schedule_saved_key = _schedule_file_key()
+        _set_schedule_cache(_schedule_saved_key, saved_events)
+        notify_fleet()
         return True
         
     except Exception as e:
         logging.error(f"Ошибка сохранения расписания: {str(e)}", exc_info=True)
         return False
 
+def _write_schedule_file(events, path):
+    """Записывает события в текстовом формате через временный файл"""
+    # Полный абсолютный путь
+    schedule_path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(schedule_path), exist_ok=True)
+    
+    # Временный файл для безопасной записи
+    temp_path = schedule_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        for event in events:
+            line = f"{event.event_type} {event.lesson_num} {event.time} {event.audio_file}"
+            if event.profile != DEFAULT_PROFILE:
+                line += f" {event.profile}"
+            f.write(line + "\n")
+    
+    # Атомарная замена файла
+    if os.path.exists(schedule_path):
+        os.remove(schedule_path)
+    os.rename(temp_path, schedule_path)
+
+def export_schedule_text(path):
+    """Выгружает расписание в текстовом формате schedule.txt"""
+    _write_schedule_file(load_events(), path)
+
+def import_schedule_text(path):
+    """Загружает расписание из текстового файла в текущее хранилище"""
+    events = _parse_schedule_file(path)
+    return save_events(events), len(events)
+
 # --- Работа с настройками ---
 def load_settings():
     """Загружает настройки из файла"""
     default_settings = {
         "lesson_duration": 45,
-        "cron_paused": False
+        "cron_paused": False,
+        "ring_mode": RING_MODE_CRON,
+        "max_audio_size_mb": 20,
+        "calendar": {}
     }
     try:
+        if storage is not None:
+            return {**default_settings, **storage.load_settings()}
         with open(SETTINGS_FILE, 'r') as f:
             return {**default_settings, **json.load(f)}
     except:
         return default_settings
 
+_settings_version = 0  # Растёт при каждом save_settings
+_settings_file_key = None  # Ключ SETTINGS_FILE после последней записи ботом
+
 def save_settings(settings):
     """Сохраняет настройки в файл"""
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f)
+    global _settings_version, _settings_file_key
+    _settings_version += 1
+    if storage is not None:
+        storage.save_settings(settings)
+    else:
+        with open(SETTINGS_FILE, 'w') as f:
+            json.dump(settings, f)
+        _settings_file_key = _stat_key(SETTINGS_FILE)
+    notify_fleet()
 
-# --- Работа с cron ---
-def generate_cron_jobs(events):
-    """Генерирует crontab с абсолютными путями"""
-    if not os.path.exists(AUDIO_DIR):
-        os.makedirs(AUDIO_DIR, exist_ok=True)
-    
-    abs_audio_dir = os.path.abspath(AUDIO_DIR)
-    cron_log = os.path.join(abs_audio_dir, 'cron.log')
-    
-    cron_content = "# Аудио расписание\n\n"
-    
-    for event in sorted(events, key=lambda x: x.time):
-        try:
-            audio_path = os.path.join(abs_audio_dir, event.audio_file)
-            if not os.path.exists(audio_path):
-                logging.warning(f"Audio file {audio_path} not found, skipping")
-                continue
-                
-            hour, minute = event.time.split(':')
-            cron_content += (
-                f"{minute} {hour} * * 1-5 "
-                f"/usr/bin/mpg123 '{audio_path}' "
-                f">>{cron_log} 2>&1\n"
-            )
-        except Exception as e:
-            logging.error(f"Error processing event {event.lesson_num}: {str(e)}")
-    
-    return cron_content
-#------------------------------>
-def install_cron_jobs():
-    """Устанавливает задания в crontab с полной диагностикой"""
+def invalidate_settings_cache():
+    """Настройки поменяли вне бота: кэши поверх них пересобираются"""
+    global _settings_version
+    _settings_version += 1
+
+# --- Календарь звонков ---
+class ScheduleCalendar:
+    """Какой профиль звонков действует в какой день.
+
+    В настройках (ключ calendar) хранится таблица дней недели
+    {"weekdays": {"5": "short", ...}} и таблица особых дат
+    {"dates": {"2026-12-31": "short", "2027-01-02": "holiday"}}.
+    Особая дата важнее дня недели.
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.weekdays = dict(DEFAULT_WEEKDAYS)
+        self.weekdays.update({int(k): v for k, v in data.get('weekdays', {}).items()})
+        self.dates = {date.fromisoformat(k): v for k, v in data.get('dates', {}).items()}
+
+    def to_dict(self):
+        return {
+            'weekdays': {
+                str(k): v for k, v in self.weekdays.items() if DEFAULT_WEEKDAYS.get(k) != v
+            },
+            'dates': {d.isoformat(): p for d, p in sorted(self.dates.items())}
+        }
+
+    def profile_for(self, day):
+        """Профиль дня или HOLIDAY"""
+        return self.dates.get(day, self.weekdays.get(day.isoweekday(), HOLIDAY))
+
+    def weekday_groups(self):
+        """{профиль: [дни недели]} без выходных"""
+        groups = {}
+        for weekday, profile in sorted(self.weekdays.items()):
+            if profile != HOLIDAY:
+                groups.setdefault(profile, []).append(weekday)
+        return groups
+
+    def overrides(self, today, horizon=CALENDAR_HORIZON_DAYS):
+        """Особые даты ближайших horizon дней, которые отличаются от дня недели"""
+        last = today + timedelta(days=horizon)
+        return {
+            day: profile
+            for day, profile in sorted(self.dates.items())
+            if today <= day < last and profile != self.weekdays.get(day.isoweekday(), HOLIDAY)
+        }
+
+def load_calendar():
+    return ScheduleCalendar(load_settings().get("calendar"))
+
+def save_calendar(calendar):
+    settings = load_settings()
+    settings["calendar"] = calendar.to_dict()
+    save_settings(settings)
+
+class DayTimeline:
+    """Скомпилированные звонки одного дня: отсортированные секунды от полуночи"""
+
+    def __init__(self, day, profile, events):
+        self.day = day
+        self.profile = profile
+        by_time = {}
+        if profile != HOLIDAY:
+            for event in profile_events(events, profile):
+                try:
+                    h, m = map(int, event.time.split(':'))
+                except ValueError:
+                    logging.warning(f"Некорректное время события: {event.time}")
+                    continue
+                by_time.setdefault(h * 3600 + m * 60, []).append(event)
+        self.seconds = sorted(by_time)
+        self.events = [by_time[second] for second in self.seconds]
+
+    def next_after(self, second):
+        """(секунда, события) первого звонка строго после second или (None, [])"""
+        i = bisect.bisect_right(self.seconds, second)
+        if i == len(self.seconds):
+            return None, []
+        return self.seconds[i], self.events[i]
+
+# Таблица "дата -> скомпилированный день", сбрасывается при смене
+# расписания или настроек
+_timeline_cache = {'key': None, 'days': {}}
+_timeline_cache_lock = threading.Lock()
+
+def get_day_timeline(day, events=None, calendar=None):
+    """Звонки на дату day (из кэша, пока не менялись расписание и календарь)"""
+    key = (get_schedule_version(), _settings_version)
+    with _timeline_cache_lock:
+        if _timeline_cache['key'] != key:
+            _timeline_cache['key'] = key
+            _timeline_cache['days'] = {}
+        timeline = _timeline_cache['days'].get(day)
+    if timeline is None:
+        calendar = calendar or load_calendar()
+        timeline = DayTimeline(day, calendar.profile_for(day), load_events() if events is None else events)
+        with _timeline_cache_lock:
+            _timeline_cache['days'][day] = timeline
+    return timeline
+
+def next_ring_after(now, events=None, calendar=None, max_days=CALENDAR_HORIZON_DAYS):
+    """(datetime, события) ближайшего звонка строго после now"""
+    calendar = calendar or load_calendar()
+    second = now.hour * 3600 + now.minute * 60 + now.second
+    for day_offset in range(max_days):
+        day = now.date() + timedelta(days=day_offset)
+        timeline = get_day_timeline(day, events, calendar)
+        ring_second, ring_events = timeline.next_after(second if day_offset == 0 else -1)
+        if ring_second is not None:
+            return datetime.combine(day, datetime.min.time()) + timedelta(seconds=ring_second), ring_events
+    return None, []
+
+# --- Метаданные аудиофайлов ---
+def load_audio_meta():
+    """Возвращает {имя файла: метаданные} для загруженных аудио"""
+    if storage is not None:
+        return storage.load_audio_meta()
     try:
-        events = load_events()
-        if not events:
-            return False, "Нет событий для установки"
-        
-        # Генерируем содержимое cron
-        cron_content = generate_cron_jobs(events)
-        
-        # Сохраняем во временный файл
-        with open(CRON_FILE, 'w') as f:
-            f.write(cron_content)
-        
-        # 1. Пробуем стандартную установку
-        exit_code = os.system(f"crontab {CRON_FILE} 2>&1")
-        if exit_code == 0:
-            return True, "Cron успешно установлен"
-        
-        # 2. Получаем информацию об ошибке
-        error = os.popen(f"crontab {CRON_FILE} 2>&1").read()
-        
-        # 3. Проверяем возможные причины
-        if "permission denied" in error.lower():
-            # Пробуем через sudo
-            username = os.getenv('USER')
-            exit_code = os.system(f"sudo crontab -u {username} {CRON_FILE}")
-            if exit_code == 0:
-                return True, "Cron установлен через sudo"
-            else:
-                sudo_error = os.popen(f"sudo crontab -u {username} {CRON_FILE} 2>&1").read()
-                manual_install = (
-                    "Требуются права администратора.\n"
-                    "Выполните вручную:\n"
-                    f"1. nano {os.path.abspath(CRON_FILE)}\n"
-                    f"2. sudo crontab -u {username} {os.path.abspath(CRON_FILE)}"
-                )
-                return False, f"{sudo_error}\n\n{manual_install}"
-        
-        elif "no crontab for" in error.lower():
-            # Пробуем создать новый crontab
-            exit_code = os.system(f"crontab -l >/dev/null 2>&1 || crontab {CRON_FILE}")
-            if exit_code == 0:
-                return True, "Создан новый crontab"
-            else:
-                return False, "Не удалось создать crontab"
-        
-        else:
-            # Неизвестная ошибка
-            return False, f"Неизвестная ошибка: {error}"
-            
+        with open(AUDIO_META_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        logging.error(f"Cron error: {str(e)}", exc_info=True)
-        return False, f"Ошибка: {str(e)}"
+        logging.error(f"Ошибка чтения {AUDIO_META_FILE}: {str(e)}")
+        return {}
 
-#---------------------------------------------------------->
-# --- Команды бота ---
+def _save_audio_meta_file(meta):
+    temp_path = AUDIO_META_FILE + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, AUDIO_META_FILE)
 
-@bot.message_handler(commands=['start'])
-def start(message):
-    if not is_authenticated(message.chat.id):
-        request_password(message)
+def save_audio_meta(name, info):
+    """Сохраняет метаданные одного аудиофайла"""
+    if storage is not None:
+        storage.save_audio_meta(name, info)
         return
-        
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    buttons = [
-        types.KeyboardButton('/add_lesson'),
+    meta = load_audio_meta()
+    meta[name] = info
+    _save_audio_meta_file(meta)
+
+def audio_upload_meta(download, tg_file):
+    """Метаданные загруженного из Telegram файла"""
+    return {
+        'sha256': download['sha256'],
+        'size': download['size'],
+        'file_unique_id': getattr(tg_file, 'file_unique_id', None),
+        'mime_type': getattr(tg_file, 'mime_type', None),
+        'duration': getattr(tg_file, 'duration', None),
+        'uploaded': int(time.time())
+    }
+
+def delete_audio_meta(name):
+    if storage is not None:
+        storage.delete_audio_meta(name)
+        return
+    meta = load_audio_meta()
+    if meta.pop(name, None) is not None:
+        _save_audio_meta_file(meta)
+
+#--------------------Хранилище SQLite--------------------------------->
+class SqliteStorage:
+    """Расписание, настройки и метаданные аудио в SQLite (режим WAL).
+
+    У каждого потока своё соединение: в WAL читатели не блокируют писателя.
+    Многошаговые изменения выполняются внутри transaction().
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            profile TEXT NOT NULL DEFAULT 'default',
+            lesson_num INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            time TEXT NOT NULL,
+            audio_file TEXT NOT NULL,
+            PRIMARY KEY (profile, lesson_num, event_type)
+        );
+        CREATE INDEX IF NOT EXISTS events_by_lesson ON events (lesson_num);
+        CREATE INDEX IF NOT EXISTS events_by_time ON events (time);
+        CREATE INDEX IF NOT EXISTS events_by_profile ON events (profile, time);
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS audio (
+            name TEXT PRIMARY KEY,
+            sha256 TEXT,
+            size INTEGER,
+            meta TEXT NOT NULL DEFAULT '{}',
+            data BLOB
+        );
+        CREATE INDEX IF NOT EXISTS audio_by_sha256 ON audio (sha256);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция записи; вложенные вызовы входят во внешнюю"""
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._local.depth = 0
+
+    def _get_meta(self, key, default=0):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, conn, key, value):
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    def cache_key(self):
+        return ('sqlite', self._get_meta('schedule_version'))
+
+    def is_empty(self):
+        return self._conn().execute("SELECT 1 FROM events LIMIT 1").fetchone() is None
+
+    # --- расписание ---
+    def load_events(self):
+        rows = self._conn().execute(
+            "SELECT profile, lesson_num, event_type, time, audio_file FROM events "
+            "ORDER BY profile != ?, profile, lesson_num, event_type",
+            (DEFAULT_PROFILE,)
+        ).fetchall()
+        return [
+            LessonEvent(str(num), event_type, t, audio, profile)
+            for profile, num, event_type, t, audio in rows
+        ]
+
+    def save_events(self, events):
+        """Приводит таблицу к списку events: удаляет лишнее, обновляет изменённое"""
+        with self.transaction() as conn:
+            current = {
+                (profile, num, event_type): (t, audio)
+                for profile, num, event_type, t, audio in conn.execute(
+                    "SELECT profile, lesson_num, event_type, time, audio_file FROM events"
+                )
+            }
+            wanted = {
+                (e.profile, int(e.lesson_num), e.event_type): (e.time, e.audio_file)
+                for e in events
+            }
+            conn.executemany(
+                "DELETE FROM events WHERE profile = ? AND lesson_num = ? AND event_type = ?",
+                list(current.keys() - wanted.keys())
+            )
+            conn.executemany(
+                "INSERT INTO events (profile, lesson_num, event_type, time, audio_file) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(profile, lesson_num, event_type) "
+                "DO UPDATE SET time = excluded.time, audio_file = excluded.audio_file",
+                [
+                    (*key, t, audio)
+                    for key, (t, audio) in wanted.items()
+                    if current.get(key) != (t, audio)
+                ]
+            )
+            self._set_meta(conn, 'schedule_version', self._get_meta('schedule_version') + 1)
+
+    # --- настройки ---
+    def load_settings(self):
+        rows = self._conn().execute("SELECT key, value FROM settings").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_settings(self, settings):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM settings")
+            conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in settings.items()]
+            )
+
+    # --- аудио ---
+    def load_audio_meta(self):
+        rows = self._conn().execute("SELECT name, sha256, size, meta FROM audio").fetchall()
+        return {
+            name: {**json.loads(meta), 'sha256': sha256, 'size': size}
+            for name, sha256, size, meta in rows
+        }
+
+    def save_audio_meta(self, name, info):
+        extra = {k: v for k, v in info.items() if k not in ('sha256', 'size')}
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO audio (name, sha256, size, meta) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET sha256 = excluded.sha256, "
+                "size = excluded.size, meta = excluded.meta",
+                (name, info.get('sha256'), info.get('size'), json.dumps(extra))
+            )
+
+    def delete_audio_meta(self, name):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM audio WHERE name = ?", (name,))
+
+
+def open_storage():
+    """Открывает хранилище, выбранное в .env (STORAGE_BACKEND)"""
+    if STORAGE_BACKEND != "sqlite":
+        return None
+    sqlite_storage = SqliteStorage(STORAGE_DB)
+    if sqlite_storage.is_empty() and os.path.exists(SCHEDULE_FILE):
+        # Первый запуск: переносим данные из текстовых файлов
+        with sqlite_storage.transaction():
+            sqlite_storage.save_events(_parse_schedule_file())
+            if os.path.exists(SETTINGS_FILE):
+                with open(SETTINGS_FILE, 'r') as f:
+                    sqlite_storage.save_settings(json.load(f))
+            if os.path.exists(AUDIO_META_FILE):
+                with open(AUDIO_META_FILE, 'r') as f:
+                    for name, info in json.load(f).items():
+                        sqlite_storage.save_audio_meta(name, info)
+        logging.info(f"Данные перенесены из {SCHEDULE_FILE} в {STORAGE_DB}")
+    return sqlite_storage
+
+@contextmanager
+def storage_transaction():
+    """Объединяет несколько изменений хранилища в одну транзакцию"""
+    if storage is None:
+        yield
+        return
+    with storage.transaction():
+        yield
+
+storage = open_storage()
+
+# --- Работа с cron ---
+def _cron_weekdays(weekdays):
+    """Дни недели для cron: [1, 2, 3, 4, 5] -> 1-5, [1, 3, 5] -> 1,3,5"""
+    parts = []
+    for day in sorted(weekdays):
+        if parts and parts[-1][1] == day - 1:
+            parts[-1][1] = day
+        else:
+            parts.append([day, day])
+    return ','.join(f"{a}-{b}" if b - a > 1 else (f"{a},{b}" if b > a else str(a)) for a, b in parts)
+
+def cron_ring_specs(events, calendar=None, today=None):
+    """Строки звонков для cron: [(минута, час, день, месяц, дни недели, дата, событие)].
+
+    Дни недели дают по строке на событие своего профиля (дата None), особые
+    даты ближайших CALENDAR_HORIZON_DAYS дней - отдельные строки с датой.
+    """
+    calendar = calendar or load_calendar()
+    today = today or date.today()
+    groups = [
+        ('*', '*', _cron_weekdays(weekdays), None, profile)
+        for profile, weekdays in calendar.weekday_groups().items()
+    ]
+    groups += [
+        (str(day.day), str(day.month), '*', day, profile)
+        for day, profile in calendar.overrides(today).items() if profile != HOLIDAY
+    ]
+    specs = []
+    for dom, month, dow, day, profile in groups:
+        for event in sorted(profile_events(events, profile), key=lambda x: x.time):
+            try:
+                hour, minute = event.time.split(':')
+            except ValueError:
+                logging.warning(f"Некорректное время события: {event.time}")
+                continue
+            specs.append((minute, hour, dom, month, dow, day, event))
+    return specs
+
+def calendar_skip_path():
+    return os.path.join(os.path.dirname(SCHEDULE_FILE), CALENDAR_SKIP_FILE)
+
+def generate_cron_jobs(events, calendar=None, today=None):
+    """Генерирует crontab с абсолютными путями"""
+    if not os.path.exists(AUDIO_DIR):
+        os.makedirs(AUDIO_DIR, exist_ok=True)
+    
+    abs_audio_dir = os.path.abspath(AUDIO_DIR)
+    cron_log = os.path.join(abs_audio_dir, 'cron.log')
+    calendar = calendar or load_calendar()
+    today = today or date.today()
+    overrides = calendar.overrides(today)
+
+    # В особые даты недельные строки молчат: список дат лежит в файле,
+    # который строка проверяет перед запуском плеера
+    skip_guard = ""
+    if overrides:
+        skip_path = calendar_skip_path()
+        with open(skip_path, 'w') as f:
+            f.write(''.join(f"{day.isoformat()}\n" for day in overrides))
+        skip_guard = f"grep -qxF \"$(date +\\%F)\" '{skip_path}' || "
+
+    # Через обёртку каждый звонок попадает в журнал точности
+    ring_log = os.path.abspath(RING_LOG_FILE)
+    use_helper = os.path.exists(RING_HELPER)
+    python_path = sys.executable or "/usr/bin/python3"
+    
+    available = audio_inventory.snapshot()
+    cron_content = "# Аудио расписание\n\n"
+    
+    for minute, hour, dom, month, dow, day, event in cron_ring_specs(events, calendar, today):
+        try:
+            audio_path = os.path.join(abs_audio_dir, event.audio_file)
+            if event.audio_file not in available:
+                logging.warning(f"Audio file {audio_path} not found, skipping")
+                continue
+
+            if day is None:
+                guard = skip_guard
+            else:
+                # Строка с датой сработала бы и через год - сверяем год тоже
+                guard = f"test \"$(date +\\%F)\" = {day.isoformat()} && "
+            if use_helper:
+                guard += (
+                    f"{python_path} '{RING_HELPER}' '{ring_log}' {hour}:{minute} "
+                    f"{event.profile} {event.lesson_num} {event.event_type} "
+                )
+            cron_content += (
+                f"{minute} {hour} {dom} {month} {dow} "
+                f"{guard}{MPG123_PATH} '{audio_path}' "
+                f">>{cron_log} 2>&1\n"
+            )
+        except Exception as e:
+            logging.error(f"Error processing event {event.lesson_num}: {str(e)}")
+    
+    return cron_content
+
+# Строка звонка: "ММ ЧЧ Д М ДН [проверка даты] .../mpg123 [ключи] '/путь' ..."
+CRON_RING_RE = re.compile(
+    r"^(?P<minute>\d+)\s+(?P<hour>\d+)\s+(?P<dom>\S+)\s+(?P<month>\S+)\s+(?P<dow>\S+)\s+"
+    r".*?\b(?:mpg123|aplay)\b[^']*'(?P<path>[^']+)'"
+)
+
+def cron_entry(minute, hour, dom, month, dow, audio_path):
+    """Ключ записи crontab: (минута, час, день, месяц, дни недели, путь к файлу)"""
+    return (int(minute), int(hour), dom, month, dow, audio_path)
+
+def expected_cron_entries(events, calendar=None):
+    """Записи, которые должны быть в crontab для событий расписания"""
+    abs_audio_dir = os.path.abspath(AUDIO_DIR)
+    return {
+        cron_entry(minute, hour, dom, month, dow, os.path.join(abs_audio_dir, event.audio_file))
+        for minute, hour, dom, month, dow, _, event in cron_ring_specs(events, calendar)
+    }
+
+class CrontabIndex:
+    """Разобранный crontab: множество записей звонков и блок SRS"""
+
+    def __init__(self, text):
+        self.text = text
+        self.installed = bool(text.strip())
+        _, block, _ = split_crontab(text)
+        self.block = block
+        self.entries = self._parse(text)
+        self.block_entries = self._parse(block or "")
+        self.jobs = sum(
+            1 for line in text.splitlines()
+            if line.strip() and not line.lstrip().startswith('#')
+        )
+
+    @staticmethod
+    def _parse(text):
+        entries = set()
+        for line in text.splitlines():
+            match = CRON_RING_RE.match(line.strip())
+            if match:
+                entries.add(cron_entry(
+                    match['minute'], match['hour'], match['dom'], match['month'], match['dow'], match['path']
+                ))
+        return entries
+
+    def diff(self, events):
+        """(нет в cron, лишние в блоке SRS) для событий расписания"""
+        expected = expected_cron_entries(events)
+        return expected - self.entries, self.block_entries - expected
+
+# Кэш разобранного crontab. Ключ - stat файла в spool cron, если он доступен;
+# иначе crontab -l перечитывается не чаще раза в CRONTAB_CACHE_TTL секунд.
+# Собственные установки бота обновляют кэш сразу.
+CRONTAB_CACHE_TTL = 30
+_crontab_cache = {'key': None, 'read_at': 0.0, 'index': None, 'version': 0}
+_crontab_cache_lock = threading.Lock()
+
+def _crontab_spool_key():
+    path = get_cron_path()
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _set_crontab_index(text):
+    index = CrontabIndex(text)
+    with _crontab_cache_lock:
+        _crontab_cache['key'] = _crontab_spool_key()
+        _crontab_cache['read_at'] = time.monotonic()
+        _crontab_cache['index'] = index
+        _crontab_cache['version'] += 1
+    return index
+
+def get_crontab_index():
+    """Разобранный crontab пользователя (из кэша, пока crontab не менялся)"""
+    key = _crontab_spool_key()
+    with _crontab_cache_lock:
+        index = _crontab_cache['index']
+        if index is not None:
+            if key is not None and key == _crontab_cache['key']:
+                return index
+            if key is None and time.monotonic() - _crontab_cache['read_at'] < CRONTAB_CACHE_TTL:
+                return index
+    return _set_crontab_index(read_crontab())
+
+#------------------------------>
+CRON_BLOCK_BEGIN = "# >>> SRS: расписание звонков (изменяется ботом) >>>"
+CRON_BLOCK_END = "# <<< SRS: расписание звонков <<<"
+LEGACY_CRON_HEADER = "# Аудио расписание"  # Старые версии занимали весь crontab
+
+_cron_batch = threading.local()
+
+def read_crontab():
+    """Текущий crontab пользователя ('' если его нет)"""
+    result = subprocess.run(['crontab', '-l'], capture_output=True, text=True)
+    if result.returncode == 0:
+        return result.stdout
+    if "no crontab" in result.stderr.lower():
+        return ""
+    raise RuntimeError(result.stderr.strip() or f"crontab -l: код {result.returncode}")
+
+def split_crontab(text):
+    """Делит crontab на (строки до блока SRS, тело блока или None, строки после)"""
+    lines = text.splitlines()
+    if CRON_BLOCK_BEGIN in lines:
+        begin = lines.index(CRON_BLOCK_BEGIN)
+        # Без END блок тянется до конца файла - последняя строка не должна теряться
+        end = lines.index(CRON_BLOCK_END, begin) if CRON_BLOCK_END in lines[begin:] else len(lines)
+        return lines[:begin], "\n".join(lines[begin + 1:end]), lines[end + 1:]
+    if lines and lines[0] == LEGACY_CRON_HEADER:
+        # crontab целиком записан старой версией бота
+        return [], text.rstrip("\n"), []
+    return lines, None, []
+
+def _cron_block_hash(body):
+    return hashlib.sha256((body or "").strip().encode()).hexdigest()
+
+def write_crontab(text):
+    """Устанавливает crontab одним вызовом, возвращает (успех, сообщение)"""
+    result = subprocess.run(['crontab', '-'], input=text, capture_output=True, text=True)
+    if result.returncode == 0:
+        return True, "Cron успешно установлен"
+
+    error = result.stderr.strip()
+    if "permission denied" in error.lower():
+        # Пробуем через sudo (без запроса пароля)
+        username = os.getenv('USER')
+        result = subprocess.run(
+            ['sudo', '-n', 'crontab', '-u', username, '-'],
+            input=text, capture_output=True, text=True
+        )
+        if result.returncode == 0:
+            return True, "Cron установлен через sudo"
+        manual_install = (
+            "Требуются права администратора.\n"
+            "Выполните вручную:\n"
+            f"1. nano {os.path.abspath(CRON_FILE)}\n"
+            f"2. sudo crontab -u {username} {os.path.abspath(CRON_FILE)}"
+        )
+        return False, f"{result.stderr.strip()}\n\n{manual_install}"
+
+    return False, f"Неизвестная ошибка: {error}"
+
+@contextmanager
+def cron_batch():
+    """Откладывает install_cron_jobs до конца блока: массовые изменения
+    устанавливают crontab один раз. Результат установки - в result['cron']."""
+    result = {}
+    depth = getattr(_cron_batch, 'depth', 0)
+    _cron_batch.depth = depth + 1
+    if depth == 0:
+        _cron_batch.pending = False
+    try:
+        yield result
+    finally:
+        _cron_batch.depth = depth
+        if depth == 0 and _cron_batch.pending:
+            _cron_batch.pending = False
+            result['cron'] = install_cron_jobs()
+
+@track_cron_install
+def install_cron_jobs():
+    """Обновляет блок SRS в crontab, не трогая остальные задания"""
+    if getattr(_cron_batch, 'depth', 0):
+        _cron_batch.pending = True
+        return True, "Установка cron отложена до конца операции"
+    try:
+        events = load_events()
+        settings = load_settings()
+        
+        # Генерируем содержимое блока
+        if settings.get("ring_mode") == RING_MODE_ENGINE:
+            # Звонки играет встроенный движок - в cron их быть не должно,
+            # иначе каждый звонок прозвучит дважды
+            ring_engine.reload()
+            cron_block = "# Звонки обслуживает встроенный движок (ring_mode=engine)"
+        elif settings.get("cron_paused", False):
+            cron_block = "# Звонки приостановлены"
+        else:
+            cron_block = generate_cron_jobs(events)
+
+        # Читаем crontab один раз и заменяем только свой блок
+        current = read_crontab()
+        before, installed_block, after = split_crontab(current)
+        new_crontab = "\n".join(
+            before + [CRON_BLOCK_BEGIN] + cron_block.strip("\n").splitlines() + [CRON_BLOCK_END] + after
+        ) + "\n"
+
+        # Копия для ручной установки
+        with open(CRON_FILE, 'w') as f:
+            f.write(new_crontab)
+
+        if installed_block is not None and _cron_block_hash(installed_block) == _cron_block_hash(cron_block):
+            success, message = True, "Cron не изменился"
+            _set_crontab_index(current)
+        else:
+            success, message = write_crontab(new_crontab)
+            if success:
+                _set_crontab_index(new_crontab)
+
+        if success and not events:
+            # Пустой блок записан успешно - это не ошибка установки
+            return True, "Расписание пустое, звонки убраны из cron"
+        return success, message
+            
+    except Exception as e:
+        logging.error(f"Cron error: {str(e)}", exc_info=True)
+        return False, f"Ошибка: {str(e)}"
+
+#--------------------Скачивание аудио--------------------------------->
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def looks_like_audio(head):
+    """Проверяет сигнатуру начала файла (MP3, WAV, OGG, M4A, FLAC)"""
+    return (
+        head.startswith(b'ID3')
+        or (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0)
+        or head.startswith(b'OggS')
+        or (head[:4] == b'RIFF' and head[8:12] == b'WAVE')
+        or head[4:8] == b'ftyp'
+        or head.startswith(b'fLaC')
+    )
+
+def download_audio_file(file_info, filename):
+    """Потоково скачивает файл Telegram в AUDIO_DIR/filename.
+
+    Куски пишутся сразу во временный файл в AUDIO_DIR, по пути считается
+    SHA-256 и проверяется лимит max_audio_size_mb. Файл не из аудио
+    отбрасывается по первому куску. Готовый файл синхронизируется на диск
+    и атомарно переименовывается. Возвращает {'sha256', 'size', 'seconds'}.
+    """
+    max_mb = load_settings()["max_audio_size_mb"]
+    max_size = max_mb * 1024 * 1024
+    if file_info.file_size and file_info.file_size > max_size:
+        raise ValueError(f"Файл больше {max_mb} МБ")
+
+    if apihelper.FILE_URL is None:
+        url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
+    else:
+        url = apihelper.FILE_URL.format(TOKEN, file_info.file_path)
+
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    started = time.monotonic()
+    fd, temp_path = tempfile.mkstemp(dir=AUDIO_DIR, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f, requests.get(
+            url,
+            stream=True,
+            proxies=apihelper.proxy,
+            timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)
+        ) as response:
+            if response.status_code != 200:
+                raise ValueError(f"Ошибка скачивания файла: HTTP {response.status_code}")
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if size == 0 and not looks_like_audio(chunk):
+                    raise ValueError("Файл не похож на аудиозапись")
+                size += len(chunk)
+                if size > max_size:
+                    raise ValueError(f"Файл больше {max_mb} МБ")
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, os.path.join(AUDIO_DIR, filename))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # Фиксируем на диске и само переименование
+    dir_fd = os.open(AUDIO_DIR, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+    seconds = time.monotonic() - started
+    DOWNLOAD_BYTES.inc(size)
+    if seconds > 0:
+        DOWNLOAD_SPEED.observe(size / seconds)
+    return {'sha256': digest.hexdigest(), 'size': size, 'seconds': seconds}
+
+#--------------------Хранилище звуков по содержимому------------------>
+def _unique_id_index(meta):
+    """{file_unique_id Telegram: имя файла} по метаданным аудио"""
+    return {
+        unique_id: name
+        for name, info in meta.items()
+        for unique_id in info.get('file_unique_ids', [])
+    }
+
+def store_telegram_audio(tg_file):
+    """Возвращает имя файла (store/<sha256>.<ext>) для аудио из Telegram.
+
+    Каждый звук хранится один раз под своим хэшем. Если этот file_unique_id
+    уже встречался, файл из Telegram повторно не скачивается.
+    """
+    meta = load_audio_meta()
+    unique_id = getattr(tg_file, 'file_unique_id', None)
+    known = _unique_id_index(meta).get(unique_id) if unique_id else None
+    if known and audio_inventory.exists(known):
+        return known
+
+    file_info = bot.get_file(tg_file.file_id)
+    if not file_info:
+        raise ValueError("Не удалось получить информацию о файле")
+    file_ext = os.path.splitext(file_info.file_path)[1].lower()
+    if file_ext not in AUDIO_EXTENSIONS:
+        file_ext = '.mp3'
+
+    store_dir = os.path.join(AUDIO_DIR, AUDIO_STORE_SUBDIR)
+    os.makedirs(store_dir, exist_ok=True)
+    # Своё имя на каждую загрузку: один и тот же звук могут прислать из двух чатов сразу
+    fd, incoming_path = tempfile.mkstemp(dir=store_dir, prefix='.incoming-', suffix=file_ext)
+    os.close(fd)
+    incoming = os.path.join(AUDIO_STORE_SUBDIR, os.path.basename(incoming_path))
+    try:
+        download = download_audio_file(file_info, incoming)
+    except BaseException:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
+        raise
+
+    filename = os.path.join(AUDIO_STORE_SUBDIR, download['sha256'] + file_ext)
+    if audio_inventory.exists(filename):
+        # Такой звук уже есть - загруженная копия не нужна
+        os.remove(os.path.join(AUDIO_DIR, incoming))
+    else:
+        os.replace(os.path.join(AUDIO_DIR, incoming), os.path.join(AUDIO_DIR, filename))
+        build_pcm_cache(filename)
+
+    info = meta.get(filename) or audio_upload_meta(download, tg_file)
+    unique_ids = set(info.get('file_unique_ids', []))
+    if unique_id:
+        unique_ids.add(unique_id)
+    info['file_unique_ids'] = sorted(unique_ids)
+    # Точная длительность - по декодированному WAV, если он есть
+    info['duration'] = pcm_duration(filename) or info.get('duration')
+    save_audio_meta(filename, info)
+    audio_inventory.add(filename, info)
+    return filename
+
+def audio_refcounts(events):
+    """Сколько событий расписания ссылается на каждый аудиофайл"""
+    counts = {}
+    for event in events:
+        counts[event.audio_file] = counts.get(event.audio_file, 0) + 1
+    for lesson_data in current_lessons.values():
+        for file_type in ('start_audio', 'end_audio'):
+            if lesson_data.get(file_type):
+                counts[lesson_data[file_type]] = counts.get(lesson_data[file_type], 0) + 1
+    return counts
+
+def release_audio(audio_file, events):
+    """Удаляет файл, его кэш и метаданные, если на него больше никто не ссылается.
+
+    events - расписание после изменения; ссылки из незавершённых диалогов
+    добавления урока тоже учитываются.
+    """
+    if not audio_file or audio_refcounts(events).get(audio_file, 0) > 0:
+        return False
+    file_path = os.path.join(AUDIO_DIR, audio_file)
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    except Exception as e:
+        logging.error(f"Ошибка удаления файла {file_path}: {str(e)}")
+    audio_inventory.discard(audio_file)
+    invalidate_pcm_cache(audio_file)
+    delete_audio_meta(audio_file)
+    return True
+
+#--------------------Опись папки со звуками--------------------------->
+# Звуки из Telegram: store/<sha256>.<ext>
+STORE_NAME_RE = re.compile(
+    r'^' + re.escape(AUDIO_STORE_SUBDIR) + r'/[0-9a-f]{64}(' + '|'.join(re.escape(ext) for ext in AUDIO_EXTENSIONS) + r')$'
+)
+
+def safe_audio_name(name):
+    """Имя не выходит за AUDIO_DIR и не ломает schedule.txt (split) и кавычки в строках cron.
+
+    Имена в store/ принимаются только в виде store/<sha256>.<расширение>.
+    """
+    if not name or not isinstance(name, str) or os.path.isabs(name) or re.search(r"[\s'\"\\]", name):
+        return False
+    normalized = os.path.normpath(name)
+    if normalized != name or normalized == '..' or normalized.startswith('../'):
+        return False
+    return not name.startswith(AUDIO_STORE_SUBDIR + '/') or bool(STORE_NAME_RE.match(name))
+
+class AudioInventory:
+    """Что лежит в AUDIO_DIR: {имя: {'size', 'mtime', 'duration'}}.
+
+    Строится одним проходом os.scandir по AUDIO_DIR и AUDIO_DIR/store, дальше
+    его поддерживают загрузка и удаление звуков. Проверка наличия файла -
+    поиск в словаре. Заново папки читаются, только если их изменили в обход
+    бота (поменялось mtime каталога).
+    """
+
+    def __init__(self):
+        self._files = None
+        self._key = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _dirs_key():
+        key = []
+        for path in (AUDIO_DIR, os.path.join(AUDIO_DIR, AUDIO_STORE_SUBDIR)):
+            try:
+                key.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    @staticmethod
+    def _entry(stat_result, info):
+        return {
+            'size': stat_result.st_size,
+            'mtime': stat_result.st_mtime,
+            'duration': info.get('duration'),
+        }
+
+    def _scan(self):
+        meta = load_audio_meta()
+        files = {}
+        for subdir in ('', AUDIO_STORE_SUBDIR):
+            try:
+                with os.scandir(os.path.join(AUDIO_DIR, subdir)) as entries:
+                    for entry in entries:
+                        # Временные .upload-/.incoming- файлы и служебные json/tsv не звуки
+                        if entry.name.startswith('.') or os.path.splitext(entry.name)[1].lower() not in AUDIO_EXTENSIONS:
+                            continue
+                        if not entry.is_file():
+                            continue
+                        name = os.path.join(subdir, entry.name) if subdir else entry.name
+                        info = meta.get(name, {})
+                        if info.get('duration') is None:
+                            info = {'duration': pcm_duration(name)}
+                        files[name] = self._entry(entry.stat(), info)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logging.error(f"Ошибка чтения папки {os.path.join(AUDIO_DIR, subdir)}: {str(e)}")
+        return files
+
+    def snapshot(self):
+        """Актуальная опись. Словарь не менять - он общий для всех потоков"""
+        key = self._dirs_key()
+        with self._lock:
+            if self._files is None or key != self._key:
+                self._files = self._scan()
+                self._key = key
+                self._version += 1
+            return self._files
+
+    def version(self):
+        """Номер описи: меняется при каждом изменении набора файлов"""
+        self.snapshot()
+        return self._version
+
+    def exists(self, name):
+        return name in self.snapshot()
+
+    def get(self, name):
+        return self.snapshot().get(name)
+
+    def rescan(self):
+        """Перечитывает папки целиком. Возвращает имена новых, изменённых и удалённых файлов"""
+        key = self._dirs_key()
+        files = self._scan()
+        with self._lock:
+            old = self._files or {}
+            changed = {
+                name for name in old.keys() | files.keys()
+                if name not in old or name not in files
+                or (old[name]['size'], old[name]['mtime']) != (files[name]['size'], files[name]['mtime'])
+            }
+            self._files = files
+            self._key = key
+            if changed:
+                self._version += 1
+        return changed
+
+    def add(self, name, info=None):
+        """Бот сам положил файл в AUDIO_DIR"""
+        try:
+            stat_result = os.stat(os.path.join(AUDIO_DIR, name))
+        except OSError:
+            return self.discard(name)
+        with self._lock:
+            if self._files is None:
+                return
+            # Копия вместо правки на месте: другие потоки могут читать старую
+            files = dict(self._files)
+            files[name] = self._entry(stat_result, info or {})
+            self._files = files
+            self._key = self._dirs_key()
+            self._version += 1
+
+    def discard(self, name):
+        """Бот сам удалил файл из AUDIO_DIR"""
+        with self._lock:
+            if self._files is None:
+                return
+            files = dict(self._files)
+            files.pop(name, None)
+            self._files = files
+            self._key = self._dirs_key()
+            self._version += 1
+
+audio_inventory = AudioInventory()
+
+#--------------------Кэш декодированного аудио------------------------>
+def pcm_cache_path(audio_file):
+    """Путь к декодированному WAV для файла из AUDIO_DIR"""
+    return os.path.join(PCM_CACHE_DIR, audio_file + '.wav')
+
+def pcm_duration(audio_file):
+    """Длительность звука в секундах по размеру декодированного WAV или None"""
+    try:
+        size = os.path.getsize(pcm_cache_path(audio_file))
+    except OSError:
+        return None
+    # Заголовок WAV - 44 байта, дальше s16le: 2 байта на канал
+    return round(max(size - 44, 0) / (PCM_RATE * PCM_CHANNELS * 2), 2)
+
+def invalidate_pcm_cache(audio_file):
+    """Удаляет декодированную копию файла"""
+    if not audio_file:
+        return
+    cache_path = pcm_cache_path(audio_file)
+    try:
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+    except Exception as e:
+        logging.error(f"Ошибка удаления кэша {cache_path}: {str(e)}")
+
+def build_pcm_cache(audio_file):
+    """Один раз декодирует загруженный файл в WAV (s16le, 44.1 кГц, стерео).
+
+    Возвращает путь к кэшу или None, если декодировать нечем.
+    """
+    src = os.path.join(AUDIO_DIR, audio_file)
+    cache_path = pcm_cache_path(audio_file)
+    temp_path = cache_path + '.tmp'
+    invalidate_pcm_cache(audio_file)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    ext = os.path.splitext(audio_file)[1].lower()
+    if FFMPEG_PATH:
+        cmd = [
+            FFMPEG_PATH, '-v', 'error', '-y', '-i', src,
+            '-ac', str(PCM_CHANNELS), '-ar', str(PCM_RATE),
+            '-acodec', 'pcm_s16le', '-f', 'wav', temp_path
+        ]
+    elif ext == '.mp3' and os.path.exists(MPG123_PATH):
+        cmd = [MPG123_PATH, '-q', '--stereo', '-r', str(PCM_RATE), '-w', temp_path, src]
+    elif ext == '.wav':
+        cmd = None
+    else:
+        logging.warning(f"Нет декодера для {audio_file}, кэш PCM не создан")
+        return None
+
+    try:
+        if cmd:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip() or f"код {result.returncode}")
+        else:
+            shutil.copyfile(src, temp_path)
+        os.replace(temp_path, cache_path)
+        return cache_path
+    except Exception as e:
+        logging.error(f"Ошибка декодирования {audio_file}: {str(e)}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+PLAYER_PIPE_SIZE = 4096    # Канал к плееру ужимается до страницы (по умолчанию 64 КБ - ~0,37 с звука)
+PLAYER_FIRST_CHUNK = 4096  # Первый блок: когда плеер его забрал, звук пошёл
+
+def shrink_pipe(pipe, size=PLAYER_PIPE_SIZE):
+    """Уменьшает буфер канала: запись в него ждёт, пока плеер не заберёт данные"""
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except (AttributeError, OSError) as e:
+        logging.warning(f"Не удалось уменьшить канал к плееру: {str(e)}")
+
+def _feed_player(proc, cache_path, on_first_sample=None, started=None):
+    """Отдаёт плееру отображённый в память WAV"""
+    first_sample = None
+    try:
+        with open(cache_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Первый блок заполняет ужатый канал, второй ждёт, пока aplay
+            # первый заберёт: после этого устройство открыто и звук пошёл
+            shrink_pipe(proc.stdin)
+            proc.stdin.write(data[:PLAYER_FIRST_CHUNK])
+            proc.stdin.flush()
+            proc.stdin.write(data[PLAYER_FIRST_CHUNK:2 * PLAYER_FIRST_CHUNK])
+            proc.stdin.flush()
+            first_sample = time.time()
+            if on_first_sample:
+                on_first_sample(started, first_sample)
+            proc.stdin.write(data[2 * PLAYER_FIRST_CHUNK:])
+    except (BrokenPipeError, ValueError):
+        pass
+    except Exception as e:
+        logging.error(f"Ошибка передачи {cache_path} плееру: {str(e)}")
+    finally:
+        if first_sample is None and on_first_sample:
+            on_first_sample(started, None)
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+def _watch_mpg123(proc, audio_path, on_first_sample=None, started=None):
+    """Ведёт mpg123 в режиме -R: первая строка @F - первый сыгранный кадр"""
+    first_sample = None
+    try:
+        proc.stdin.write(f"LOAD {audio_path}\n".encode())
+        proc.stdin.flush()
+        for line in proc.stdout:
+            if line.startswith(b'@F') and first_sample is None:
+                first_sample = time.time()
+                if on_first_sample:
+                    on_first_sample(started, first_sample)
+                # Дальше кадры не нужны - mpg123 перестаёт их печатать
+                proc.stdin.write(b"SILENCE\n")
+                proc.stdin.flush()
+            elif line.startswith(b'@E'):
+                logging.error(f"mpg123: {line.decode(errors='replace').strip()}")
+                break
+            elif line.startswith(b'@P 0'):
+                break
+        proc.stdin.write(b"QUIT\n")
+        proc.stdin.flush()
+    except (BrokenPipeError, ValueError, OSError):
+        pass
+    finally:
+        if first_sample is None and on_first_sample:
+            on_first_sample(started, None)
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+#--------------------Постоянный плеер--------------------------------->
+PLAYER_BLOCK = 1024 * PCM_CHANNELS * 2  # ~23 мс звука за одну запись в плеер
+PLAYER_AHEAD = 0.05                     # Насколько запись опережает воспроизведение, с
+PLAYER_BUFFER_US = 100000               # Буфер ALSA у aplay: меньше - быстрее старт звука
+PLAYER_PRELOAD_AHEAD = 120              # За сколько секунд до звонка держать его файл в памяти
+PLAYER_PRELOAD_CHECK = 15               # Как часто смотреть на ближайший звонок, с
+PLAYER_FIFO = os.path.join(AUDIO_DIR, "player.fifo")  # Команды от строк cron (SRS-ring.py)
+
+PLAYER_RESTARTS = Counter("srs_player_restarts_total", "Перезапуски постоянного плеера")
+
+def wav_data_range(data):
+    """(начало, конец) сэмплов в WAV: ffmpeg пишет перед data ещё блок LIST"""
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        size = struct.unpack_from('<I', data, offset + 4)[0]
+        if chunk_id == b'data':
+            start = offset + 8
+            end = min(len(data), start + size)
+            return start, end - (end - start) % (PCM_CHANNELS * 2)
+        offset += 8 + size + (size & 1)
+    return 44, len(data)
+
+class PlayerSupervisor:
+    """Один долгоживущий aplay на сырой PCM вместо нового процесса на звонок.
+
+    Устройство открыто всё время: пока звонка нет, плееру в темпе реального
+    времени идёт тишина, звонок подменяет тишину данными из кэша WAV - без
+    запуска процесса, загрузки библиотек и открытия ALSA/Pulse. Звуки,
+    пришедшие одновременно (конец урока и начало следующего), играют друг за
+    другом. Канал к плееру ужат, так что впереди звонка не копится больше
+    страницы канала и буфера ALSA, даже если часы звуковой карты отстают.
+    Файлы ближайшего звонка заранее держатся в памяти. Упавший плеер
+    перезапускается. Строки cron отдают звонки через PLAYER_FIFO.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._proc = None
+        self._queue = deque()   # [(mmap, on_first_sample, время команды)] - играют по очереди
+        self._preloaded = {}    # {имя файла: mmap} - держит страницы в кэше ОС
+        self._thread = None
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def play(self, audio_file, on_first_sample=None):
+        """Ставит файл в очередь плеера (сразу, если ничего не играет). False - плеер не работает или нет WAV"""
+        proc = self._proc
+        if not self.is_running() or proc is None or proc.poll() is not None:
+            # Пока плеер перезапускается, звонок играет отдельный процесс
+            return False
+        try:
+            with open(pcm_cache_path(audio_file), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return False
+        with self._lock:
+            self._queue.append((data, on_first_sample, time.time()))
+        self._wake.set()
+        return True
+
+    def preload(self, audio_files):
+        """Отображает в память файлы ближайшего звонка, остальные отпускает"""
+        loaded = {}
+        for name in set(audio_files):
+            with self._lock:
+                data = self._preloaded.get(name)
+            if data is None:
+                try:
+                    with open(pcm_cache_path(name), 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    data.madvise(mmap.MADV_WILLNEED)
+                except (OSError, ValueError):
+                    continue
+            loaded[name] = data
+        with self._lock:
+            stale = [data for name, data in self._preloaded.items() if name not in loaded]
+            self._preloaded = loaded
+        for data in stale:
+            data.close()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="player", daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._preload_loop, name="player-preload", daemon=True).start()
+        threading.Thread(target=self._listen_fifo, name="player-fifo", daemon=True).start()
+        logging.info("Постоянный плеер запущен")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+
+    def _spawn(self):
+        with open(os.path.join(AUDIO_DIR, 'cron.log'), 'a') as log:
+            self._proc = subprocess.Popen(
+                [
+                    APLAY_PATH, '-q', '-t', 'raw', '-f', 'S16_LE',
+                    '-r', str(PCM_RATE), '-c', str(PCM_CHANNELS),
+                    f'--buffer-time={PLAYER_BUFFER_US}', '-'
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=log,
+                bufsize=0
+            )
+        # С каналом по умолчанию (64 КБ) при отстающих часах карты впереди
+        # звонка копилось бы до ~0,4 с тишины
+        shrink_pipe(self._proc.stdin)
+
+    def _queued(self, ahead):
+        """Сколько секунд звука уже отдано плееру, но ещё не сыграно"""
+        try:
+            pipe_bytes = struct.unpack('i', fcntl.ioctl(self._proc.stdin.fileno(), termios.FIONREAD, b'\0' * 4))[0]
+        except OSError:
+            return max(ahead, 0.0)
+        buffer_time = PLAYER_BUFFER_US / 1000000
+        if pipe_bytes:
+            # aplay читает канал, только когда в буфере ALSA есть место
+            return pipe_bytes / (PCM_RATE * PCM_CHANNELS * 2) + buffer_time
+        return min(max(ahead, 0.0), buffer_time)
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._spawn()
+                self._feed()
+            except Exception as e:
+                logging.error(f"Постоянный плеер остановился: {str(e)}")
+            finally:
+                if self._proc is not None and self._proc.poll() is None:
+                    self._proc.kill()
+                    self._proc.wait()
+            if self._stop.is_set():
+                break
+            # Плеер, проработавший долго, перезапускаем через секунду; падающий раз за разом - всё реже
+            if time.monotonic() - started > 60:
+                delay = 1
+            PLAYER_RESTARTS.inc()
+            self._stop.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def _feed(self):
+        """Пишет в плеер звук или тишину в темпе воспроизведения"""
+        silence = bytes(PLAYER_BLOCK)
+        bytes_per_second = PCM_RATE * PCM_CHANNELS * 2
+        current = None  # [mmap, позиция, конец]
+        origin = time.monotonic()
+        written = 0.0   # Секунд звука отдано плееру с origin
+        while not self._stop.is_set():
+            code = self._proc.poll()
+            if code is not None:
+                raise RuntimeError(f"aplay завершился с кодом {code}")
+
+            if current is None:
+                with self._lock:
+                    pending = self._queue.popleft() if self._queue else None
+                if pending is not None:
+                    data, on_first_sample, requested = pending
+                    start, end = wav_data_range(data)
+                    current = [data, start, end]
+                    if on_first_sample:
+                        # Перед первым сэмплом ещё сыграется то, что уже в канале и буфере ALSA
+                        ahead = written - (time.monotonic() - origin)
+                        on_first_sample(requested, time.time() + self._queued(ahead))
+
+            if current is not None:
+                data, position, end = current
+                block = data[position:min(position + PLAYER_BLOCK, end)]
+                current[1] = position + len(block)
+                if current[1] >= end:
+                    data.close()
+                    current = None
+            else:
+                block = silence
+            self._proc.stdin.write(block)
+            written += len(block) / bytes_per_second
+
+            ahead = written - (time.monotonic() - origin)
+            if ahead < -0.5:
+                # Плеер простоял (система засыпала) - начинаем отсчёт заново
+                origin = time.monotonic() - written
+            elif ahead > PLAYER_AHEAD:
+                self._wake.wait(ahead - PLAYER_AHEAD)
+                self._wake.clear()
+
+    def _preload_loop(self):
+        while not self._stop.is_set():
+            try:
+                ring_at, events = next_ring_after(datetime.now())
+                files = []
+                if ring_at is not None and (ring_at - datetime.now()).total_seconds() <= PLAYER_PRELOAD_AHEAD:
+                    files = [event.audio_file for event in events]
+                    for name in files:
+                        if not os.path.exists(pcm_cache_path(name)) and audio_inventory.exists(name):
+                            build_pcm_cache(name)
+                self.preload(files)
+            except Exception as e:
+                logging.error(f"Ошибка подготовки звонка: {str(e)}")
+            self._stop.wait(PLAYER_PRELOAD_CHECK)
+
+    def _listen_fifo(self):
+        """Строки PLAY от SRS-ring.py: время по расписанию, профиль, урок, тип, файл"""
+        try:
+            if os.path.lexists(PLAYER_FIFO) and not stat.S_ISFIFO(os.lstat(PLAYER_FIFO).st_mode):
+                os.remove(PLAYER_FIFO)
+            if not os.path.exists(PLAYER_FIFO):
+                os.mkfifo(PLAYER_FIFO, 0o600)
+            # O_RDWR: канал не закрывается, когда cron дописал свою строку
+            fifo = io.open(os.open(PLAYER_FIFO, os.O_RDWR), 'rb')
+        except Exception as e:
+            logging.error(f"Канал команд плеера {PLAYER_FIFO} недоступен: {str(e)}")
+            return
+        audio_dir = os.path.abspath(AUDIO_DIR)
+        with fifo:
+            for line in fifo:
+                try:
+                    command, scheduled, profile, lesson_num, event_type, audio_path = (
+                        line.decode().rstrip("\n").split("\t")
+                    )
+                    name = os.path.relpath(audio_path, audio_dir)
+                    if command != "PLAY" or name.startswith('..'):
+                        raise ValueError(f"неизвестная команда: {line!r}")
+                    scheduled = float(scheduled)
+                    event = LessonEvent(
+                        lesson_num, event_type, datetime.fromtimestamp(scheduled).strftime('%H:%M'), name, profile
+                    )
+                    play_audio(
+                        name,
+                        lambda started, first_sample, event=event, scheduled=scheduled: record_ring(
+                            scheduled, started, first_sample, event, RING_MODE_CRON
+                        )
+                    )
+                except Exception as e:
+                    logging.error(f"Ошибка команды плеера: {str(e)}")
+
+player_supervisor = PlayerSupervisor()
+
+#--------------------Встроенный движок звонков------------------------>
+def play_audio(audio_file, on_first_sample=None):
+    """Запускает воспроизведение файла без ожидания окончания.
+
+    on_first_sample(запуск плеера, первый сэмпл) вызывается один раз, когда
+    звук пошёл в плеер (первый сэмпл None, если до этого не дошло).
+    """
+    if player_supervisor.play(audio_file, on_first_sample):
+        return player_supervisor
+    cache_path = pcm_cache_path(audio_file)
+    if os.path.exists(cache_path) and os.path.exists(APLAY_PATH):
+        # Декодировать ничего не нужно: WAV из кэша идёт в aplay напрямую из mmap
+        with open(os.path.join(AUDIO_DIR, 'cron.log'), 'a') as log:
+            proc = subprocess.Popen(
+                [APLAY_PATH, '-q', '-'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=log
+            )
+        threading.Thread(
+            target=_feed_player, args=(proc, cache_path, on_first_sample, time.time()), daemon=True
+        ).start()
+        return proc
+
+    audio_path = os.path.join(os.path.abspath(AUDIO_DIR), audio_file)
+    if not os.path.exists(audio_path):
+        logging.warning(f"Audio file {audio_path} not found, skipping")
+        return None
+    with open(os.path.join(AUDIO_DIR, 'cron.log'), 'a') as log:
+        proc = subprocess.Popen(
+            [MPG123_PATH, '-R'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=log
+        )
+    threading.Thread(
+        target=_watch_mpg123, args=(proc, audio_path, on_first_sample, time.time()), daemon=True
+    ).start()
+    return proc
+
+#--------------------Журнал точности звонков------------------------>
+# Формат строки (TSV, совпадает с SRS-ring.py):
+# время звонка по расписанию (unix, с) | запуск плеера, мс после звонка |
+# первый сэмпл, мс после звонка или "-" | профиль | урок | start/end | cron/engine
+_ring_log_lock = threading.Lock()
+
+def record_ring(scheduled, started, first_sample, event, source):
+    """Дописывает одну строку в журнал звонков"""
+    def delay_ms(moment):
+        return "-" if moment is None else str(round((moment - scheduled) * 1000))
+    line = "\t".join([
+        str(int(scheduled)), delay_ms(started), delay_ms(first_sample),
+        event.profile, str(event.lesson_num), event.event_type, source
+    ]) + "\n"
+    try:
+        with _ring_log_lock:
+            if os.path.exists(RING_LOG_FILE) and os.path.getsize(RING_LOG_FILE) > RING_LOG_MAX_SIZE:
+                os.replace(RING_LOG_FILE, RING_LOG_FILE + '.1')
+            # Одна запись с O_APPEND не перемешивается с записями из cron
+            fd = os.open(RING_LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+    except Exception as e:
+        logging.error(f"Ошибка записи журнала звонков: {str(e)}")
+
+def read_ring_log(since=None):
+    """Записи журнала (и его прошлой части .1) не раньше since (unix, с)"""
+    records = []
+    for path in (RING_LOG_FILE + '.1', RING_LOG_FILE):
+        try:
+            with open(path) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) != 7:
+                        continue
+                    try:
+                        scheduled = int(parts[0])
+                        started = None if parts[1] == "-" else int(parts[1])
+                        first_sample = None if parts[2] == "-" else int(parts[2])
+                        int(parts[4])  # Номер урока - число, иначе строка битая
+                    except ValueError:
+                        continue
+                    if since is not None and scheduled < since:
+                        continue
+                    records.append({
+                        'scheduled': scheduled,
+                        'started_ms': started,
+                        'first_sample_ms': first_sample,
+                        'profile': parts[3],
+                        'lesson': parts[4],
+                        'event_type': parts[5],
+                        'source': parts[6]
+                    })
+        except FileNotFoundError:
+            continue
+    return records
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по уже отсортированному списку (ближайший ранг)"""
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def lateness_summary(values):
+    """"p50/p95/max" опозданий в мс"""
+    values = sorted(values)
+    return f"p50 {percentile(values, 0.5)} / p95 {percentile(values, 0.95)} / max {values[-1]} мс"
+
+
+class RingEngine:
+    """Долгоживущий планировщик звонков внутри сервиса.
+
+    Расписание читается один раз (и при reload), до ближайшего звонка поток
+    спит на монотонных часах, последние миллисекунды добирает короткими
+    sleep, так что воспроизведение стартует в пределах ~50 мс от секунды.
+    """
+
+    COARSE_STEP = 30.0   # Максимальный сон без пересчёта (смена времени NTP)
+    FINE_WINDOW = 0.5    # За сколько секунд до звонка переходим к точному ожиданию
+    SPIN_WINDOW = 0.002  # Последние миллисекунды ждём активно
+
+    def __init__(self):
+        self._events = []
+        self._calendar = ScheduleCalendar()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_fired = None
+
+    def reload(self, events=None):
+        """Перечитывает расписание и календарь и будит поток для пересчёта"""
+        if events is None:
+            events = load_events()
+        calendar = load_calendar()
+        with self._lock:
+            self._events = events
+            self._calendar = calendar
+        self._wakeup.set()
+
+    def next_ring(self, now):
+        """Возвращает (datetime, события) ближайшего звонка после now"""
+        with self._lock:
+            events, calendar = self._events, self._calendar
+        if self._last_fired and self._last_fired >= now:
+            now = self._last_fired
+        return next_ring_after(now, events, calendar)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.reload()
+        self._thread = threading.Thread(target=self._run, name="ring-engine", daemon=True)
+        self._thread.start()
+        logging.info("Движок звонков запущен")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def is_running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                ring_at, events = self.next_ring(datetime.now())
+                if ring_at is None:
+                    self._wakeup.wait(self.COARSE_STEP)
+                    self._wakeup.clear()
+                    continue
+
+                delay = ring_at.timestamp() - time.time()
+                if delay > self.FINE_WINDOW:
+                    # Грубый сон: Event.wait считает таймаут по монотонным часам
+                    self._wakeup.wait(min(delay - self.FINE_WINDOW, self.COARSE_STEP))
+                    self._wakeup.clear()
+                    continue
+
+                deadline = time.monotonic() + delay
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if remaining > self.SPIN_WINDOW:
+                        time.sleep(remaining / 2)
+
+                self._last_fired = ring_at
+                self._fire(ring_at, events)
+            except Exception as e:
+                logging.error(f"Ошибка движка звонков: {str(e)}", exc_info=True)
+                self._stop.wait(1)
+
+    def _fire(self, ring_at, events):
+        lateness = time.time() - ring_at.timestamp()
+        if lateness > RING_LATE_LIMIT:
+            logging.warning(f"Звонок {ring_at:%H:%M} пропущен (опоздание {lateness:.1f} с)")
+            return
+        if load_settings().get("cron_paused", False):
+            return
+        scheduled = ring_at.timestamp()
+        for event in events:
+            try:
+                play_audio(
+                    event.audio_file,
+                    lambda started, first_sample, event=event: record_ring(
+                        scheduled, started, first_sample, event, RING_MODE_ENGINE
+                    )
+                )
+            except Exception as e:
+                logging.error(f"Ошибка воспроизведения {event.audio_file}: {str(e)}")
+        logging.info(f"Звонок {ring_at:%H:%M} (опоздание {lateness * 1000:.0f} мс)")
+
+
+ring_engine = RingEngine()
+
+#--------------------Слежение за файлами------------------------------>
+# Правки по SSH (schedule.txt, settings.json, звуки в audio_files) бот
+# подхватывает сам: на пачку изменений - одно обновление cron или движка
+WATCH_DEBOUNCE = 1.0       # Столько секунд тишины после последнего изменения
+WATCH_MAX_DELAY = 10.0     # Дольше при непрерывных изменениях не ждём
+WATCH_POLL_INTERVAL = 2.0  # Период опроса, если inotify недоступен
+
+WATCH_REFRESHES = Counter(
+    "srs_file_watch_refresh_total", "Обновления звонков после правки файлов вне бота", ("reason",)
+)
+
+class Inotify:
+    """Минимальная обёртка над inotify(7) через ctypes (только Linux)"""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    # Файлы заменяются переименованием, поэтому следим за каталогами
+    DIR_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.dirs = {}  # {дескриптор наблюдения: каталог}
+
+    def add(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), self.DIR_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.dirs[wd] = directory
+
+    def read(self, timeout):
+        """[(каталог, имя, маска)] за timeout секунд. Каталог None - очередь переполнилась"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_IGNORED:
+                # Каталог удалили - наблюдение снято ядром
+                self.dirs.pop(wd, None)
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((None, '', mask))
+            elif wd in self.dirs:
+                events.append((self.dirs[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FileWatcher:
+    """Следит за SCHEDULE_FILE, SETTINGS_FILE и папками со звуками.
+
+    На Linux - inotify, иначе опрос раз в WATCH_POLL_INTERVAL. Изменения
+    копятся до WATCH_DEBOUNCE секунд тишины, потом кэши сбрасываются и cron
+    (или движок) обновляется один раз на всю пачку. Свои записи бот узнаёт
+    по ключам кэшей, так что после /add_lesson cron повторно не трогается.
+    С хранилищем SQLite файлы расписания и настроек не используются -
+    следим только за звуками.
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._polled = None
+        self.backend = None
+
+    def _audio_dirs(self):
+        audio_dir = os.path.abspath(AUDIO_DIR)
+        return (audio_dir, os.path.join(audio_dir, AUDIO_STORE_SUBDIR))
+
+    def _files(self):
+        """{(каталог, имя): вид изменения} для файлов расписания и настроек"""
+        if storage is not None:
+            return {}
+        return {
+            os.path.split(os.path.abspath(SCHEDULE_FILE)): 'schedule',
+            os.path.split(os.path.abspath(SETTINGS_FILE)): 'settings',
+        }
+
+    def _classify(self, directory, name):
+        kind = self._files().get((directory, name))
+        if kind:
+            return kind
+        if directory in self._audio_dirs() and not name.startswith('.'):
+            if name == AUDIO_STORE_SUBDIR or os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS:
+                return 'audio'
+        return None
+
+    def _watch_dirs(self):
+        """Ставит наблюдение на каталоги, которых ещё нет в списке (store создаётся позже)"""
+        watched = set(self._inotify.dirs.values())
+        for directory in {directory for directory, _ in self._files()} | set(self._audio_dirs()):
+            if directory not in watched and os.path.isdir(directory):
+                self._inotify.add(directory)
+
+    def _poll_state(self):
+        state = {kind: _stat_key(os.path.join(*path)) for path, kind in self._files().items()}
+        audio = {}
+        for directory in self._audio_dirs():
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if self._classify(directory, entry.name) == 'audio' and entry.is_file():
+                            st = entry.stat()
+                            audio[entry.path] = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                continue
+        state['audio'] = audio
+        return state
+
+    def _wait(self, timeout):
+        """Виды изменений (schedule, settings, audio) за timeout секунд"""
+        if self._inotify is None:
+            self._stop.wait(timeout)
+            state = self._poll_state()
+            kinds = {kind for kind, value in state.items() if value != self._polled.get(kind)}
+            self._polled = state
+            return kinds
+
+        kinds = set()
+        for directory, name, _ in self._inotify.read(timeout):
+            if directory is None:
+                kinds.update(('schedule', 'settings', 'audio'))
+            else:
+                kind = self._classify(directory, name)
+                if kind:
+                    kinds.add(kind)
+        if 'audio' in kinds:
+            self._watch_dirs()
+        return kinds
+
+    def start(self):
+        global _settings_file_key, _schedule_saved_key
+        if self._thread and self._thread.is_alive():
+            return
+        # Точка отсчёта: всё, что на диске сейчас, бот уже знает
+        load_events()
+        audio_inventory.snapshot()
+        if _schedule_saved_key is None:
+            _schedule_saved_key = _schedule_file_key()
+        if _settings_file_key is None:
+            _settings_file_key = _stat_key(SETTINGS_FILE)
+
+        self._inotify = None
+        if FILE_WATCH != "poll" and sys.platform.startswith('linux'):
+            try:
+                self._inotify = Inotify()
+                self._watch_dirs()
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify недоступен, перехожу на опрос: {str(e)}")
+                if self._inotify is not None:
+                    self._inotify.close()
+                self._inotify = None
+        if self._inotify is None:
+            self._polled = self._poll_state()
+        self.backend = "inotify" if self._inotify is not None else "poll"
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+        self._thread.start()
+        logging.info(f"Слежение за файлами запущено ({self.backend})")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        pending = set()
+        first = last = 0.0
+        while not self._stop.is_set():
+            try:
+                if pending:
+                    timeout = max(0.0, min(last + WATCH_DEBOUNCE, first + WATCH_MAX_DELAY) - time.monotonic())
+                else:
+                    timeout = WATCH_POLL_INTERVAL
+                kinds = self._wait(timeout)
+                now = time.monotonic()
+                if kinds:
+                    if not pending:
+                        first = now
+                    pending |= kinds
+                    last = now
+                if pending and now >= min(last + WATCH_DEBOUNCE, first + WATCH_MAX_DELAY):
+                    self.refresh(pending)
+                    pending = set()
+            except Exception as e:
+                logging.error(f"Ошибка слежения за файлами: {str(e)}", exc_info=True)
+                self._stop.wait(WATCH_POLL_INTERVAL)
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def refresh(self, kinds):
+        """Сбрасывает кэши и один раз обновляет звонки, если файлы правили вне бота"""
+        global _settings_file_key, _schedule_saved_key
+        reasons = []
+        if 'schedule' in kinds and storage is None:
+            # Сверяем с последней записью бота, а не с кэшем чтения: любой
+            # load_events между правкой и обновлением уже подхватил новый файл
+            key = _schedule_file_key()
+            if key != _schedule_saved_key:
+                _schedule_saved_key = key
+                invalidate_schedule_cache()
+                reasons.append('schedule')
+        if 'settings' in kinds and storage is None:
+            key = _stat_key(SETTINGS_FILE)
+            if key != _settings_file_key:
+                _settings_file_key = key
+                invalidate_settings_cache()
+                reasons.append('settings')
+        if 'audio' in kinds:
+            changed = audio_inventory.rescan()
+            for name in sorted(changed):
+                if audio_inventory.exists(name):
+                    build_pcm_cache(name)
+                    audio_inventory.add(name, {'duration': pcm_duration(name)})
+                else:
+                    invalidate_pcm_cache(name)
+            if changed:
+                reasons.append('audio')
+        if not reasons:
+            return False
+
+        reason = "+".join(reasons)
+        logging.info(f"Файлы изменены вне бота ({reason}) - обновляю звонки")
+        WATCH_REFRESHES.inc(reason=reason)
+        notify_fleet()
+        # ring_mode меняют только правкой settings.json
+        if load_settings().get("ring_mode") == RING_MODE_ENGINE:
+            ring_engine.start()
+        elif ring_engine.is_running():
+            ring_engine.stop()
+        success, message = install_cron_jobs()
+        if not success:
+            logging.warning(f"Обновление после правки файлов: {message}")
+        return True
+
+file_watcher = FileWatcher()
+
+#--------------------Сеть звонковых узлов----------------------------->
+# Контроллер отдаёт по HTTP снимок расписания и звуки по их sha256,
+# агенты держат долгий опрос и докачивают только недостающие файлы
+FLEET_WAIT = 25              # Сколько секунд контроллер держит запрос без изменений
+FLEET_SETTINGS = ("lesson_duration", "cron_paused", "calendar")  # ring_mode у каждого узла свой
+FLEET_STATE_FILE = "fleet_state.json"  # Что агент применил последним
+FLEET_CHUNK_SIZE = 64 * 1024
+
+FLEET_BYTES = Counter("srs_fleet_bytes_total", "Байт передано между контроллером и агентами", ("kind",))
+FLEET_SYNCS = Counter("srs_fleet_syncs_total", "Применённые агентом снимки по исходу", ("outcome",))
+
+_audio_hashes = {}  # {имя: ((size, mtime), sha256)} для файлов без sha256 в метаданных
+_audio_hashes_lock = threading.Lock()
+
+def audio_sha256(name, meta=None):
+    """sha256 файла из AUDIO_DIR: из метаданных, иначе считается один раз на версию файла"""
+    info = (meta if meta is not None else load_audio_meta()).get(name) or {}
+    if info.get('sha256'):
+        return info['sha256']
+    entry = audio_inventory.get(name)
+    if entry is None:
+        return None
+    version = (entry['size'], entry['mtime'])
+    with _audio_hashes_lock:
+        cached = _audio_hashes.get(name)
+    if cached and cached[0] == version:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(os.path.join(AUDIO_DIR, name), 'rb') as f:
+        for chunk in iter(lambda: f.read(FLEET_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    with _audio_hashes_lock:
+        _audio_hashes[name] = (version, digest.hexdigest())
+    return digest.hexdigest()
+
+class FleetController:
+    """Версионированный снимок расписания для агентов.
+
+    Снимок пересобирается, когда меняется расписание, настройки или набор
+    звуков; номер версии растёт, только если поменялось содержимое. Ждущие
+    агенты будятся сразу - вся сеть обновляется одной правкой.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._key = None
+        self.version = 0
+        self.snapshot = None  # {'version', 'hash', 'events', 'settings', 'audio'}
+        self._body = None
+        self._gzip_body = None
+        self._blobs = {}      # {sha256: имя файла}
+        self.nodes = {}       # {узел: {'hash', 'seen', 'address'}}
+
+    def _build(self):
+        events = load_events()
+        settings = load_settings()
+        available = audio_inventory.snapshot()
+        meta = load_audio_meta()
+        audio = {}
+        for name in sorted({event.audio_file for event in events}):
+            if name in available:
+                audio[name] = {'sha256': audio_sha256(name, meta), 'size': available[name]['size']}
+        content = {
+            'events': [
+                [event.profile, event.lesson_num, event.event_type, event.time, event.audio_file]
+                for event in events
+            ],
+            'settings': {key: settings.get(key) for key in FLEET_SETTINGS},
+            'audio': audio,
+        }
+        content_hash = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+        return content, content_hash
+
+    def refresh(self):
+        """Актуальный снимок; при изменении содержимого будит ждущих агентов"""
+        key = (get_schedule_version(), _settings_version, audio_inventory.version())
+        with self._cond:
+            if key == self._key:
+                return self.snapshot
+            content, content_hash = self._build()
+            self._key = key
+            if self.snapshot is None or content_hash != self.snapshot['hash']:
+                self.version += 1
+                self.snapshot = {'version': self.version, 'hash': content_hash, **content}
+                self._body = json.dumps(self.snapshot).encode()
+                self._gzip_body = gzip.compress(self._body)
+                self._blobs = {info['sha256']: name for name, info in content['audio'].items()}
+                self._cond.notify_all()
+                logging.info(f"Снимок для агентов: версия {self.version}, событий {len(content['events'])}")
+            return self.snapshot
+
+    def wait(self, have, timeout):
+        """Ждёт снимок с хэшем, отличным от have. Возвращает (снимок, тело, gzip) или None.
+
+        Ждущих будит notify_fleet из save_events, save_settings и наблюдателя
+        за файлами, опроса нет.
+        """
+        deadline = time.monotonic() + timeout
+        self.refresh()
+        with self._cond:
+            while self.snapshot['hash'] == have:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            else:
+                return self.snapshot, self._body, self._gzip_body
+        # Правки в обход и бота, и наблюдателя (SQLite другим процессом) - раз за запрос
+        if self.refresh()['hash'] == have:
+            return None
+        with self._cond:
+            return self.snapshot, self._body, self._gzip_body
+
+    def blob_path(self, sha256):
+        with self._cond:
+            name = self._blobs.get(sha256)
+        return os.path.join(AUDIO_DIR, name) if name else None
+
+    def seen(self, node, have, address):
+        with self._cond:
+            self.nodes[node] = {'hash': have, 'seen': time.time(), 'address': address}
+
+    def start_server(self):
+        """HTTP для агентов на FLEET_HOST:FLEET_PORT в фоновом потоке"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import urlsplit, parse_qs
+        controller = self
+
+        class FleetHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Агенты держат одно соединение
+
+            def do_GET(self):
+                if not hmac.compare_digest(self.headers.get('X-Fleet-Token', ''), FLEET_TOKEN):
+                    self.send_error(403)
+                    return
+                url = urlsplit(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                if url.path == '/fleet/snapshot':
+                    self._snapshot(params)
+                elif url.path.startswith('/fleet/audio/'):
+                    self._audio(url.path.rsplit('/', 1)[-1])
+                else:
+                    self.send_error(404)
+
+            def _snapshot(self, params):
+                have = params.get('have', '')
+                controller.seen(params.get('node') or self.client_address[0], have, self.client_address[0])
+                try:
+                    wait = float(params.get('wait') or 0)
+                    if wait != wait:  # nan
+                        raise ValueError(wait)
+                    wait = min(max(wait, 0.0), FLEET_WAIT)
+                except ValueError:
+                    self.send_error(400)
+                    return
+                result = controller.wait(have, wait)
+                if result is None:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                _, body, gzip_body = result
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip_body
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                FLEET_BYTES.inc(len(body), kind="snapshot")
+
+            def _audio(self, sha256):
+                path = controller.blob_path(sha256)
+                if not path or not os.path.exists(path):
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, self.wfile, FLEET_CHUNK_SIZE)
+                FLEET_BYTES.inc(size, kind="audio")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.refresh()
+        server = ThreadingHTTPServer((FLEET_HOST, FLEET_PORT), FleetHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fleet", daemon=True).start()
+        logging.info(f"Контроллер звонков: http://{FLEET_HOST}:{FLEET_PORT}/fleet/")
+        return server
+
+class FleetAgent:
+    """Узел со своим динамиком: зеркалит расписание и звуки контроллера.
+
+    Расписание, календарь и звуки пишутся обычными save_events/save_settings,
+    дальше звонки идут как на отдельной установке: cron или движок, по
+    ring_mode в локальном settings.json.
+    """
+
+    def __init__(self, controller_url, node, token):
+        self.url = controller_url
+        self.node = node
+        self._session = requests.Session()  # keep-alive: одно соединение на все запросы
+        self._session.headers['X-Fleet-Token'] = token
+        self._stop = threading.Event()
+        self.state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(FLEET_STATE_FILE) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'hash': '', 'version': 0, 'audio': []}
+        except Exception as e:
+            logging.error(f"Ошибка чтения {FLEET_STATE_FILE}: {str(e)}")
+            return {'hash': '', 'version': 0, 'audio': []}
+
+    def _save_state(self):
+        temp_path = FLEET_STATE_FILE + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, FLEET_STATE_FILE)
+
+    def fetch_snapshot(self, wait=FLEET_WAIT):
+        """Новый снимок или None, если за wait секунд ничего не поменялось"""
+        response = self._session.get(
+            f"{self.url}/fleet/snapshot",
+            params={'node': self.node, 'have': self.state['hash'], 'wait': wait},
+            timeout=(5, wait + 10)
+        )
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        FLEET_BYTES.inc(len(response.content), kind="snapshot")
+        return response.json()
+
+    def _has_audio(self, name, info, available, meta):
+        entry = available.get(name)
+        return entry is not None and entry['size'] == info['size'] and audio_sha256(name, meta) == info['sha256']
+
+    def download_audio(self, name, info):
+        """Качает звук по sha256 во временный файл, сверяет хэш и кладёт под именем name"""
+        if not safe_audio_name(name):
+            raise ValueError(f"недопустимое имя файла {name!r}")
+        target = os.path.join(AUDIO_DIR, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.fleet-', suffix='.part')
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f, self._session.get(
+                f"{self.url}/fleet/audio/{info['sha256']}", stream=True, timeout=(5, 60)
+            ) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(FLEET_CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+            if digest.hexdigest() != info['sha256']:
+                raise ValueError(f"хэш {name} не совпал")
+            os.replace(temp_path, target)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        FLEET_BYTES.inc(info['size'], kind="audio")
+        build_pcm_cache(name)
+        save_audio_meta(name, {
+            'sha256': info['sha256'], 'size': info['size'],
+            'duration': pcm_duration(name), 'source': 'fleet', 'uploaded': int(time.time())
+        })
+        audio_inventory.add(name, {'duration': pcm_duration(name)})
+
+    def apply(self, snapshot):
+        """Докачивает недостающие звуки, затем одной записью меняет расписание и настройки"""
+        # Имена из снимка идут в os.path.join(AUDIO_DIR, ...): ../ писал бы и удалял мимо папки
+        unsafe = sorted({
+            name for name in list(snapshot['audio']) + [event[4] for event in snapshot['events']]
+            if not safe_audio_name(name)
+        }, key=repr)
+        if unsafe:
+            raise ValueError(f"Снимок {snapshot.get('version')} отклонён: недопустимые имена файлов {unsafe[:5]!r}")
+        available = audio_inventory.snapshot()
+        meta = load_audio_meta()
+        missing = [
+            (name, info) for name, info in snapshot['audio'].items()
+            if not self._has_audio(name, info, available, meta)
+        ]
+        # Расписание меняется только когда все его звуки уже на месте
+        for name, info in missing:
+            self.download_audio(name, info)
+
+        events = [
+            LessonEvent(lesson_num, event_type, time_str, audio_file, profile)
+            for profile, lesson_num, event_type, time_str, audio_file in snapshot['events']
+        ]
+        with cron_batch() as batch:
+            if not save_events(events):
+                raise Exception("Не удалось сохранить файл расписания")
+            settings = load_settings()
+            settings.update(snapshot['settings'])
+            save_settings(settings)
+            install_cron_jobs()
+
+        # Звуки, которые пришли с контроллера и больше не нужны
+        for name in set(self.state.get('audio', [])) - set(snapshot['audio']):
+            if safe_audio_name(name):
+                release_audio(name, events)
+
+        self.state = {'hash': snapshot['hash'], 'version': snapshot['version'], 'audio': sorted(snapshot['audio'])}
+        self._save_state()
+        logging.info(
+            f"Снимок {snapshot['version']} применён: событий {len(events)}, докачано звуков {len(missing)}"
+        )
+        return batch.get('cron', (True, ""))
+
+    def run(self):
+        """Долгий опрос контроллера до stop()"""
+        logging.info(f"Агент {self.node}: контроллер {self.url}")
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                snapshot = self.fetch_snapshot()
+                if snapshot is not None:
+                    self.apply(snapshot)
+                    FLEET_SYNCS.inc(outcome="applied")
+                delay = 1
+            except Exception as e:
+                FLEET_SYNCS.inc(outcome="error")
+                logging.error(f"Ошибка синхронизации с контроллером: {str(e)}")
+                self._stop.wait(delay)
+                delay = min(delay * 2, 60)
+
+    def run_commands(self):
+        """Постоянное соединение с контроллером для /ring_now (в отдельном потоке)"""
+        from urllib.parse import urlsplit
+        host = urlsplit(self.url).hostname
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                with socket.create_connection((host, FLEET_COMMAND_PORT), timeout=10) as sock:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.settimeout(None)
+                    send_lock = threading.Lock()
+
+                    def send(message):
+                        with send_lock:
+                            sock.sendall((json.dumps(message) + "\n").encode())
+
+                    send({'node': self.node, 'token': self._session.headers['X-Fleet-Token']})
+                    delay = 1
+                    for line in sock.makefile('rb'):
+                        self._command(json.loads(line), send)
+            except Exception as e:
+                logging.error(f"Соединение для команд с контроллером: {str(e)}")
+            self._stop.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def _command(self, message, send):
+        if message['cmd'] == 'ping':
+            send({'cmd': 'pong', 'id': message['id'], 't': message['t'], 'agent_time': time.time()})
+        elif message['cmd'] == 'play':
+            send({'cmd': 'ack', 'id': message['id']})
+
+            def play():
+                started, first_sample, error = play_at(message['audio'], message['at'])
+                try:
+                    send({
+                        'cmd': 'played', 'id': message['id'],
+                        'started': started, 'first_sample': first_sample, 'error': error
+                    })
+                except OSError:
+                    pass
+
+            threading.Thread(target=play, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+fleet_controller = FleetController()
+
+def notify_fleet():
+    """Расписание, настройки или звуки поменялись: контроллер сразу будит ждущих агентов"""
+    # Снимок появляется в start_server; без сервера агентов никто не ждёт
+    if fleet_controller.snapshot is None:
+        return
+    try:
+        fleet_controller.refresh()
+    except Exception as e:
+        logging.error(f"Ошибка обновления снимка для агентов: {str(e)}")
+
+#--------------------Звонок сейчас------------------------------------>
+# /ring_now: контроллер назначает общий момент старта чуть впереди и
+# рассылает его агентам по постоянным TCP-соединениям (строки JSON).
+# Часы агентов сверяются пингами, так что каждый узел ждёт свой момент
+# по своим часам и все динамики стартуют вместе.
+RING_NOW_LEAD = 0.3          # Минимальный запас до старта, с
+RING_NOW_ACK_TIMEOUT = 5.0   # Сколько ждать отчёт о старте после назначенного момента
+RING_NOW_SPREAD_LIMIT = 0.2  # Допустимый разброс старта между динамиками, с
+FLEET_PING_INTERVAL = 5.0    # Пинг агентов: живо ли соединение и сдвиг часов
+FLEET_PING_SAMPLES = 5       # Сдвиг часов берём по самому быстрому из последних пингов
+
+RING_NOW_SPREAD = Histogram(
+    "srs_ring_now_spread_seconds", "Разброс первого сэмпла между узлами для /ring_now", buckets=LATENESS_BUCKETS
+)
+
+def wait_until(moment):
+    """Ждёт момент time.time() с точностью до миллисекунд (как движок звонков)"""
+    deadline = time.monotonic() + (moment - time.time())
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if remaining > RingEngine.SPIN_WINDOW:
+            time.sleep(remaining / 2)
+
+def play_at(audio_file, moment, timeout=RING_NOW_ACK_TIMEOUT):
+    """Играет файл в момент moment. Возвращает (запуск плеера, первый сэмпл, ошибка)"""
+    wait_until(moment)
+    done = threading.Event()
+    result = {}
+
+    def on_first_sample(started, first_sample):
+        result.update(started=started, first_sample=first_sample)
+        done.set()
+
+    try:
+        if play_audio(audio_file, on_first_sample) is None:
+            return None, None, "нет файла"
+    except Exception as e:
+        return None, None, str(e)
+    if not done.wait(timeout):
+        return None, None, "плеер не ответил"
+    return result['started'], result['first_sample'], None
+
+class CommandLink:
+    """Постоянное соединение контроллера с одним агентом"""
+
+    def __init__(self, node, sock, address):
+        self.node = node
+        self.sock = sock
+        self.address = address
+        self.offset = 0.0    # Часы агента минус часы контроллера
+        self.rtt = None
+        self._samples = deque(maxlen=FLEET_PING_SAMPLES)
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._replies = {}   # {id команды: {'ack': ..., 'played': ...}}
+        self._next_ping = 0
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode()
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def ping(self):
+        self._next_ping += 1
+        self.send({'cmd': 'ping', 'id': self._next_ping, 't': time.time()})
+
+    def handle(self, message):
+        now = time.time()
+        if message.get('cmd') == 'pong':
+            rtt = now - message['t']
+            # Агент ответил посередине пути туда-обратно
+            self._samples.append((rtt, message['agent_time'] - (message['t'] + rtt / 2)))
+            self.rtt, self.offset = min(self._samples)
+        elif message.get('cmd') in ('ack', 'played'):
+            with self._cond:
+                self._replies.setdefault(message['id'], {})[message['cmd']] = {**message, 'at': now}
+                self._cond.notify_all()
+
+    def wait_played(self, command_id, deadline):
+        """Ответы агента на команду ({'ack', 'played'}), дождавшись отчёта о старте или deadline"""
+        with self._cond:
+            while 'played' not in self._replies.get(command_id, {}):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._replies.pop(command_id, {})
+
+class CommandHub:
+    """Сервер постоянных соединений агентов на FLEET_COMMAND_PORT"""
+
+    def __init__(self):
+        self._links = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def links(self):
+        with self._lock:
+            return list(self._links.values())
+
+    def drop(self, link):
+        with self._lock:
+            if self._links.get(link.node) is link:
+                del self._links[link.node]
+        try:
+            link.sock.close()
+        except OSError:
+            pass
+
+    def _serve(self, sock, address):
+        """Рукопожатие с токеном, затем чтение ответов агента до разрыва"""
+        link = None
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = sock.makefile('rb')
+            sock.settimeout(10)
+            hello = json.loads(reader.readline() or b'{}')
+            if not hmac.compare_digest(str(hello.get('token', '')), FLEET_TOKEN) or not hello.get('node'):
+                sock.close()
+                return
+            sock.settimeout(None)
+            link = CommandLink(hello['node'], sock, address[0])
+            with self._lock:
+                old = self._links.get(link.node)
+                self._links[link.node] = link
+            if old is not None:
+                self.drop(old)
+            logging.info(f"Агент {link.node} ({address[0]}) на связи")
+            # Несколько пингов сразу: сдвиг часов нужен до первой команды
+            for _ in range(3):
+                link.ping()
+            for line in reader:
+                link.handle(json.loads(line))
+        except Exception as e:
+            logging.error(f"Соединение с агентом {address[0]}: {str(e)}")
+        finally:
+            if link is not None:
+                logging.info(f"Агент {link.node} отключился")
+                self.drop(link)
+
+    def _ping_loop(self):
+        while not self._stop.wait(FLEET_PING_INTERVAL):
+            for link in self.links():
+                try:
+                    link.ping()
+                except OSError:
+                    self.drop(link)
+
+    def start(self):
+        server = socket.create_server((FLEET_HOST, FLEET_COMMAND_PORT))
+
+        def accept_loop():
+            while not self._stop.is_set():
+                try:
+                    sock, address = server.accept()
+                except OSError as e:
+                    logging.error(f"Ошибка приёма соединения агента: {str(e)}")
+                    continue
+                threading.Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+        threading.Thread(target=accept_loop, name="fleet-commands", daemon=True).start()
+        threading.Thread(target=self._ping_loop, name="fleet-ping", daemon=True).start()
+        logging.info(f"Команды агентам: {FLEET_HOST}:{FLEET_COMMAND_PORT}")
+        return server
+
+def ring_now(audio_file):
+    """Играет звук здесь и на всех подключённых агентах одновременно.
+
+    Возвращает [{'node', 'ack', 'started', 'first_sample', 'error'}]: время
+    подтверждения - от отправки команды, старт и первый сэмпл - от общего
+    назначенного момента, всё в секундах по часам контроллера.
+    """
+    links = command_hub.links()
+    rtts = [link.rtt for link in links if link.rtt is not None]
+    moment = time.time() + max(RING_NOW_LEAD, 2 * max(rtts, default=0) + 0.05)
+    command_id = f"{int(moment * 1000)}-{random.randrange(1 << 16)}"
+
+    sent = {}
+    for link in links:
+        try:
+            sent[link.node] = time.time()
+            link.send({'cmd': 'play', 'id': command_id, 'audio': audio_file, 'at': moment + link.offset})
+        except OSError:
+            command_hub.drop(link)
+            sent.pop(link.node, None)
+
+    local = {}
+    local_thread = threading.Thread(
+        target=lambda: local.update(zip(('started', 'first_sample', 'error'), play_at(audio_file, moment))),
+        daemon=True
+    )
+    local_thread.start()
+
+    def since(value, base, offset=0.0):
+        return None if value is None else value - offset - base
+
+    deadline = time.monotonic() + (moment - time.time()) + RING_NOW_ACK_TIMEOUT
+    results = []
+    for link in links:
+        if link.node not in sent:
+            results.append({'node': link.node, 'error': "соединение потеряно"})
+            continue
+        replies = link.wait_played(command_id, deadline)
+        ack = replies.get('ack', {})
+        played = replies.get('played', {})
+        results.append({
+            'node': link.node,
+            'ack': since(ack.get('at'), sent[link.node]),
+            'started': since(played.get('started'), moment, link.offset),
+            'first_sample': since(played.get('first_sample'), moment, link.offset),
+            'error': played.get('error') or (None if played else "нет отчёта о старте"),
+        })
+    local_thread.join(max(0.0, deadline - time.monotonic()))
+    results.insert(0, {
+        'node': FLEET_NODE + " (здесь)",
+        'ack': 0.0,
+        'started': since(local.get('started'), moment),
+        'first_sample': since(local.get('first_sample'), moment),
+        'error': local.get('error') or (None if local else "нет отчёта о старте"),
+    })
+
+    starts = [r['first_sample'] if r['first_sample'] is not None else r['started'] for r in results]
+    starts = [value for value in starts if value is not None]
+    if len(starts) > 1:
+        RING_NOW_SPREAD.observe(max(starts) - min(starts))
+    return results
+
+command_hub = CommandHub()
+
+#---------------------------------------------------------->
+# --- Команды бота ---
+
+@bot.message_handler(commands=['start'])
+def start(message):
+    if not is_authenticated(message.chat.id):
+        request_password(message)
+        return
+        
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    buttons = [
+        types.KeyboardButton('/add_lesson'),
         types.KeyboardButton('/show_schedule'),
         types.KeyboardButton('/remove_lessons'),  # Новая кнопка
+        types.KeyboardButton('/import_schedule'),
+        types.KeyboardButton('/calendar'),
         types.KeyboardButton('/settings'),
         types.KeyboardButton('/change_password')
     ]
@@ -405,6 +3737,12 @@ def start(message):
         "/add_lesson - добавить урок\n"
         "/show_schedule - показать расписание\n"
         "/remove_lessons - удалить последние уроки\n"  # Обновленная подпись
+        "/import_schedule - загрузить расписание целиком\n"
+        "/calendar - профили дней и особые даты\n"
+        "/shift, /regenerate, /compress_breaks - сдвиг и пересчёт всех уроков\n"
+        "/ring_stats - точность звонков\n"
+        "/ring_now - звонок прямо сейчас (учебная тревога)\n"
+        "/fleet - узлы звонков в других корпусах\n"
         "/settings - настройки\n"
         "/change_password - изменить пароль",
         reply_markup=markup
@@ -412,6 +3750,9 @@ def start(message):
 
 def request_password(message):
     """Запрашивает пароль у пользователя"""
+    if login_attempts.get(message.chat.id, 0) >= MAX_ATTEMPTS:
+        bot.send_message(message.chat.id, "🚫 Превышено максимальное количество попыток. Попробуйте позже.")
+        return
     msg = bot.send_message(
         message.chat.id,
         "🔒 Для работы с ботом требуется аутентификация.\n"
@@ -424,19 +3765,15 @@ def process_password(message):
     try:
         if check_password(message.text):
             authenticated_users[message.chat.id] = (time.time(), "admin")
+            login_attempts.pop(message.chat.id, None)
             bot.send_message(message.chat.id, "✅ Успешная аутентификация!")
             start(message)
         else:
             # Подсчёт попыток
-            if 'attempts' not in process_password.__dict__:
-                process_password.attempts = {}
-            
-            if message.chat.id not in process_password.attempts:
-                process_password.attempts[message.chat.id] = 1
-            else:
-                process_password.attempts[message.chat.id] += 1
+            attempts = login_attempts.get(message.chat.id, 0) + 1
+            login_attempts[message.chat.id] = attempts
             
-            remaining = MAX_ATTEMPTS - process_password.attempts[message.chat.id]
+            remaining = MAX_ATTEMPTS - attempts
             
             if remaining > 0:
                 msg = bot.send_message(
@@ -446,7 +3783,7 @@ def process_password(message):
                 )
                 bot.register_next_step_handler(msg, process_password)
             else:
-                del process_password.attempts[message.chat.id]
+                # Счётчик остаётся до истечения ATTEMPTS_TIMEOUT
                 bot.send_message(
                     message.chat.id,
                     "🚫 Превышено максимальное количество попыток. "
@@ -494,25 +3831,18 @@ def debug_cron(message):
     """Команда для диагностики проблем с cron"""
     try:
         # 1. Проверяем доступность crontab
-        crontab_path = os.popen("which crontab").read().strip()
+        crontab_path = shutil.which("crontab") or ""
         exists = "✅ Доступен" if crontab_path else "❌ Не установлен"
         
-        # 2. Проверяем права
-        test_file = "test_cron_job"
-        with open(test_file, 'w') as f:
-            f.write("* * * * * echo 'test'\n")
-        
-        exit_code = os.system(f"crontab {test_file} 2>/dev/null")
-        permissions = "✅ Есть права" if exit_code == 0 else "❌ Нет прав"
-        
-        # 3. Пробуем получить текущие задания
-        current_jobs = os.popen("crontab -l 2>&1").read()
-        if "no crontab" in current_jobs:
-            jobs_status = "Нет заданий"
-        elif "permission denied" in current_jobs:
+        # 2-3. Проверяем права и получаем текущие задания
+        try:
+            index = _set_crontab_index(read_crontab())
+            permissions = "✅ Есть права"
+            jobs_status = f"{index.jobs} заданий" if index.installed else "Нет заданий"
+        except Exception as e:
+            index = None
+            permissions = f"❌ Нет прав ({str(e)})"
             jobs_status = "Ошибка прав доступа"
-        else:
-            jobs_status = f"{len(current_jobs.splitlines())} заданий"
         
         # 4. Проверяем системный cron.d
         cron_d_status = "✅ Доступен" if os.path.exists("/etc/cron.d") else "❌ Недоступен"
@@ -524,81 +3854,165 @@ def debug_cron(message):
             f"3. Текущие задания: {jobs_status}\n"
             f"4. Системный cron.d: {cron_d_status}"
         )
+
+        # 5. Расхождения расписания и crontab
+        if index is not None:
+            missing, stale = index.diff(load_events())
+            report += f"\n5. Блок SRS: {'✅ есть' if index.block is not None else '❌ нет'}"
+            for title, entries in (("Нет в cron", missing), ("Лишние в cron", stale)):
+                if entries:
+                    report += f"\n{title}:\n" + "\n".join(
+                        f"  {hour:02d}:{minute:02d} ({dow if dom == '*' else f'{dom}.{month}'}) "
+                        f"{os.path.basename(path)}"
+                        for minute, hour, dom, month, dow, path in sorted(entries, key=lambda e: (e[1], e[0]))
+                    )
         
         bot.reply_to(message, report)
         
     except Exception as e:
         bot.reply_to(message, f"Ошибка диагностики: {str(e)}")
 ################################Показ расписания##################################################
+SCHEDULE_PAGE_SIZE = 3500  # Символов на страницу (лимит Telegram 4096, остаток - на подвал)
+SCHEDULE_PAGE_PREFIX = "sched:"
+
+# Готовые страницы расписания: пересобираются, только когда поменялись
+# расписание, настройки, crontab или содержимое папки со звуками
+_schedule_view_cache = {'key': None, 'view': None}
+_schedule_view_lock = threading.Lock()
+
+def _schedule_view_key():
+    load_events()  # Подхватывает правки файла расписания вне бота
+    if load_settings().get("ring_mode") == RING_MODE_ENGINE:
+        cron_key = ('engine', ring_engine.is_running())
+    else:
+        get_crontab_index()
+        cron_key = ('cron', _crontab_cache['version'])
+    return (get_schedule_version(), _settings_version, cron_key, audio_inventory.version())
+
+def render_schedule_view(events):
+    """{'pages': [текст страницы], 'missing': [нет файла]} или None для пустого расписания"""
+    if not events:
+        return None
+
+    # Группировка событий по профилям и урокам
+    lessons = {}
+    for event in events:
+        lessons.setdefault((event.profile, event.lesson_num), {'start': None, 'end': None})[event.event_type] = event
+
+    available = audio_inventory.snapshot()
+    def file_status(event):
+        return event.audio_file in available
+
+    blocks = []
+    missing_files = []
+    current_profile = DEFAULT_PROFILE
+    for profile, lesson_num in sorted(lessons.keys(), key=lambda x: (x[0] != DEFAULT_PROFILE, x[0], int(x[1]))):
+        lesson = lessons[(profile, lesson_num)]
+        block = ""
+        if profile != current_profile:
+            current_profile = profile
+            block += f"📋 Профиль {profile}:\n\n"
+        if profile != DEFAULT_PROFILE:
+            lesson_num = f"{lesson_num} ({profile})"
+        block += f"Урок {lesson_num}:\n"
+        for event_type, icon, title in (('start', "🔔", "Начало"), ('end', "🔕", "Конец")):
+            event = lesson[event_type]
+            if event is None:
+                continue
+            file_exists = file_status(event)
+            if not file_exists:
+                missing_files.append(f"{event_type}_{lesson_num}")
+            block += f"  {icon} {title}: {event.time} ({'✅' if file_exists else '❌'} {event.audio_file})\n"
+        blocks.append(block + "\n")
+
+    pages = []
+    page = "📅 Текущее расписание:\n\n"
+    for block in blocks:
+        if len(page) + len(block) > SCHEDULE_PAGE_SIZE and page.strip():
+            pages.append(page)
+            page = ""
+        page += block
+    pages.append(page + f"\nСтатус cron: {get_cron_status()}")
+    if len(pages) > 1:
+        pages = [f"{text.rstrip()}\n\nСтраница {i + 1}/{len(pages)}" for i, text in enumerate(pages)]
+    return {'pages': pages, 'missing': missing_files}
+
+def get_schedule_view():
+    """Страницы расписания из кэша (пересобираются при изменениях)"""
+    key = _schedule_view_key()
+    with _schedule_view_lock:
+        if _schedule_view_cache['key'] == key:
+            return _schedule_view_cache['view']
+    view = render_schedule_view(load_events())
+    with _schedule_view_lock:
+        _schedule_view_cache['key'] = key
+        _schedule_view_cache['view'] = view
+    return view
+
+def schedule_page_markup(page, total):
+    """Кнопки листания или None для одной страницы"""
+    if total <= 1:
+        return None
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    markup.add(
+        types.InlineKeyboardButton("◀️", callback_data=f"{SCHEDULE_PAGE_PREFIX}{(page - 1) % total}"),
+        types.InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"{SCHEDULE_PAGE_PREFIX}{page}"),
+        types.InlineKeyboardButton("▶️", callback_data=f"{SCHEDULE_PAGE_PREFIX}{(page + 1) % total}")
+    )
+    return markup
+
 @bot.message_handler(commands=['show_schedule'])
 def show_schedule(message):
     try:
-        events = load_events()
-        if not events:
+        view = get_schedule_view()
+        if view is None:
             bot.send_message(message.chat.id, "Расписание пусто.")
             return
         
-        # Группировка событий по урокам
-        lessons = {}
-        for event in events:
-            if event.lesson_num not in lessons:
-                lessons[event.lesson_num] = {'start': None, 'end': None}
-            
-            if event.event_type == 'start':
-                lessons[event.lesson_num]['start'] = event
-            elif event.event_type == 'end':
-                lessons[event.lesson_num]['end'] = event
-        
-        # Формируем сообщение и проверяем файлы
-        schedule_text = "📅 Текущее расписание:\n\n"
-        missing_files = []
-        
-        for lesson_num in sorted(lessons.keys(), key=lambda x: int(x)):
-            lesson = lessons[lesson_num]
-            
-            # Проверяем файлы для начала урока
-            start_file_exists = os.path.exists(os.path.join(AUDIO_DIR, lesson['start'].audio_file))
-            start_status = "✅" if start_file_exists else "❌"
-            if not start_file_exists:
-                missing_files.append(f"start_{lesson_num}")
-            
-            # Проверяем файлы для конца урока
-            end_file_exists = os.path.exists(os.path.join(AUDIO_DIR, lesson['end'].audio_file))
-            end_status = "✅" if end_file_exists else "❌"
-            if not end_file_exists:
-                missing_files.append(f"end_{lesson_num}")
-            
-            schedule_text += (
-                f"Урок {lesson_num}:\n"
-                f"  🔔 Начало: {lesson['start'].time} ({start_status} {lesson['start'].audio_file})\n"
-                f"  🔕 Конец: {lesson['end'].time} ({end_status} {lesson['end'].audio_file})\n\n"
-            )
-        
-        # Добавляем информацию о cron
-        cron_status = get_cron_status()
-        schedule_text += f"\nСтатус cron: {cron_status}"
-        
-        # Отправляем расписание
-        bot.send_message(message.chat.id, schedule_text)
+        # Отправляем первую страницу, остальные - по кнопкам
+        pages = view['pages']
+        bot.send_message(message.chat.id, pages[0], reply_markup=schedule_page_markup(0, len(pages)))
         
         # Отправляем отдельное сообщение о недостающих файлах
-        if missing_files:
+        if view['missing']:
             bot.send_message(
                 message.chat.id,
-                "⚠️ Отсутствующие файлы:\n" + "\n".join(missing_files)
+                "⚠️ Отсутствующие файлы:\n" + "\n".join(view['missing'])
             )
         
     except Exception as e:
         logging.error(f"Ошибка при показе расписания: {str(e)}")
         bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith(SCHEDULE_PAGE_PREFIX))
+def show_schedule_page(call):
+    try:
+        view = get_schedule_view()
+        if view is None:
+            bot.answer_callback_query(call.id, "Расписание пусто")
+            return
+        pages = view['pages']
+        page = min(int(call.data[len(SCHEDULE_PAGE_PREFIX):]), len(pages) - 1)
+        if call.message.text != pages[page]:
+            bot.edit_message_text(
+                pages[page], call.message.chat.id, call.message.message_id,
+                reply_markup=schedule_page_markup(page, len(pages))
+            )
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logging.error(f"Ошибка листания расписания: {str(e)}")
+        bot.answer_callback_query(call.id, "Ошибка, откройте /show_schedule заново")
 #№№№№№№№№№№№№№№№№№№№№№№№№№№№№№ КОНЕЦ ПОКАЗА РАСПИСАНИЯ №№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№
 def get_cron_status():
     """Проверяет статус cron и возвращает текстовое описание"""
     try:
-        # Получаем содержимое crontab
-        cron_output = os.popen("crontab -l 2>&1").read()
-        
-        if "no crontab" in cron_output.lower():
+        settings = load_settings()
+        if settings.get("ring_mode") == RING_MODE_ENGINE:
+            state = "работает" if ring_engine.is_running() else "остановлен"
+            return f"Звонки играет встроенный движок ({state})"
+
+        index = get_crontab_index()
+        if not index.installed:
             return "Не установлен"
         
         # Проверяем наличие наших записей
@@ -606,17 +4020,18 @@ def get_cron_status():
         if not events:
             return "Установлен (нет наших записей)"
         
-        # Подсчитываем наши записи в crontab
-        our_entries = 0
-        for event in events:
-            if f"mpg123 '{os.path.join(os.path.abspath(AUDIO_DIR), event.audio_file)}'" in cron_output:
-                our_entries += 1
+        # Сравниваем множества ожидаемых и установленных записей
+        expected = len(expected_cron_entries(events))
+        missing, stale = index.diff(events)
+        our_entries = expected - len(missing)
+        details = ""
+        if missing or stale:
+            details = f", нет в cron: {len(missing)}, лишних: {len(stale)}"
         
-        settings = load_settings()
         if settings.get("cron_paused", False):
-            return f"Приостановлен (наших записей: {our_entries}/{len(events)*2})"
+            return f"Приостановлен (наших записей: {our_entries}/{expected})"
         
-        return f"Активен (наших записей: {our_entries}/{len(events)*2})"
+        return f"Активен (наших записей: {our_entries}/{expected}{details})"
     
     except Exception as e:
         logging.error(f"Ошибка проверки статуса cron: {str(e)}")
@@ -625,10 +4040,10 @@ def get_cron_status():
 
 # Глобальная переменная для хранения состояния удаления
 
-lesson_deletion_state = {}
+lesson_deletion_state = SessionStore("lesson_deletion", DIALOG_TIMEOUT)
 
 # Глобальный словарь для отслеживания состояния
-deletion_context = {}
+deletion_context = SessionStore("deletion", DIALOG_TIMEOUT)
 
 # Переделаем обработку удаления уроков с использованием состояния
 @bot.message_handler(commands=['remove_lessons'])
@@ -640,7 +4055,7 @@ def handle_remove_lessons(message):
             bot.send_message(message.chat.id, "Нет уроков для удаления.")
             return
             
-        lesson_numbers = sorted({int(e.lesson_num) for e in events})
+        lesson_numbers = sorted({int(e.lesson_num) for e in profile_events(events)})
         total = len(lesson_numbers)
         
         # Создаем клавиатуру
@@ -720,22 +4135,22 @@ def perform_lesson_deletion(chat_id, count):
             bot.send_message(chat_id, "Расписание пусто.")
             return
 
-        remaining_events = [e for e in events if int(e.lesson_num) not in lessons_to_delete]
+        # Удаление из меню касается только основного профиля
+        remaining_events = [
+            e for e in events
+            if e.profile != DEFAULT_PROFILE or int(e.lesson_num) not in lessons_to_delete
+        ]
         
-        if not save_events(remaining_events):
-            bot.send_message(chat_id, "Ошибка сохранения расписания.")
-            return
+        with storage_transaction():
+            if not save_events(remaining_events):
+                bot.send_message(chat_id, "Ошибка сохранения расписания.")
+                return
 
-        # Удаляем связанные аудиофайлы
-        for lesson_num in lessons_to_delete:
-            for event in events:
-                if event.lesson_num == str(lesson_num):
-                    file_path = os.path.join(AUDIO_DIR, event.audio_file)
-                    try:
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                    except Exception as e:
-                        logging.error(f"Ошибка удаления файла {file_path}: {str(e)}")
+            # Удаляем аудиофайлы, которые больше не нужны ни одному уроку
+            for lesson_num in lessons_to_delete:
+                for event in profile_events(events):
+                    if event.lesson_num == str(lesson_num):
+                        release_audio(event.audio_file, remaining_events)
 
         bot.send_message(chat_id, f"Удалено {count} уроков: {lessons_to_delete}")
         install_cron_jobs()
@@ -792,12 +4207,13 @@ def pause_cron(message):
         
     try:
         with open(CRON_BACKUP_FILE, 'w') as f:
-            f.write(os.popen("crontab -l").read())
-        os.system("crontab -r")
+            f.write(read_crontab())
         
         settings = load_settings()
         settings["cron_paused"] = True
         save_settings(settings)
+        # Убираем звонки из блока SRS, остальные задания crontab не трогаем
+        install_cron_jobs()
         
         bot.send_message(message.chat.id, "✅ Звонки приостановлены. Cron очищен.")
     except Exception as e:
@@ -812,16 +4228,12 @@ def resume_cron(message):
         return
         
     try:
-        if os.path.exists(CRON_BACKUP_FILE):
-            os.system(f"crontab {CRON_BACKUP_FILE}")
-            status = "восстановлены"
-        else:
-            success, _ = install_cron_jobs()
-            status = "запущены (новые)" if success else "не удалось запустить"
-            
         settings = load_settings()
         settings["cron_paused"] = False
         save_settings(settings)
+
+        success, _ = install_cron_jobs()
+        status = "восстановлены" if success else "не удалось запустить"
         
         bot.send_message(message.chat.id, f"✅ Звонки {status}. Cron активирован.")
     except Exception as e:
@@ -851,12 +4263,13 @@ def process_lesson_duration(message):
 def pause_cron(message):
     try:
         with open(CRON_BACKUP_FILE, 'w') as f:
-            f.write(os.popen("crontab -l").read())
-        os.system("crontab -r")
+            f.write(read_crontab())
         
         settings = load_settings()
         settings["cron_paused"] = True
         save_settings(settings)
+        # Убираем звонки из блока SRS, остальные задания crontab не трогаем
+        install_cron_jobs()
         
         bot.send_message(message.chat.id, "✅ Звонки приостановлены. Cron очищен.")
     except Exception as e:
@@ -867,16 +4280,12 @@ def pause_cron(message):
 @bot.message_handler(func=lambda message: message.text == '3. Запустить звонки')
 def resume_cron(message):
     try:
-        if os.path.exists(CRON_BACKUP_FILE):
-            os.system(f"crontab {CRON_BACKUP_FILE}")
-            status = "восстановлены"
-        else:
-            install_cron_jobs()
-            status = "запущены (новые)"
-            
         settings = load_settings()
         settings["cron_paused"] = False
         save_settings(settings)
+
+        success, _ = install_cron_jobs()
+        status = "восстановлены" if success else "не удалось запустить"
         
         bot.send_message(message.chat.id, f"✅ Звонки {status}. Cron активирован.")
     except Exception as e:
@@ -887,7 +4296,12 @@ def resume_cron(message):
 # ... (остальные существующие функции process_lesson_number, 
 # process_start_time, process_start_audio, process_end_time, 
 # process_end_audio остаются без изменений)
-current_lessons = {}  # Временное хранилище для уроков в процессе добавления
+# Временное хранилище для уроков в процессе добавления. Брошенный диалог
+# через DIALOG_TIMEOUT без действий забывается вместе с загруженными звуками
+current_lessons = SessionStore(
+    "add_lesson", DIALOG_TIMEOUT, sliding=True,
+    on_evict=lambda lesson_data: cleanup_lesson_files(lesson_data)
+)
 
 @bot.message_handler(commands=['add_lesson'])
 @auth_required
@@ -909,7 +4323,7 @@ def process_lesson_number(message):
             raise ValueError("Номер урока должен быть числом")
             
         existing_events = load_events()
-        existing_nums = {int(e.lesson_num) for e in existing_events}
+        existing_nums = {int(e.lesson_num) for e in profile_events(existing_events)}
         current_num = int(lesson_num)
         
         # Если есть существующие уроки
@@ -992,7 +4406,9 @@ def process_start_time(message):
         
         # Проверяем пересечение с другими уроками
         existing_events = load_events()
-        is_valid, error_msg = validate_lesson_times(lesson_num, start_time, end_time, existing_events)
+        is_valid, error_msg = validate_lesson_times(
+            lesson_num, start_time, end_time, existing_events, index=get_schedule_index()
+        )
         if not is_valid:
             raise ValueError(error_msg)
             
@@ -1017,15 +4433,8 @@ def process_start_audio(message):
         if not message.audio and not message.document:
             raise ValueError("Отправьте аудиофайл в формате MP3, WAV или OGG")
         
-        # Получаем файл
-        file_info = bot.get_file(message.audio.file_id if message.audio else message.document.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        # Сохраняем файл
-        file_ext = os.path.splitext(file_info.file_path)[1].lower() or '.mp3'
-        filename = f"start_{current_lessons[message.chat.id]['lesson_num']}{file_ext}"
-        with open(os.path.join(AUDIO_DIR, filename), 'wb') as f:
-            f.write(downloaded_file)
+        # Получаем файл (уже известный звук повторно не скачивается)
+        filename = store_telegram_audio(message.audio or message.document)
         
         # Сохраняем информацию о файле
         current_lessons[message.chat.id]['start_audio'] = filename
@@ -1066,15 +4475,19 @@ def process_end_audio(message):
         existing_events = load_events()
         
         # Фильтрация событий
-        filtered_events = [e for e in existing_events if e.lesson_num != lesson_data['lesson_num']]
+        filtered_events = [
+            e for e in existing_events
+            if e.profile != DEFAULT_PROFILE or e.lesson_num != lesson_data['lesson_num']
+        ]
         
         # Валидация времени урока
         is_valid, error_msg = validate_lesson_times(
             lesson_data['lesson_num'],
             lesson_data['start_time'],
             lesson_data['end_time'],
-            existing_events
+            existing_events,
             #filtered_events
+            index=get_schedule_index()
         )
         
         if not is_valid:
@@ -1086,26 +4499,9 @@ def process_end_audio(message):
             cleanup_lesson_files(lesson_data)
             raise ValueError("Пожалуйста, отправьте аудиофайл для звонка на конец урока")
 
-        file_info = bot.get_file(message.audio.file_id if message.audio else message.document.file_id)
-        if not file_info:
-            cleanup_lesson_files(lesson_data)
-            raise ValueError("Не удалось получить информацию о файле")
-
-        # Обработка расширения файла
-        file_ext = os.path.splitext(file_info.file_path)[1].lower()
-        if not file_ext or file_ext not in ['.mp3', '.wav', '.ogg', '.m4a']:
-            file_ext = '.mp3'
-
-        # Создание имени файла и пути
-        filename = f"end_{lesson_data['lesson_num']}{file_ext}"
-        filepath = os.path.join(AUDIO_DIR, filename)
-        
         # Скачивание и сохранение файла
         try:
-            downloaded_file = bot.download_file(file_info.file_path)
-            os.makedirs(AUDIO_DIR, exist_ok=True)
-            with open(filepath, 'wb') as f:
-                f.write(downloaded_file)
+            filename = store_telegram_audio(message.audio or message.document)
         except Exception as e:
             cleanup_lesson_files(lesson_data)
             raise ValueError(f"Ошибка сохранения файла: {str(e)}")
@@ -1114,7 +4510,10 @@ def process_end_audio(message):
         lesson_data['end_audio'] = filename
 
         # Подготовка и сохранение расписания
-        events = [e for e in existing_events if e.lesson_num != lesson_data['lesson_num']]
+        events = [
+            e for e in existing_events
+            if e.profile != DEFAULT_PROFILE or e.lesson_num != lesson_data['lesson_num']
+        ]
         events.extend([
             LessonEvent(
                 lesson_num=lesson_data['lesson_num'],
@@ -1142,6 +4541,13 @@ def process_end_audio(message):
             cleanup_lesson_files(lesson_data)
             raise Exception("Не удалось сохранить файл расписания")
 
+        # Звуки, которые урок использовал до редактирования
+        del current_lessons[message.chat.id]
+        with storage_transaction():
+            for event in profile_events(existing_events):
+                if event.lesson_num == lesson_data['lesson_num']:
+                    release_audio(event.audio_file, events)
+
         # Обновление cron
         success, cron_msg = install_cron_jobs()
         if not success:
@@ -1171,15 +4577,688 @@ def process_end_audio(message):
 
 def cleanup_lesson_files(lesson_data):
     """Очистка файлов урока при ошибках"""
-    for file_type in ['start_audio', 'end_audio']:
-        if file_type in lesson_data and lesson_data[file_type]:
+    audio_files = [lesson_data.get(file_type) for file_type in ['start_audio', 'end_audio']]
+    # Сам диалог на файлы больше не ссылается
+    lesson_data['start_audio'] = lesson_data['end_audio'] = None
+    events = load_events()
+    for audio_file in audio_files:
+        release_audio(audio_file, events)
+
+#-----------------Импорт расписания целиком------------------->
+IMPORT_MAX_SIZE = 1024 * 1024
+IMPORT_FIELDS = ['lesson', 'start', 'end', 'start_audio', 'end_audio', 'profile']
+
+def parse_schedule_import(text):
+    """Разбирает CSV или JSON с уроками в список словарей.
+
+    CSV - строка заголовка lesson,start,end,start_audio,end_audio (разделитель
+    запятая или точка с запятой). JSON - список таких объектов или {"lessons": [...]}.
+    Столбцы end и *_audio можно не заполнять.
+    """
+    text = text.strip().lstrip('\ufeff')
+    if text.startswith('[') or text.startswith('{'):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get('lessons', [])
+        if not isinstance(data, list):
+            raise ValueError("JSON должен содержать список уроков")
+        return [{k: str(v).strip() for k, v in row.items() if v is not None} for row in data]
+
+    dialect = csv.Sniffer().sniff(text.splitlines()[0], delimiters=',;\t')
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    missing = {'lesson', 'start'} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"Нет обязательных столбцов: {', '.join(sorted(missing))}")
+    return [
+        {k.strip(): (v or '').strip() for k, v in row.items() if k}
+        for row in reader
+    ]
+
+def _schedule_overlap_errors(events, profile):
+    """Пересечения и порядок уроков одного профиля - по одному индексу"""
+    errors = []
+    suffix = "" if profile == DEFAULT_PROFILE else f" (профиль {profile})"
+    index = LessonIntervalIndex(events)
+    reported = set()
+    for start_min, end_min, lesson_num in index.intervals:
+        for other_num, other_start, other_end in index.overlaps(start_min, end_min, exclude=lesson_num):
+            pair = tuple(sorted((int(lesson_num), int(other_num))))
+            if pair not in reported:
+                reported.add(pair)
+                errors.append(
+                    f"Уроки {pair[0]} и {pair[1]} пересекаются{suffix} "
+                    f"({minutes_to_time(start_min)}-{minutes_to_time(end_min)} и "
+                    f"{minutes_to_time(other_start)}-{minutes_to_time(other_end)})"
+                )
+    by_number = sorted(index.intervals, key=lambda interval: int(interval[2]))
+    for previous, current in zip(by_number, by_number[1:]):
+        if current[0] < previous[1] and (int(previous[2]), int(current[2])) not in reported:
+            errors.append(
+                f"Урок {current[2]} должен начинаться после конца урока {previous[2]}{suffix} "
+                f"({minutes_to_time(previous[1])})"
+            )
+    return errors
+
+def build_import_events(rows, existing_events, duration):
+    """Проверяет все уроки за один проход и собирает события.
+
+    Возвращает (события, список ошибок). Ошибки не прерывают проверку -
+    пользователь получает их все сразу. Столбец profile необязателен,
+    каждый профиль проверяется отдельно.
+    """
+    errors = []
+    existing_audio = {
+        (e.profile, e.lesson_num, e.event_type): e.audio_file for e in existing_events
+    }
+    lessons = {}
+
+    for row_num, row in enumerate(rows, start=1):
+        prefix = f"Строка {row_num}"
+        profile = row.get('profile') or DEFAULT_PROFILE
+        if profile == HOLIDAY or not re.fullmatch(r'[\w-]+', profile):
+            errors.append(f"{prefix}: недопустимое имя профиля {profile}")
+            continue
+        lesson_num = row.get('lesson', '')
+        if not lesson_num.isdigit():
+            errors.append(f"{prefix}: номер урока должен быть числом")
+            continue
+        lesson_num = str(int(lesson_num))
+        if (profile, lesson_num) in lessons:
+            errors.append(f"{prefix}: урок {lesson_num} указан повторно")
+            continue
+        try:
+            start_time = normalize_time(row.get('start', ''))
+            end_time = normalize_time(row['end']) if row.get('end') else calculate_end_time(start_time, duration)
+            if time_to_minutes(end_time) <= time_to_minutes(start_time) or time_to_minutes(end_time) >= 24 * 60:
+                raise ValueError("урок должен заканчиваться после начала и до полуночи")
+        except ValueError as e:
+            errors.append(f"{prefix}: {str(e)}")
+            continue
+
+        audio = {}
+        for event_type in ('start', 'end'):
+            audio_file = (
+                row.get(f'{event_type}_audio')
+                or existing_audio.get((profile, lesson_num, event_type))
+            )
+            if not audio_file:
+                errors.append(f"{prefix}: не указан звук {event_type}_audio для урока {lesson_num}")
+            elif not safe_audio_name(audio_file):
+                errors.append(f"{prefix}: недопустимое имя файла {audio_file!r}")
+            elif not audio_inventory.exists(audio_file):
+                errors.append(f"{prefix}: нет файла {audio_file}")
+            audio[event_type] = audio_file
+        lessons[(profile, lesson_num)] = (start_time, end_time, audio)
+
+    events = []
+    for (profile, lesson_num), (start_time, end_time, audio) in lessons.items():
+        events.append(LessonEvent(lesson_num, 'start', start_time, audio['start'], profile))
+        events.append(LessonEvent(lesson_num, 'end', end_time, audio['end'], profile))
+
+    for profile in sorted({profile for profile, _ in lessons}):
+        # Номера уроков идут подряд с 1
+        numbers = sorted(int(num) for p, num in lessons if p == profile)
+        if numbers != list(range(1, len(numbers) + 1)):
+            errors.append(f"Номера уроков должны идти подряд с 1, получено: {numbers}")
+        errors.extend(_schedule_overlap_errors(profile_events(events, profile), profile))
+
+    return events, errors
+
+def apply_schedule_import(events, existing_events):
+    """Сохраняет импортированное расписание одной записью и одной установкой cron"""
+    with cron_batch() as batch:
+        with storage_transaction():
+            if not save_events(events):
+                raise Exception("Не удалось сохранить файл расписания")
+            for event in existing_events:
+                release_audio(event.audio_file, events)
+        install_cron_jobs()
+    return batch.get('cron', (True, ""))
+
+@bot.message_handler(commands=['import_schedule'])
+@auth_required
+def import_schedule(message):
+    bot.send_message(
+        message.chat.id,
+        "Отправьте файл CSV или JSON (или вставьте текст) с расписанием на день.\n"
+        "Столбцы: lesson,start,end,start_audio,end_audio[,profile]\n"
+        "Пример:\n"
+        "lesson,start,end,start_audio,end_audio\n"
+        "1,08:30,09:15,store/<хэш>.mp3,store/<хэш>.mp3\n\n"
+        "end можно не указывать (возьмётся продолжительность урока), "
+        "пустые звуки берутся у урока с тем же номером. "
+        "Расписание профилей из файла (по умолчанию default) будет заменено."
+    )
+    bot.register_next_step_handler(message, process_schedule_import)
+
+def process_schedule_import(message):
+    try:
+        if message.document:
+            if message.document.file_size and message.document.file_size > IMPORT_MAX_SIZE:
+                raise ValueError("Файл расписания слишком большой")
+            file_info = bot.get_file(message.document.file_id)
+            text = bot.download_file(file_info.file_path).decode('utf-8')
+        elif message.text:
+            text = message.text
+        else:
+            raise ValueError("Отправьте файл CSV/JSON или текст")
+
+        rows = parse_schedule_import(text)
+        if not rows:
+            raise ValueError("В файле нет уроков")
+
+        existing_events = load_events()
+        imported, errors = build_import_events(rows, existing_events, load_settings()['lesson_duration'])
+        if errors:
+            bot.send_message(
+                message.chat.id,
+                f"⛔ Расписание не загружено, ошибок: {len(errors)}\n" + "\n".join(errors)
+            )
+            return
+
+        # Профили, которых нет в файле, остаются как были
+        profiles = {e.profile for e in imported}
+        events = imported + [e for e in existing_events if e.profile not in profiles]
+        success, cron_msg = apply_schedule_import(events, existing_events)
+        report = f"✅ Загружено уроков: {len(imported) // 2}"
+        if profiles != {DEFAULT_PROFILE}:
+            report += f" (профили: {', '.join(sorted(profiles))})"
+        if not success:
+            report += f"\n⚠️ Не удалось обновить cron: {cron_msg}"
+        bot.send_message(message.chat.id, report)
+
+    except Exception as e:
+        logging.error(f"Ошибка импорта расписания: {str(e)}", exc_info=True)
+        bot.send_message(message.chat.id, f"❌ Ошибка импорта: {str(e)}")
+    finally:
+        start(message)
+
+#-----------------Массовые изменения расписания------------------->
+BULK_PREVIEW_LINES = 40
+
+# Показанные, но ещё не подтверждённые изменения:
+# {chat_id: {'events': [...], 'version': версия расписания, 'title': str}}
+bulk_pending = SessionStore("bulk", DIALOG_TIMEOUT)
+
+def _lesson_table(events, profile):
+    """{номер урока: {'start': событие, 'end': событие}} за один проход"""
+    lessons = {}
+    for event in profile_events(events, profile):
+        lessons.setdefault(int(event.lesson_num), {})[event.event_type] = event
+    return lessons
+
+def _moved(event, minutes):
+    """Копия события с новым временем"""
+    if not 0 <= minutes < 24 * 60:
+        raise ValueError(f"Урок {event.lesson_num} выходит за пределы суток")
+    return LessonEvent(event.lesson_num, event.event_type, minutes_to_time(minutes), event.audio_file, event.profile)
+
+def _with_profile(events, profile, changed):
+    """Расписание, где события профиля заменены на changed"""
+    return [e for e in events if e.profile != profile] + changed
+
+def shift_lessons(events, from_lesson, delta, profile=DEFAULT_PROFILE):
+    """Сдвигает уроки с номером >= from_lesson на delta минут"""
+    changed = [
+        _moved(e, time_to_minutes(e.time) + delta) if int(e.lesson_num) >= from_lesson else e
+        for e in profile_events(events, profile)
+    ]
+    return _with_profile(events, profile, changed)
+
+def regenerate_lessons(events, first_start, duration, breaks, profile=DEFAULT_PROFILE):
+    """Пересчитывает время всех уроков профиля: первый начинается в first_start,
+    каждый длится duration минут, перемены берутся из breaks по порядку
+    (последняя повторяется). Номера и звуки уроков сохраняются."""
+    lessons = _lesson_table(events, profile)
+    changed = []
+    start = time_to_minutes(first_start)
+    for i, lesson_num in enumerate(sorted(lessons)):
+        if i:
+            start = end + breaks[min(i - 1, len(breaks) - 1)]
+        end = start + duration
+        for event_type, minutes in (('start', start), ('end', end)):
+            if event_type in lessons[lesson_num]:
+                changed.append(_moved(lessons[lesson_num][event_type], minutes))
+    return _with_profile(events, profile, changed)
+
+def compress_breaks(events, max_break, profile=DEFAULT_PROFILE):
+    """Сокращает перемены длиннее max_break минут, сдвигая следующие уроки раньше.
+    Продолжительность уроков не меняется."""
+    lessons = _lesson_table(events, profile)
+    changed = []
+    offset = 0
+    previous_end = None
+    for lesson_num in sorted(lessons):
+        lesson = lessons[lesson_num]
+        if 'start' not in lesson or 'end' not in lesson:
+            raise ValueError(f"У урока {lesson_num} нет начала или конца")
+        start, end = time_to_minutes(lesson['start'].time), time_to_minutes(lesson['end'].time)
+        if previous_end is not None and start - previous_end > max_break:
+            offset -= start - previous_end - max_break
+        previous_end = end
+        changed.append(_moved(lesson['start'], start + offset))
+        changed.append(_moved(lesson['end'], end + offset))
+    return _with_profile(events, profile, changed)
+
+def schedule_diff(old_events, new_events):
+    """Строки "Урок N начало: ЧЧ:ММ → ЧЧ:ММ" для изменившихся событий"""
+    old_times = {(e.profile, e.lesson_num, e.event_type): e.time for e in old_events}
+    lines = []
+    for e in sorted(new_events, key=lambda e: (e.profile, int(e.lesson_num), e.event_type != 'start')):
+        old_time = old_times.get((e.profile, e.lesson_num, e.event_type))
+        if old_time != e.time:
+            suffix = "" if e.profile == DEFAULT_PROFILE else f" ({e.profile})"
+            lines.append(
+                f"Урок {e.lesson_num}{suffix} {'начало' if e.event_type == 'start' else 'конец'}: "
+                f"{old_time or '-'} → {e.time}"
+            )
+    return lines
+
+def apply_bulk_change(events):
+    """Сохраняет расписание одной записью и одной установкой cron"""
+    with cron_batch() as batch:
+        if not save_events(events):
+            raise Exception("Не удалось сохранить файл расписания")
+        install_cron_jobs()
+    return batch.get('cron', (True, ""))
+
+def offer_bulk_change(message, title, old_events, new_events, profile):
+    """Показывает изменения без сохранения и спрашивает подтверждение"""
+    errors = _schedule_overlap_errors(profile_events(new_events, profile), profile)
+    if errors:
+        bot.send_message(message.chat.id, "⛔ Изменение невозможно:\n" + "\n".join(errors))
+        return
+    lines = schedule_diff(old_events, new_events)
+    if not lines:
+        bot.send_message(message.chat.id, "Изменений нет.")
+        return
+
+    bulk_pending[message.chat.id] = {
+        'events': new_events,
+        'version': get_schedule_version(),
+        'title': title
+    }
+    preview = lines[:BULK_PREVIEW_LINES]
+    if len(lines) > BULK_PREVIEW_LINES:
+        preview.append(f"... и ещё {len(lines) - BULK_PREVIEW_LINES}")
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(types.KeyboardButton("Применить"), types.KeyboardButton("Не применять"))
+    msg = bot.send_message(
+        message.chat.id,
+        f"🔍 {title} (проверка, ничего не сохранено)\n"
+        f"Изменится событий: {len(lines)}\n\n" + "\n".join(preview),
+        reply_markup=markup
+    )
+    bot.register_next_step_handler(msg, process_bulk_confirm)
+
+def process_bulk_confirm(message):
+    pending = bulk_pending.pop(message.chat.id, None)
+    try:
+        if message.text != "Применить" or pending is None:
+            bot.send_message(message.chat.id, "Изменения не применены", reply_markup=types.ReplyKeyboardRemove())
+            return
+        load_events()  # Подхватывает правки файла расписания вне бота
+        if get_schedule_version() != pending['version']:
+            bot.send_message(
+                message.chat.id,
+                "⛔ Расписание изменилось после проверки, повторите команду",
+                reply_markup=types.ReplyKeyboardRemove()
+            )
+            return
+        success, cron_msg = apply_bulk_change(pending['events'])
+        report = f"✅ {pending['title']}: изменения сохранены"
+        if not success:
+            report += f"\n⚠️ Не удалось обновить cron: {cron_msg}"
+        bot.send_message(message.chat.id, report, reply_markup=types.ReplyKeyboardRemove())
+    except Exception as e:
+        logging.error(f"Ошибка массового изменения: {str(e)}", exc_info=True)
+        bot.send_message(message.chat.id, f"❌ Ошибка: {str(e)}")
+    finally:
+        start(message)
+
+def _bulk_args(message, usage, count):
+    """Аргументы команды и профиль (необязательный последний аргумент)"""
+    parts = message.text.split()[1:]
+    if len(parts) not in (count, count + 1):
+        raise ValueError(f"Формат: {usage}")
+    profile = parts[count] if len(parts) > count else DEFAULT_PROFILE
+    return parts[:count], profile
+
+@bot.message_handler(commands=['shift'])
+@auth_required
+def shift_command(message):
+    try:
+        (from_lesson, delta), profile = _bulk_args(message, "/shift <с урока> <±минуты> [профиль]", 2)
+        if not from_lesson.isdigit() or not re.fullmatch(r'[+-]?\d+', delta):
+            raise ValueError("Номер урока и сдвиг должны быть числами")
+        events = load_events()
+        new_events = shift_lessons(events, int(from_lesson), int(delta), profile)
+        offer_bulk_change(message, f"Сдвиг уроков с {from_lesson} на {int(delta):+d} мин", events, new_events, profile)
+    except ValueError as e:
+        bot.send_message(message.chat.id, f"❌ {str(e)}")
+    except Exception as e:
+        logging.error(f"Ошибка сдвига расписания: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+@bot.message_handler(commands=['regenerate'])
+@auth_required
+def regenerate_command(message):
+    try:
+        (first_start, breaks), profile = _bulk_args(
+            message, "/regenerate <ЧЧ:ММ первого урока> <перемены через запятую> [профиль]", 2
+        )
+        first_start = normalize_time(first_start)
+        try:
+            breaks = [int(b) for b in breaks.split(',')]
+        except ValueError:
+            raise ValueError("Перемены - минуты через запятую, например 10,20,10")
+        if any(b < 0 for b in breaks):
+            raise ValueError("Перемена не может быть отрицательной")
+        duration = load_settings()['lesson_duration']
+        events = load_events()
+        new_events = regenerate_lessons(events, first_start, duration, breaks, profile)
+        offer_bulk_change(
+            message, f"Пересчёт от {first_start}, уроки по {duration} мин", events, new_events, profile
+        )
+    except ValueError as e:
+        bot.send_message(message.chat.id, f"❌ {str(e)}")
+    except Exception as e:
+        logging.error(f"Ошибка пересчёта расписания: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+@bot.message_handler(commands=['compress_breaks'])
+@auth_required
+def compress_breaks_command(message):
+    try:
+        (max_break,), profile = _bulk_args(message, "/compress_breaks <минуты> [профиль]", 1)
+        if not max_break.isdigit():
+            raise ValueError("Длина перемены должна быть числом")
+        events = load_events()
+        new_events = compress_breaks(events, int(max_break), profile)
+        offer_bulk_change(message, f"Перемены не длиннее {max_break} мин", events, new_events, profile)
+    except ValueError as e:
+        bot.send_message(message.chat.id, f"❌ {str(e)}")
+    except Exception as e:
+        logging.error(f"Ошибка сжатия перемен: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+#-----------------Календарь звонков------------------->
+WEEKDAY_NAMES = {1: "Пн", 2: "Вт", 3: "Ср", 4: "Чт", 5: "Пт", 6: "Сб", 7: "Вс"}
+
+@bot.message_handler(commands=['calendar'])
+@auth_required
+def show_calendar(message):
+    try:
+        calendar = load_calendar()
+        today = date.today()
+        events = load_events()
+        profiles = sorted({e.profile for e in events})
+
+        text = "🗓 Календарь звонков\n\nДни недели:\n"
+        text += "\n".join(
+            f"  {WEEKDAY_NAMES[day]}: {calendar.weekdays.get(day, HOLIDAY)}" for day in range(1, 8)
+        )
+        overrides = calendar.overrides(today)
+        if overrides:
+            text += "\n\nОсобые даты:\n" + "\n".join(
+                f"  {day:%d.%m.%Y}: {profile}" for day, profile in overrides.items()
+            )
+        text += f"\n\nСегодня: {calendar.profile_for(today)}"
+        ring_at, _ = next_ring_after(datetime.now(), events, calendar)
+        if ring_at:
+            text += f"\nСледующий звонок: {ring_at:%d.%m %H:%M}"
+        text += f"\nПрофили в расписании: {', '.join(profiles) or 'нет'}"
+        text += (
+            "\n\nИзменить: /set_day <ГГГГ-ММ-ДД или 1-7> <профиль|holiday|->\n"
+            "'-' убирает особую дату или возвращает день недели по умолчанию"
+        )
+        bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logging.error(f"Ошибка показа календаря: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+@bot.message_handler(commands=['set_day'])
+@auth_required
+def set_day(message):
+    try:
+        parts = message.text.split()
+        if len(parts) != 3:
+            raise ValueError("Формат: /set_day <ГГГГ-ММ-ДД или 1-7> <профиль|holiday|->")
+        _, day, profile = parts
+        if profile != '-' and not re.fullmatch(r'[\w-]+', profile):
+            raise ValueError(f"Недопустимое имя профиля: {profile}")
+
+        calendar = load_calendar()
+        if day.isdigit() and 1 <= int(day) <= 7:
+            weekday = int(day)
+            calendar.weekdays[weekday] = DEFAULT_WEEKDAYS[weekday] if profile == '-' else profile
+            target = WEEKDAY_NAMES[weekday]
+        else:
+            try:
+                target_date = date.fromisoformat(day)
+            except ValueError:
+                raise ValueError("День: дата ГГГГ-ММ-ДД или номер дня недели 1-7")
+            if profile == '-':
+                calendar.dates.pop(target_date, None)
+            else:
+                calendar.dates[target_date] = profile
+            target = f"{target_date:%d.%m.%Y}"
+
+        if profile not in ('-', HOLIDAY) and not profile_events(load_events(), profile):
+            bot.send_message(message.chat.id, f"⚠️ В расписании нет уроков профиля {profile}")
+
+        save_calendar(calendar)
+        success, cron_msg = install_cron_jobs()
+        report = f"✅ {target}: {profile if profile != '-' else 'по умолчанию'}"
+        if not success:
+            report += f"\n⚠️ Не удалось обновить cron: {cron_msg}"
+        bot.send_message(message.chat.id, report)
+    except ValueError as e:
+        bot.send_message(message.chat.id, f"❌ {str(e)}")
+    except Exception as e:
+        logging.error(f"Ошибка изменения календаря: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+#-----------------Точность звонков------------------->
+RING_STATS_DEFAULT_DAYS = 7
+
+@bot.message_handler(commands=['ring_stats'])
+@auth_required
+def ring_stats(message):
+    """Опоздание звонков (до первого сэмпла) по дням и по урокам"""
+    try:
+        parts = message.text.split()
+        days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else RING_STATS_DEFAULT_DAYS
+        since = datetime.combine(date.today() - timedelta(days=days - 1), datetime.min.time())
+        records = read_ring_log(since.timestamp())
+        if not records:
+            bot.send_message(message.chat.id, f"За {days} дн. звонков в журнале нет.")
+            return
+
+        by_day = {}
+        by_lesson = {}
+        no_sample = 0
+        for record in records:
+            lateness = record['first_sample_ms']
+            if lateness is None:
+                no_sample += 1
+                lateness = record['started_ms']
+                if lateness is None:
+                    continue
+            day = datetime.fromtimestamp(record['scheduled']).date()
+            by_day.setdefault(day, []).append(lateness)
+            lesson = (record['profile'], int(record['lesson']), record['event_type'])
+            by_lesson.setdefault(lesson, []).append(lateness)
+
+        text = f"⏱ Опоздание звонков за {days} дн. (до первого сэмпла)\n\nПо дням:\n"
+        text += "\n".join(
+            f"  {day:%d.%m}: {len(values)} зв., {lateness_summary(values)}"
+            for day, values in sorted(by_day.items())
+        )
+        text += "\n\nПо урокам:\n"
+        text += "\n".join(
+            f"  {lesson_num}{'' if profile == DEFAULT_PROFILE else f' ({profile})'} "
+            f"{'начало' if event_type == 'start' else 'конец'}: {lateness_summary(values)}"
+            for (profile, lesson_num, event_type), values in sorted(
+                by_lesson.items(),
+                key=lambda item: (item[0][0] != DEFAULT_PROFILE, item[0][0], item[0][1], item[0][2] != 'start')
+            )
+        )
+        if no_sample:
+            text += f"\n\nБез отметки первого сэмпла (взят запуск плеера): {no_sample}"
+        bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logging.error(f"Ошибка статистики звонков: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+#-----------------Производительность обработчиков------------------->
+@bot.message_handler(commands=['perf'])
+@auth_required
+def perf(message):
+    """Самые медленные обработчики по p99 и последний медленный профиль"""
+    try:
+        with _handler_timings_lock:
+            snapshot = {name: sorted(timings) for name, timings in handler_timings.items() if timings}
+        if not snapshot:
+            bot.send_message(message.chat.id, "Замеров пока нет.")
+            return
+
+        top = sorted(snapshot.items(), key=lambda item: percentile(item[1], 0.99), reverse=True)[:15]
+        text = f"⚙️ Обработчики (последние {PERF_WINDOW} вызовов), мс:\n\n"
+        text += "\n".join(
+            f"{name}: {len(values)} выз., p50 {percentile(values, 0.5) * 1000:.0f}, "
+            f"p99 {percentile(values, 0.99) * 1000:.0f}, max {values[-1] * 1000:.0f}"
+            for name, values in top
+        )
+        path = dump_slow_profile()
+        if path:
+            text += (
+                f"\n\nПоследний медленный вызов (>{PERF_SLOW_MS:.0f} мс): {slow_profile['name']}, "
+                f"{slow_profile['seconds'] * 1000:.0f} мс\nПрофиль: {path}"
+            )
+        else:
+            text += f"\n\nМедленных вызовов под профилем (>{PERF_SLOW_MS:.0f} мс) не было."
+        bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logging.error(f"Ошибка /perf: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+#-----------------Сеть звонковых узлов------------------->
+@bot.message_handler(commands=['fleet'])
+@auth_required
+def fleet_status(message):
+    """Какие агенты на связи и какая у них версия расписания"""
+    try:
+        if FLEET_ROLE != "controller":
+            bot.send_message(message.chat.id, "Этот узел не контроллер (FLEET_ROLE=controller в .env).")
+            return
+        snapshot = fleet_controller.refresh()
+        nodes = dict(fleet_controller.nodes)
+        text = f"🏫 Версия расписания: {snapshot['version']}\n\n"
+        if not nodes:
+            text += "Агенты ещё не подключались."
+        now = time.time()
+        for node, info in sorted(nodes.items()):
+            status = "✅" if info['hash'] == snapshot['hash'] else "⏳ обновляется"
+            text += f"{status} {node} ({info['address']}), на связи {now - info['seen']:.0f} с назад\n"
+        bot.send_message(message.chat.id, text)
+    except Exception as e:
+        logging.error(f"Ошибка /fleet: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+#-----------------Звонок сейчас------------------->
+RING_NOW_PREFIX = "ringnow:"
+ring_now_choices = SessionStore("ring_now", DIALOG_TIMEOUT)  # {chat_id: [имена файлов для кнопок]}
+
+def ring_now_options():
+    """[(имя файла, подпись)] звуков из расписания, которые есть на диске"""
+    available = audio_inventory.snapshot()
+    labels = {}
+    for event in sorted(load_events(), key=lambda e: (e.profile != DEFAULT_PROFILE, int(e.lesson_num))):
+        if event.audio_file in available and event.audio_file not in labels:
+            kind = 'начало' if event.event_type == 'start' else 'конец'
+            labels[event.audio_file] = f"урок {event.lesson_num}, {kind}"
+    options = []
+    for name, label in labels.items():
+        duration = available[name].get('duration')
+        if duration:
+            label += f", {duration:.0f} с"
+        options.append((name, f"{os.path.basename(name)[:16]} ({label})"))
+    return options
+
+@bot.message_handler(commands=['ring_now'])
+@auth_required
+def ring_now_command(message):
+    """Выбор звука для немедленного звонка"""
+    try:
+        options = ring_now_options()
+        if not options:
+            bot.send_message(message.chat.id, "Нет звуков: сначала добавьте уроки со звонками.")
+            return
+        ring_now_choices[message.chat.id] = [name for name, _ in options]
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        for i, (_, label) in enumerate(options):
+            markup.add(types.InlineKeyboardButton(f"🔔 {label}", callback_data=f"{RING_NOW_PREFIX}{i}"))
+        nodes = len(command_hub.links())
+        bot.send_message(
+            message.chat.id,
+            f"Какой звук дать сейчас? Сыграет здесь и на агентах: {nodes}.",
+            reply_markup=markup
+        )
+    except Exception as e:
+        logging.error(f"Ошибка /ring_now: {str(e)}")
+        bot.send_message(message.chat.id, f"Произошла ошибка: {str(e)}")
+
+def format_ring_now_report(audio_file, results):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:+.0f}"
+    lines = [f"🔔 {os.path.basename(audio_file)}: старт относительно назначенного момента, мс\n"]
+    for result in results:
+        if result.get('error'):
+            lines.append(f"❌ {result['node']}: {result['error']}")
+        else:
+            lines.append(
+                f"✅ {result['node']}: подтверждение {result['ack'] * 1000:.0f}, "
+                f"плеер {ms(result['started'])}, первый сэмпл {ms(result['first_sample'])}"
+            )
+    starts = [r['first_sample'] if r.get('first_sample') is not None else r.get('started') for r in results]
+    starts = [value for value in starts if value is not None]
+    if len(starts) > 1:
+        spread = max(starts) - min(starts)
+        mark = "✅" if spread <= RING_NOW_SPREAD_LIMIT else "⚠️"
+        lines.append(f"\n{mark} Разброс старта: {spread * 1000:.0f} мс")
+    return "\n".join(lines)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith(RING_NOW_PREFIX))
+def ring_now_pick(call):
+    chat_id = call.message.chat.id
+    try:
+        if not is_authenticated(chat_id):
+            bot.answer_callback_query(call.id, "Войдите заново: /start")
+            return
+        choices = ring_now_choices.pop(chat_id, None)
+        index = int(call.data[len(RING_NOW_PREFIX):])
+        if not choices or index >= len(choices):
+            bot.answer_callback_query(call.id, "Список устарел, откройте /ring_now заново")
+            return
+        audio_file = choices[index]
+        bot.answer_callback_query(call.id, "Звоню")
+        bot.edit_message_text(f"🔔 Звоню: {os.path.basename(audio_file)}", chat_id, call.message.message_id)
+
+        # Ждать отчёты агентов в обработчике незачем - отчёт придёт отдельным сообщением
+        def run():
             try:
-                filepath = os.path.join(AUDIO_DIR, lesson_data[file_type])
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                results = ring_now(audio_file)
+                bot.send_message(chat_id, format_ring_now_report(audio_file, results))
             except Exception as e:
-                logging.error(f"Ошибка удаления файла {filepath}: {str(e)}")
-        
+                logging.error(f"Ошибка звонка сейчас: {str(e)}", exc_info=True)
+                bot.send_message(chat_id, f"Ошибка звонка: {str(e)}")
+
+        threading.Thread(target=run, name="ring-now", daemon=True).start()
+    except Exception as e:
+        logging.error(f"Ошибка выбора звука для /ring_now: {str(e)}")
+        bot.answer_callback_query(call.id, "Ошибка, откройте /ring_now заново")
+
 #-----------------Ручная проверка------------------->
 @bot.message_handler(commands=['check_permissions'])
 def check_permissions(message):
@@ -1219,6 +5298,19 @@ def debug_state(message):
     else:
         bot.send_message(message.chat.id, "Нет активного состояния удаления")
 
+@bot.message_handler(commands=['export_schedule'])
+@auth_required
+def export_schedule(message):
+    """Отправляет расписание в текстовом формате schedule.txt"""
+    try:
+        export_path = os.path.join(CRON_BACKUPS_DIR, "schedule_export.txt")
+        export_schedule_text(export_path)
+        with open(export_path, 'rb') as f:
+            bot.send_document(message.chat.id, f, visible_file_name="schedule.txt")
+    except Exception as e:
+        logging.error(f"Ошибка выгрузки расписания: {str(e)}")
+        bot.send_message(message.chat.id, f"Ошибка выгрузки: {str(e)}")
+
 @bot.message_handler(commands=['debug_events'])
 def debug_events(message):
     """Показывает текущие события"""
@@ -1238,10 +5330,10 @@ def check_files(message):
             bot.send_message(message.chat.id, "Нет уроков в расписании")
             return
         
+        available = audio_inventory.snapshot()
         missing_files = []
         for event in events:
-            file_path = os.path.join(AUDIO_DIR, event.audio_file)
-            if not os.path.exists(file_path):
+            if event.audio_file not in available:
                 missing_files.append(
                     f"{event.audio_file} (урок {event.lesson_num}, {'начало' if event.event_type == 'start' else 'конец'})"
                 )
@@ -1257,23 +5349,139 @@ def check_files(message):
     except Exception as e:
         logging.error(f"Ошибка в check_files: {str(e)}")
         bot.send_message(message.chat.id, f"Ошибка проверки файлов: {str(e)}")
+#--------------------Параллельные чаты-------------------------------->
+def _update_chat_id(update):
+    """Чат, к которому относится обновление (для упорядочивания диалогов)"""
+    for source in (update.message, update.edited_message, update.callback_query):
+        if source is None:
+            continue
+        chat = getattr(source, 'chat', None) or getattr(getattr(source, 'message', None), 'chat', None)
+        if chat is not None:
+            return chat.id
+        return source.from_user.id
+    return None
+
+class ChatDispatcher:
+    """Обновления разных чатов - параллельно в пуле потоков, одного чата - по очереди.
+
+    Подменяет bot.process_new_updates: поток опроса только раскладывает
+    обновления по чатам и сразу берёт следующие. У чата с необработанными
+    обновлениями есть очередь и ровно одна задача в пуле, которая их
+    разбирает; опустевшая очередь удаляется, так что состояние не растёт с
+    числом чатов. Долгая загрузка аудио занимает один поток и не задерживает
+    остальные чаты, а пошаговые диалоги не перемешиваются.
+    """
+
+    def __init__(self, bot, workers):
+        from concurrent.futures import ThreadPoolExecutor
+        self.bot = bot
+        self._process = bot.process_new_updates
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler")
+        self._queues = {}  # {chat_id: deque(обновлений)} - только у чатов, которые сейчас обрабатываются
+        self._lock = threading.Lock()
+
+    def install(self):
+        # Обработчики вызываются прямо в потоке чата, без пула TeleBot
+        self.bot.threaded = False
+        self.bot.process_new_updates = self.dispatch
+
+    def dispatch(self, updates):
+        if not updates:
+            return
+        # Исходный process_new_updates сдвигает смещение опроса сам, но он
+        # выполнится позже - без этого следующий getUpdates вернул бы те же обновления
+        self.bot.last_update_id = max(self.bot.last_update_id, max(update.update_id for update in updates))
+        by_chat = {}
+        for update in updates:
+            by_chat.setdefault(_update_chat_id(update), []).append(update)
+        with self._lock:
+            for chat_id, chat_updates in by_chat.items():
+                queue = self._queues.get(chat_id)
+                if queue is not None:
+                    # Задача чата ещё работает - она заберёт и эти
+                    queue.extend(chat_updates)
+                    continue
+                self._queues[chat_id] = deque(chat_updates)
+                self._executor.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self._lock:
+                queue = self._queues[chat_id]
+                if not queue:
+                    del self._queues[chat_id]
+                    return
+                updates = list(queue)
+                queue.clear()
+            try:
+                self._process(updates)
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновлений чата {chat_id}: {str(e)}", exc_info=True)
+
 #####################################ЗАПУСК№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№№        
 if __name__ == "__main__":
 
     os.makedirs(CRON_BACKUPS_DIR, exist_ok=True)
     os.makedirs(AUDIO_BACKUPS_DIR, exist_ok=True)
     os.makedirs(AUDIO_DIR, exist_ok=True)
+    os.makedirs(PCM_CACHE_DIR, exist_ok=True)
     
-    print("Бот запущен... Нажмите Ctrl+C для остановки")
+    if load_settings().get("ring_mode") == RING_MODE_ENGINE:
+        ring_engine.start()
+        # Убираем из crontab строки звонков, чтобы не было двойных звонков
+        install_cron_jobs()
+
+    instrument_handlers()
+    if PLAYER_SUPERVISOR_ENABLED and os.path.exists(APLAY_PATH):
+        player_supervisor.start()
+    if FILE_WATCH != "0":
+        file_watcher.start()
+    if FLEET_ROLE == "controller":
+        if FLEET_TOKEN:
+            fleet_controller.start_server()
+            command_hub.start()
+        else:
+            logging.error("FLEET_TOKEN не задан - контроллер звонков не запущен")
+    if OUTBOX_ENABLED:
+        outbox.install()
+    if METRICS_PORT:
+        apihelper.CUSTOM_REQUEST_SENDER = timed_telegram_request
+        try:
+            start_metrics_server()
+        except OSError as e:
+            logging.error(f"Не удалось запустить сервер метрик: {str(e)}")
+
+    if FLEET_ROLE == "agent":
+        if not FLEET_CONTROLLER:
+            logging.critical("FLEET_CONTROLLER не задан (например, http://10.0.0.1:9110)")
+            sys.exit(1)
+        fleet_agent = FleetAgent(FLEET_CONTROLLER, FLEET_NODE, FLEET_TOKEN)
+        print(f"Агент звонков {FLEET_NODE} запущен... Нажмите Ctrl+C для остановки")
+    else:
+        print("Бот запущен... Нажмите Ctrl+C для остановки")
     
     try:
-        while True:
-            try:
-                bot.infinity_polling(none_stop=True, timeout=60)
-            except Exception as e:
-                logging.error(f"Ошибка подключения: {str(e)}")
-                time.sleep(10)
+        if FLEET_ROLE == "agent":
+            threading.Thread(target=fleet_agent.run_commands, name="fleet-commands", daemon=True).start()
+            fleet_agent.run()
+        else:
+            if BOT_MODE == "async":
+                logging.warning("BOT_MODE=async переименован в BOT_MODE=threaded")
+            if BOT_MODE in ("threaded", "async"):
+                ChatDispatcher(bot, BOT_WORKERS).install()
+            while True:
+                try:
+                    bot.infinity_polling(none_stop=True, timeout=60)
+                except Exception as e:
+                    logging.error(f"Ошибка подключения: {str(e)}")
+                    time.sleep(10)
     except KeyboardInterrupt:
         print("\nПолучен сигнал остановки. Завершаю работу...")
+        ring_engine.stop()
+        player_supervisor.stop()
+        file_watcher.stop()
+        flush_sessions()
+        if OUTBOX_ENABLED:
+            outbox.drain()
         # Дополнительные действия при остановке (если нужны)
         sys.exit(0)
\ No newline at end of file